@@ -0,0 +1,112 @@
+"""
+Compare the cost per mouse move of the two ways of drawing the cross hairs.
+
+"readd" is what Lasagna.mouseMoved used to do: remove both lines from all three views, add them to
+the view under the mouse again, then move them. "overlay" is the persistent CursorOverlay, which only
+moves the lines and hides them in the other views. Each move is followed by processing the pending
+events, so repainting is included.
+
+Run with:
+    python benchmarks/cursor_overlay_benchmark.py [--moves N] [--points N]
+
+Set QT_QPA_PLATFORM=offscreen to run without a display.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtWidgets import QApplication
+
+from lasagna.utils.cursor_overlay import CursorOverlay
+
+
+class FakeProjection(object):
+    def __init__(self, view):
+        self.view = view
+
+
+def make_views(n_points):
+    """
+    Three PlotWidgets each showing an image and a scatter plot, like the lasagna views
+    """
+    views = []
+    for i in range(3):
+        view = pg.PlotWidget()
+        view.resize(600, 600)
+        view.addItem(pg.ImageItem(np.random.randint(0, 2 ** 12, (1024, 1024)).astype(np.uint16)))
+        view.addItem(pg.ScatterPlotItem(*np.random.uniform(0, 1024, (2, n_points))))
+        view.show()
+        views.append(view)
+    return views
+
+
+def positions(n_moves):
+    """
+    A cursor path moving between the views
+    """
+    t = np.linspace(0, 20 * np.pi, n_moves)
+    xy = 512 + 400 * np.column_stack((np.cos(t), np.sin(1.3 * t)))
+    return [(int(i * 3 / n_moves), x, y) for i, (x, y) in enumerate(xy)]
+
+
+def bench_readd(app, views, path):
+    v_line = pg.InfiniteLine(angle=90, movable=False)
+    h_line = pg.InfiniteLine(angle=0, movable=False)
+    start = time.perf_counter()
+    for view_id, x, y in path:
+        for view in views:
+            for line in (v_line, h_line):
+                if line in view.items():
+                    view.removeItem(line)
+        views[view_id].addItem(v_line, ignoreBounds=True)
+        views[view_id].addItem(h_line, ignoreBounds=True)
+        v_line.setPen(220, 200, 0, 180)
+        h_line.setPen(220, 200, 0, 180)
+        v_line.setPos(x + 0.5)
+        h_line.setPos(y + 0.5)
+        app.processEvents()
+    return (time.perf_counter() - start) / len(path)
+
+
+def bench_overlay(app, views, path):
+    overlays = [CursorOverlay(FakeProjection(view)) for view in views]
+    for overlay in overlays:
+        overlay.addCrossHairs()
+    start = time.perf_counter()
+    for view_id, x, y in path:
+        for i, overlay in enumerate(overlays):
+            if i != view_id:
+                overlay.hideCrossHairs()
+        overlays[view_id].showCrossHairs(x, y, (220, 200, 0, 180))
+        app.processEvents()
+    elapsed = (time.perf_counter() - start) / len(path)
+    for overlay in overlays:
+        overlay.removeDecoration("crossHairVLine")
+        overlay.removeDecoration("crossHairHLine")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--moves", type=int, default=2000, help="number of simulated mouse moves")
+    parser.add_argument("--points", type=int, default=10000, help="number of scatter points in each view")
+    args = parser.parse_args()
+
+    app = QApplication([])
+    views = make_views(args.points)
+    path = positions(args.moves)
+    app.processEvents()
+
+    bench_readd(app, views, path[:100])  # Warm up
+    readd = bench_readd(app, views, path)
+    overlay = bench_overlay(app, views, path)
+
+    print("re-adding lines: {:.3f} ms per move".format(readd * 1e3))
+    print("overlay:         {:.3f} ms per move".format(overlay * 1e3))
+    print("speed-up:        {:.1f}x".format(readd / overlay))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+"""
+pytest configuration for the tests that sit next to the modules they test.
+
+Importing anything from lasagna.ingredients imports every ingredient, and with them PyQt5,
+pyqtgraph and matplotlib. Where those are not installed the ingredient tests are not collected,
+as pytest.importorskip in the test module would only run after the package failed to import.
+"""
+
+import importlib.util
+
+GUI_LIBRARIES = ("PyQt5", "pyqtgraph", "matplotlib")
+
+collect_ignore_glob = []
+if not all(importlib.util.find_spec(name) for name in GUI_LIBRARIES):
+    collect_ignore_glob.append("ingredients/test_*.py")
@@ -3,12 +3,195 @@ This class defines the basic imagestack and instructs lasagna as to how to handl
 """
 
 
+import weakref
+
 import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore
 
 from lasagna.ingredients.lasagna_ingredient import lasagna_ingredient
-from lasagna.io_libs.image_stack_loader import save_stack
+from lasagna.io_libs.image_stack_loader import save_filter, save_stack
+from lasagna.io_libs.lazy_stack import LazyStack, PlaneCache
+from lasagna.utils import preferences
+from lasagna.utils.background_task import BackgroundTask
+from lasagna.utils.slice_renderer import render_slice, render_tiled
+
+
+# Lookup tables already built, keyed by (colour map name, maximum value, alpha). They are
+# shared between stacks and never modified.
+LUT_CACHE = {}
+
+
+def calc_histogram(data, verbose=False):
+    """
+    Calculate the intensity histogram of the image stack data and return it as a dictionary
+    with keys "x" and "y". This does not touch the GUI so it can be run on a worker thread.
+    """
+    if verbose:
+        print("Calculating histogram")
+
+    nValsForCalc = 10E6 #Number of values on which to base histogram calculation
+    sampleEverynSamples = data.size
+    if data.size > nValsForCalc:
+        sampleEverynSamples = int(data.size/nValsForCalc)
+        if verbose:
+            print("Histogram based on one value every %d" % sampleEverynSamples)
+    else:
+        sampleEverynSamples=1
+
+    y, x = np.histogram(data[::sampleEverynSamples], bins=256)
+    x = x[0:-1]  # chop off last value
+    if verbose:
+        print("Done")
+    return {"x": x, "y": y}
+
+
+def default_hist_range(data, logY=False, verbose=False):
+    """
+    Returns a reasonable values for the maximum plotted value of the image stack data.
+    logY if True we log the Y values. This does not touch the GUI so it can be run on a worker thread.
+    """
+
+    if verbose:
+        print("Determining default histogram range")
+
+    nValsForCalc = 1E6 #Number of values on which to base histogram calculation
+    sampleEverynSamples = data.size
+    if data.size > nValsForCalc:
+        sampleEverynSamples = int(data.size/nValsForCalc)
+        if verbose:
+            print("Histogram based on one value every %d" % sampleEverynSamples)
+    else:
+        sampleEverynSamples=1
+
+
+    y, x = np.histogram(data[::sampleEverynSamples], bins=100)
+    y = np.append(y, 0)
+
+    # Remove negative numbers from the calculation. Sometimes these happen with registered images
+    y = y[x > 0]
+    x = x[x > 0]
+
+    if logY:
+        y = np.log10(y + 0.1)
+
+    # I'm sure this isn't the most robust approach but it works for now
+    thresh = 0.925  # find values greater than this proportion
+
+    m = x * y
+    vals = np.cumsum(m) / np.sum(m)
+
+    vals = vals > thresh
+
+    if verbose:
+        print("Done")
+
+    return x[vals.tolist().index(True)]
+
+
+def block_reduce(plane, factor, reduce="mean"):
+    """
+    Downsample a 2-D plane factor times along both dimensions. Each output pixel is the mean
+    (reduce="mean") or maximum (reduce="max") of a factor x factor block of input pixels.
+    Unlike plane[::factor, ::factor] this does not alias fine structure. Use "max" for label
+    images, where a mean would invent labels. The result has the same shape as
+    plane[::factor, ::factor]: blocks at the far edges are padded with the last row or column.
+    """
+    pad = (-plane.shape[0] % factor, -plane.shape[1] % factor)
+    if any(pad):
+        plane = np.pad(plane, ((0, pad[0]), (0, pad[1])), mode="edge")
+    # Each of the factor ** 2 pixels of a block in turn, for all blocks at once
+    pixels = [plane[i::factor, j::factor] for i in range(factor) for j in range(factor)]
+
+    if reduce == "max" or plane.dtype.kind not in "iuf":
+        out = pixels[0].copy()
+        for block_pixel in pixels[1:]:
+            np.maximum(out, block_pixel, out=out)
+        return out
+
+    if plane.dtype.kind == "f":
+        total = np.zeros(pixels[0].shape, dtype=np.promote_types(plane.dtype, np.float32))
+    else:
+        total = np.zeros(pixels[0].shape, dtype=np.int64 if plane.dtype.itemsize >= 4 else np.int32)
+    for block_pixel in pixels:
+        total += block_pixel
+    if plane.dtype.kind == "f":
+        total /= len(pixels)
+    else:
+        total += len(pixels) // 2  # Round to the nearest integer
+        total //= len(pixels)
+    return total.astype(plane.dtype)
+
+
+def pyramid_plane(data, sliceToPlot, pyramidFactor=1, region=None, reduce="mean", levels=None, key=None):
+    """
+    Return slice sliceToPlot of data, downsampled pyramidFactor times in-plane [see imagestack.pyramidPlane].
+    region ((x0, x1), (y0, y1)) crops the slice. x0 and y0 must be multiples of pyramidFactor.
+    Each even level is made from the level half as coarse by the mean or maximum of 2 x 2 blocks
+    [see block_reduce], so only the first level reads every pixel of the slice.
+    levels is an optional PlaneCache in which the levels are kept under (key, pyramidFactor),
+    key identifying the slice and region. Redraws and moves between levels then re-use them.
+    """
+    if pyramidFactor <= 1:
+        plane = data[sliceToPlot]
+        if region is not None:
+            (x0, x1), (y0, y1) = region
+            plane = plane[x0:x1, y0:y1]
+        return plane
+
+    def build(level_key):
+        if pyramidFactor % 2:
+            return block_reduce(pyramid_plane(data, sliceToPlot, 1, region), pyramidFactor, reduce)
+        finer = pyramid_plane(data, sliceToPlot, pyramidFactor // 2, region, reduce, levels, key)
+        return block_reduce(finer, 2, reduce)
+
+    if levels is None or key is None:
+        return build(None)
+    return levels.get((key, pyramidFactor), build)
+
+
+def item_transform(pyramidFactor=1, region=None):
+    """
+    Return the transform that places an image of the plane, cropped to region and downsampled
+    pyramidFactor times, in full resolution data coordinates
+    """
+    x0, y0 = (0, 0) if region is None else (region[0][0], region[1][0])
+    return QtGui.QTransform(pyramidFactor, 0, 0, pyramidFactor, x0, y0)
+
+
+def moved_to_another_slice(previous, wanted):
+    """
+    Return True if the image key wanted [see imagestack.sliceKey] is of another slice than
+    previous, i.e. the user navigated, rather than the same slice redrawn.
+    previous is None if nothing was shown yet.
+    """
+    if previous is None:
+        return True
+    return previous[1:3] != wanted[1:3]  # (axis, slice)
+
+
+def build_oriented_copies(data, axes, progress=None, max_slab_bytes=64 * 2 ** 20):
+    """
+    Return a dictionary, keyed by axis, of C-contiguous copies of the stack data in which that
+    axis is the first dimension. Slices along the axis are then blocks of contiguous memory
+    rather than gathers across the whole volume. The source is read in slabs of consecutive
+    planes, i.e. in memory order. This does not touch the GUI so it can be run on a worker thread.
+    """
+    n_planes = data.shape[0]
+    plane_bytes = max(1, int(np.prod(data.shape[1:])) * data.dtype.itemsize)
+    planes_per_slab = max(1, max_slab_bytes // plane_bytes)
+
+    copies = {}
+    for n, axis in enumerate(axes):
+        oriented = np.empty(data.swapaxes(0, axis).shape, dtype=data.dtype)
+        target = oriented.swapaxes(0, axis)  # The copy seen in the orientation of the source
+        for first in range(0, n_planes, planes_per_slab):
+            last = min(n_planes, first + planes_per_slab)
+            target[first:last] = data[first:last]
+            if progress is not None:
+                progress((n + float(last) / n_planes) / len(axes), "view %d" % (axis + 1))
+        copies[axis] = oriented
+    return copies
 
 
 class imagestack(lasagna_ingredient):
@@ -21,7 +204,12 @@ class imagestack(lasagna_ingredient):
         objectName="",
         minMax=None,
         lut="gray",
+        histogram=None,
     ):
+        """
+        minMax and histogram may be supplied if they have already been calculated
+        (e.g. by the thread that loaded the data). Otherwise they are calculated here.
+        """
         super(imagestack, self).__init__(
             parent,
             data,
@@ -43,10 +231,17 @@ class imagestack(lasagna_ingredient):
         self.lut = lut  # The look-up table
         self.maxColMapValue = 255
 
+        # How coarse pyramid levels are made from the full resolution slices: "mean" for
+        # intensities or "max" for label images [see block_reduce]
+        self.pyramidReduce = "mean"
+        self._pyramidLevels = PlaneCache(int(preferences.readPreference("pyramidCacheMB") or 0) * 2 ** 20)
+
         # image transparency stored in _alpha. see getters and setter at end of class def
         self._alpha = (100)
 
         self.build_model_for_list(objectName)
+        self.layoutItem = QtGui.QStandardItem(self.layoutDescription())  # [see buildOrientedCopies]
+        self.layoutItem.setEditable(False)
         self.model = self.parent.imageStackLayers_Model
         self.addToList()
 
@@ -55,7 +250,29 @@ class imagestack(lasagna_ingredient):
         self.histPenCustomColor = False
         self.histBrushCustomColor = False
 
-        self.histogram = self.calcHistogram()
+        if histogram is None:
+            histogram = self.calcHistogram()
+        self.histogram = histogram
+
+        # What each ImageItem showing this stack currently displays [see plotIngredient]
+        self._renderState = weakref.WeakKeyDictionary()
+
+    # The data are held in a property so that any change to them, including plugins assigning
+    # to _data directly, bumps dataVersion. Plot items then know that their image is stale.
+    @property
+    def _data(self):
+        return self._stackData
+
+    @_data.setter
+    def _data(self, data):
+        self._stackData = data
+        self.dataVersion = getattr(self, "dataVersion", 0) + 1
+        self.dropOrientedCopies()
+        if hasattr(self, "_pyramidLevels"):
+            self._pyramidLevels.clear()
+
+    def listItems(self):
+        return [self.modelItems, self.layoutItem]
 
     def setColorMap(self, cmap=""):
         """
@@ -73,13 +290,19 @@ class imagestack(lasagna_ingredient):
             print("valid color maps are {}".format(valid_cmaps))
             return
 
-        pos = np.array([0.0, 1.0])
         n_val = self.maxColMapValue
+        key = (cmap.lower(), n_val, self.alpha)
+        if key in LUT_CACHE:
+            return LUT_CACHE[key]
+
+        pos = np.array([0.0, 1.0])
         final_color = self.colorName2value(cmap, nVal=n_val, alpha=self.alpha)
         color = np.array([[0, 0, 0, n_val], final_color], dtype=np.ubyte)
         color_map = pg.ColorMap(pos, color)
         lut = color_map.getLookupTable(0.0, 1.0, n_val + 1)
+        lut.flags.writeable = False  # Shared by every stack with this colour map and alpha
 
+        LUT_CACHE[key] = lut
         return lut
 
     def colorName2value(self, colorName, nVal=255, alpha=255):
@@ -110,23 +333,7 @@ class imagestack(lasagna_ingredient):
         """
         Calculate the histogram and return results
         """
-        if verbose:
-            print("Calculating histogram")
-
-        nValsForCalc = 10E6 #Number of values on which to base histogram calculation
-        sampleEverynSamples = self.data().size
-        if self.data().size > nValsForCalc:
-            sampleEverynSamples = int(self.data().size/nValsForCalc)
-            if verbose:
-                print("Histogram based on one value every %d" % sampleEverynSamples)
-        else:
-            sampleEverynSamples=1
-
-        y, x = np.histogram(self.data()[::sampleEverynSamples], bins=256)
-        x = x[0:-1]  # chop off last value
-        if verbose:
-            print("Done")
-        return {"x": x, "y": y}
+        return calc_histogram(self.data(), verbose=verbose)
 
     def histBrushColor(self):
         """
@@ -152,17 +359,155 @@ class imagestack(lasagna_ingredient):
         """
         Returns data formated in the correct way for plotting in the single axes that requested it.
         axisToPlot defines the data dimension along which we are plotting the data.
-        specifically, axisToPlot is the dimension that is treated as the z-axis
+        specifically, axisToPlot is the dimension that is treated as the z-axis.
+        If there is a contiguous copy of the stack in this orientation it is returned instead of
+        a strided view [see buildOrientedCopies].
         """
+        oriented = self._orientedCopies.get(axisToPlot)
+        if oriented is not None:
+            return oriented
         return self._data.swapaxes(0, axisToPlot)
 
-    def plotIngredient(self, pyqtObject, axisToPlot=0, sliceToPlot=0):
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Contiguous copies of the stack for the views along the second and third axes
+    def buildOrientedCopies(self):
+        """
+        Slices along the second and third axes of a stack are strided gathers across the whole
+        volume. For large stacks these are many times slower to display than slices along the
+        first axis. This makes contiguous copies of the stack in those orientations on a worker
+        thread, as far as the "orientedCopiesMB" preference allows. The budget is shared by all
+        image stacks. Until the copies are ready the strided views are shown.
+        Lazily loaded stacks read and cache their own planes so they are not copied. Nor are
+        memory-mapped stacks (e.g. raw MHD files or volume cache entries), which are mapped
+        precisely so that they need not be read into RAM.
+        """
+        self.dropOrientedCopies()
+        if not isinstance(self._data, np.ndarray) or self._data.ndim != 3:
+            return
+        if isinstance(self._data, np.memmap):
+            return
+
+        budget = int(preferences.readPreference("orientedCopiesMB") or 0) * 2 ** 20
+        used = sum(
+            ingredient._orientedCopyBytes
+            for ingredient in self.parent.ingredientList
+            if isinstance(ingredient, imagestack) and ingredient is not self
+        )
+        axes = []
+        for axis in (2, 1):  # Slices along the last axis are the most scattered in memory
+            if used + self._data.nbytes <= budget:
+                axes.append(axis)
+                used += self._data.nbytes
+        if not axes:
+            return
+
+        version = self.dataVersion
+        self._orientedCopyBytes = len(axes) * self._data.nbytes  # Reserved while the copies are built
+        task = BackgroundTask(
+            build_oriented_copies,
+            self._data,
+            axes,
+            description="Copying {} for fast slicing".format(self.objectName),
+        )
+        task.succeeded.connect(lambda copies: self.orientedCopiesReady(copies, version))
+        task.failed.connect(lambda err: self.orientedCopiesAbandoned(version))
+        task.cancelled.connect(lambda: self.orientedCopiesAbandoned(version))
+        self._orientedCopyTask = task
+        self.parent.runInBackground(task, cancellable=False)  # The Cancel button is for the user's loads and saves
+        self.updateLayoutItem()
+
+    def orientedCopiesReady(self, copies, version):
+        if version != self.dataVersion:  # The data changed while the copies were being made
+            return
+        self._orientedCopies = copies
+        self._orientedCopyTask = None
+        self.updateLayoutItem()
+
+    def orientedCopiesAbandoned(self, version):
+        if version != self.dataVersion:
+            return
+        self._orientedCopyTask = None
+        self._orientedCopyBytes = 0
+        self.updateLayoutItem()
+
+    def dropOrientedCopies(self):
+        """
+        Free the contiguous copies, e.g. because the data they were made from have changed
+        """
+        if getattr(self, "_orientedCopyTask", None) is not None:
+            self._orientedCopyTask.cancel()
+        self._orientedCopyTask = None
+        self._orientedCopies = {}
+        self._orientedCopyBytes = 0
+        self.updateLayoutItem()
+
+    def layoutDescription(self):
+        """
+        Describe how the slices of each view are read, for the "Layout" column of the stack list
+        """
+        if isinstance(self._data, LazyStack):
+            return "lazy"
+        if isinstance(self._data, np.memmap):
+            return "memory-mapped"
+        if self._orientedCopies:
+            strided = [axis for axis in (1, 2) if axis not in self._orientedCopies]
+            if not strided:
+                return "contiguous"
+            return "contiguous, view {} strided".format(strided[0] + 1)
+        if self._orientedCopyTask is not None:
+            return "strided (copying)"
+        return "strided"
+
+    def updateLayoutItem(self):
+        if hasattr(self, "layoutItem"):
+            self.layoutItem.setText(self.layoutDescription())
+
+    def pyramidPlane(self, axisToPlot, sliceToPlot, pyramidFactor=1, region=None):
+        """
+        Returns slice sliceToPlot along axisToPlot from the level of the image pyramid that is
+        downsampled pyramidFactor times in-plane (pyramidFactor is 1, 2, 4, 8...).
+        Coarse levels are block means, or maxima [see pyramidReduce], of the full resolution
+        plane. They are made on first use and kept, as far as the "pyramidCacheMB" preference
+        allows, so redrawing a slice or zooming back to a level does not make them again.
+        region optionally crops the slice to the part in view [see clipRegion].
+        """
+        return pyramid_plane(self.data(axisToPlot), sliceToPlot, pyramidFactor, region,
+                             *self.pyramidLevels(axisToPlot, sliceToPlot, region))
+
+    def pyramidLevels(self, axisToPlot, sliceToPlot, region=None):
+        """
+        Return the (reduce, levels, key) arguments of pyramid_plane for a slice of this stack
+        """
+        key = (self.dataVersion, axisToPlot, sliceToPlot, region, self.pyramidReduce)
+        return self.pyramidReduce, self._pyramidLevels, key
+
+    def clipRegion(self, axisToPlot, region):
+        """
+        Clip region ((x0, x1), (y0, y1)), the part of the plane in view plus a margin [see
+        lasagna_axis.visibleRegion], to the planes of this stack along axisToPlot.
+        Returns None if the region covers the whole plane, so the whole plane is drawn.
+        """
+        if region is None:
+            return None
+        rows, cols = self.data(axisToPlot).shape[1:]
+        (x0, x1), (y0, y1) = region
+        clipped = ((min(x0, rows), min(x1, rows)), (min(y0, cols), min(y1, cols)))
+        if clipped == ((0, rows), (0, cols)):
+            return None
+        return clipped
+
+    def plotIngredient(self, pyqtObject, axisToPlot=0, sliceToPlot=0, pyramidFactor=1, region=None):
         """
         Plots the ingredient onto pyqtObject along axisAxisToPlot,
-        onto the object with which it is associated
+        onto the object with which it is associated.
+        pyramidFactor is the in-plane downsampling of the displayed image. The image item
+        is scaled up by the same factor so it stays in full resolution data coordinates.
+        If region is given only that part of the plane is drawn, and the image item is offset
+        to its position. The cost of drawing then follows the size of the view, not of the plane.
         """
 
         data = self.data(axisToPlot)
+        region = self.clipRegion(axisToPlot, region)
 
         if data.shape[0] - 1 < sliceToPlot:
             pyqtObject.setVisible(False)
@@ -170,57 +515,183 @@ class imagestack(lasagna_ingredient):
         elif sliceToPlot < 0:
             pyqtObject.setVisible(False)
             sliceToPlot = 0
+        elif not self.enable:
+            pyqtObject.setVisible(False)
+            return
+        elif region is not None and (region[0][0] >= region[0][1] or region[1][0] >= region[1][1]):
+            pyqtObject.setVisible(False)  # The view is beyond the edge of this stack
+            return
         else:
             pyqtObject.setVisible(True)
 
-        pyqtObject.setImage(
-            data[sliceToPlot],
-            levels=self.minMax,
-            compositionMode=self.compositionMode,
-            lut=self.setColorMap(self.lut),
-        )
+        renderer = getattr(self.parent, "sliceRenderer", None)
+        if renderer is not None:
+            self.renderInBackground(renderer, pyqtObject, axisToPlot, sliceToPlot, pyramidFactor, region)
+        else:
+            self.renderNow(pyqtObject, axisToPlot, sliceToPlot, pyramidFactor, region)
 
-    def defaultHistRange(self, logY=False, verbose=False):
+    def sliceKey(self, axisToPlot, sliceToPlot, pyramidFactor, region=None):
         """
-        Returns a reasonable values for the maximum plotted value.
-        logY if True we log the Y values
+        Return a key identifying a slice as displayed: the (image, levels, lookup table) on show
         """
+        image_key = (self.dataVersion, axisToPlot, sliceToPlot, pyramidFactor, region, self.pyramidReduce)
+        lut_key = (self.lut if isinstance(self.lut, str) else id(self.lut), self.alpha)
+        return image_key, tuple(self.minMax), lut_key
 
-        if verbose:
-            print("Determining default histogram range")
-
-        nValsForCalc = 1E6 #Number of values on which to base histogram calculation
-        sampleEverynSamples = self.data().size
-        if self.data().size > nValsForCalc:
-            sampleEverynSamples = int(self.data().size/nValsForCalc)
-            if verbose:
-                print("Histogram based on one value every %d" % sampleEverynSamples)
-        else:
-            sampleEverynSamples=1
-
-
-        y, x = np.histogram(self.data()[::sampleEverynSamples], bins=100)
-        y = np.append(y, 0)
-
-        # Remove negative numbers from the calculation. Sometimes these happen with registered images
-        y = y[x > 0]
-        x = x[x > 0]
-
-        if logY:
-            y = np.log10(y + 0.1)
-
-        # I'm sure this isn't the most robust approach but it works for now
-        thresh = 0.925  # find values greater than this proportion
-
-        m = x * y
-        vals = np.cumsum(m) / np.sum(m)
+    def sliceJob(self, axisToPlot, sliceToPlot, pyramidFactor, colour=True, region=None):
+        """
+        Return a function that prepares a slice for display without touching the GUI, so it can be
+        run on a worker thread. The function returns (plane, image): the plane of intensities and,
+        if colour is True, the plane scaled to the levels and coloured as an RGBA image (else None).
+        Cropped slices are coloured tile by tile, re-using tiles in Lasagna's tile cache.
+        """
+        data = self.data(axisToPlot)
+        levels = tuple(self.minMax)
+        lut = self.setColorMap(self.lut) if colour else None
+        tile_cache = getattr(self.parent, "tileCache", None)
+        tile_size = getattr(self.parent, "renderTileSize", 512)
+        # Tiles depend on everything about the slice except the region in view
+        tile_key = (self.objectName,) + self.sliceKey(axisToPlot, sliceToPlot, pyramidFactor)
+        pyramid = self.pyramidLevels(axisToPlot, sliceToPlot, region)
+
+        def job():
+            plane = pyramid_plane(data, sliceToPlot, pyramidFactor, region, *pyramid)
+            if lut is None:
+                return plane, None
+            if region is None or tile_cache is None:
+                return plane, render_slice(plane, levels, lut)
+            offset = (region[0][0] // pyramidFactor, region[1][0] // pyramidFactor)
+            return plane, render_tiled(plane, offset, tile_size, levels, lut, tile_cache, tile_key)
+
+        return job
+
+    def prefetchJob(self, axisToPlot, sliceToPlot, pyramidFactor, colour=True, region=None):
+        """
+        Return the (key, job) that the slice prefetcher uses to prepare a slice before it is shown,
+        or None if the slice does not exist or there is nothing to gain [see slice_prefetcher].
+        In-memory stacks are sliced instantly, so they are only worth prefetching if colouring is
+        done in the background too.
+        """
+        if not colour and not isinstance(self._data, LazyStack):
+            return None
+        if not 0 <= sliceToPlot < self.data(axisToPlot).shape[0]:
+            return None
+        region = self.clipRegion(axisToPlot, region)
+        if region is not None and (region[0][0] >= region[0][1] or region[1][0] >= region[1][1]):
+            return None
+        key = (self.objectName, self.sliceKey(axisToPlot, sliceToPlot, pyramidFactor, region))
+        return key, self.sliceJob(axisToPlot, sliceToPlot, pyramidFactor, colour, region)
+
+    def prefetched(self, key, previous=None):
+        """
+        Return the result of the slice job with key if the prefetcher has it, otherwise None.
+        previous is the image key of the slice the item showed before. The lookup only counts towards
+        the prefetch statistics if the user moved to another slice, not if the same slice is
+        redrawn with new levels, colours, zoom or region.
+        """
+        prefetcher = getattr(self.parent, "slicePrefetcher", None)
+        if prefetcher is None:
+            return None
+        return prefetcher.lookup((self.objectName, key), count=moved_to_another_slice(previous, key[0]))
 
-        vals = vals > thresh
+    def renderNow(self, pyqtObject, axisToPlot, sliceToPlot, pyramidFactor, region=None):
+        """
+        Let the ImageItem scale and colour the slice on the GUI thread.
+        Push to it only what differs from what it already shows. When scrolling through
+        slices only the image changes, so the levels and lookup table are left alone.
+        """
+        wanted = self.sliceKey(axisToPlot, sliceToPlot, pyramidFactor, region)
+        image_key, levels, lut_key = wanted
+        state = self._renderState.get(pyqtObject)
+        image_changed = state is None or state["image"] != image_key
+
+        plane = None
+        if image_changed:
+            # Only lazily loaded stacks are prefetched when slices are coloured here [see prefetchJob]
+            if isinstance(self._data, LazyStack):
+                prefetched = self.prefetched(wanted, None if state is None else state["image"])
+            else:
+                prefetched = None
+            if prefetched is not None:
+                plane = prefetched[0]
+            else:
+                plane = self.pyramidPlane(axisToPlot, sliceToPlot, pyramidFactor, region)
+
+        if state is None:
+            pyqtObject.setImage(
+                plane,
+                levels=levels,
+                compositionMode=self.compositionMode,
+                lut=self.setColorMap(self.lut),
+            )
+        else:
+            # A new image is rendered with the current lookup table and levels anyway
+            if state["lut"] != lut_key:
+                pyqtObject.setLookupTable(self.setColorMap(self.lut), update=not image_changed)
+            if state["levels"] != levels:
+                pyqtObject.setLevels(levels, update=not image_changed)
+            if state["compositionMode"] != self.compositionMode:
+                pyqtObject.setCompositionMode(self.compositionMode)
+            if image_changed:
+                pyqtObject.setImage(plane, autoLevels=False)
+        if image_changed:
+            pyqtObject.dataPlane = plane  # Replaces one left by the compositor or a background render
+
+        transform = item_transform(pyramidFactor, region)
+        if pyqtObject.transform() != transform:
+            pyqtObject.setTransform(transform)
+
+        self._renderState[pyqtObject] = dict(
+            image=image_key, levels=levels, lut=lut_key, compositionMode=self.compositionMode
+        )
 
-        if verbose:
-            print("Done")
+    def renderInBackground(self, renderer, pyqtObject, axisToPlot, sliceToPlot, pyramidFactor, region=None):
+        """
+        Extract, scale and colour the slice on one of the renderer's worker threads and show it
+        once it is ready [see slice_renderer]. The ImageItem is given a finished RGBA image, so it
+        has no levels or lookup table of its own. If another slice is requested for the same item
+        before this one is ready, this one is dropped. Slices already prepared by the prefetcher
+        are shown straight away.
+        """
+        state = self._renderState.setdefault(pyqtObject, {})
+        if state.get("compositionMode") != self.compositionMode:
+            pyqtObject.setCompositionMode(self.compositionMode)
+            state["compositionMode"] = self.compositionMode
+
+        # Nothing to do if the item shows, or will soon show, this slice
+        wanted = self.sliceKey(axisToPlot, sliceToPlot, pyramidFactor, region)
+        if renderer.isPending(pyqtObject):
+            if state.get("requested") == wanted:
+                return
+        elif state.get("rendered") == wanted:
+            return
+        previous = state.get("requested")
+        previous = None if previous is None else previous[0]
+        state["requested"] = wanted
+
+        def show(result):
+            plane, image = result
+            pyqtObject.setImage(image, autoLevels=False, levels=None, lut=None)
+            # The image is placed when it arrives, so the old one is not shown at the new position
+            transform = item_transform(pyramidFactor, region)
+            if pyqtObject.transform() != transform:
+                pyqtObject.setTransform(transform)
+            pyqtObject.dataPlane = plane  # The intensities, for plugins that read the displayed slice
+            state["rendered"] = wanted
+
+        prefetched = self.prefetched(wanted, previous)
+        if prefetched is not None:
+            renderer.cancel(pyqtObject)  # An older slice still being rendered must not replace this one
+            show(prefetched)
+        else:
+            renderer.submit(pyqtObject, self.sliceJob(axisToPlot, sliceToPlot, pyramidFactor, region=region), show)
 
-        return x[vals.tolist().index(True)]
+    def defaultHistRange(self, logY=False, verbose=False):
+        """
+        Returns a reasonable values for the maximum plotted value.
+        logY if True we log the Y values
+        """
+        return default_hist_range(self.data(), logY=logY, verbose=verbose)
 
     def changeData(self, imageData, imageAbsPath, recalculateDefaultHistRange=False):
         """
@@ -228,11 +699,12 @@ class imagestack(lasagna_ingredient):
         Must also supply imageAbsPath.
         """
 
-        if not isinstance(imageData, np.ndarray):
+        if not isinstance(imageData, (np.ndarray, LazyStack)):
             return False
 
         self._data = imageData
         self.fnameAbsPath = imageAbsPath
+        self.buildOrientedCopies()
 
         if recalculateDefaultHistRange:
             self.defaultHistRange()
@@ -247,7 +719,9 @@ class imagestack(lasagna_ingredient):
             print("imagestack.flipDataAlongAxis - axisToFlip must be an integer")
             return
 
-        if axisToFlip == 0:
+        if isinstance(self._data, LazyStack) and axisToFlip in range(3):
+            self._data = self._data.flip(axisToFlip)  # Flipped view. Nothing is read from disk.
+        elif axisToFlip == 0:
             self._data = self._data[::-1, :, :]
         elif axisToFlip == 1:
             self._data = self._data[:, ::-1, :]
@@ -255,6 +729,8 @@ class imagestack(lasagna_ingredient):
             self._data = self._data[:, :, ::-1]
         else:
             print(("Can not flip axis %d" % axisToFlip))
+            return
+        self.buildOrientedCopies()
 
     def rotateAlongDimension(self, axisToRotate):
         """
@@ -270,8 +746,13 @@ class imagestack(lasagna_ingredient):
             return
 
         self._data = np.swapaxes(self._data, 2, axisToRotate)
-        self._data = np.rot90(self._data)
+        if isinstance(self._data, LazyStack):
+            # np.rot90 would read the whole stack. This is the same rotation done with views.
+            self._data = self._data.flip(1).swapaxes(0, 1)
+        else:
+            self._data = np.rot90(self._data)
         self._data = np.swapaxes(self._data, 2, axisToRotate)
+        self.buildOrientedCopies()
 
     def swapAxes(self, ax1, ax2):
         """
@@ -282,22 +763,37 @@ class imagestack(lasagna_ingredient):
             return
 
         self._data = np.swapaxes(self._data, ax1, ax2)
+        self.buildOrientedCopies()
 
     def removeFromList(self):
         super(imagestack, self).removeFromList()
+        self.dropOrientedCopies()
+        self._pyramidLevels.clear()
+        if isinstance(self._data, LazyStack):
+            self._data.close()  # Lazily loaded stacks hold open files and decoding threads
         if len(self.parent.ingredientList) == 1:
             self.parent.ingredientList[0].lut = "gray"
             self.parent.initialiseAxes()
 
     def save(self, path=None):
+        """
+        Save the stack. The format is chosen from the file extension (see save_stack).
+        The stack is written on a worker thread, with progress shown in the status bar.
+        Returns the BackgroundTask doing the writing.
+        """
         if path is None:
             path = QtGui.QFileDialog.getSaveFileName(
-                self.parent, "File to save {}".format(self.objectName)
-            )
+                self.parent, "File to save {}".format(self.objectName), "", save_filter()
+            )[0]  # getSaveFileName returns a tuple of (file name, filter). Ignore the filter
         if not path:
             return
-        save_stack(path, self.raw_data())
-        print(("%s saved as %s" % (self.objectName, path)))
+        task = BackgroundTask(
+            save_stack, str(path), self.raw_data(), description="Saving " + self.objectName
+        )
+        task.succeeded.connect(
+            lambda result: print(("%s saved as %s" % (self.objectName, path)))
+        )
+        return self.parent.runInBackground(task)
 
     # ---------------------------------------------------------------
     # Getters and setters
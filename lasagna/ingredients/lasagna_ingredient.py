@@ -96,13 +96,20 @@ class lasagna_ingredient(object):
         self.modelItems = itemName  # Run this instead
         #self.modelItems=(itemName,itemCheckBox) # FIXME: Remove this for now because I have NO CLUE how to get access to the checkbox state
 
+    def listItems(self):
+        """
+        Return the items making up this ingredient's row in the list. The first is the name
+        (self.modelItems). Ingredients that show more columns add their items after it.
+        """
+        return [self.modelItems]
+
     def addToList(self):
         """
         Add this ingredient's list items to the QStandardModel (model) associated with its QTreeView
         then highlight it when it's added.
         """
         self.setRowColor()
-        self.model.appendRow(self.modelItems)
+        self.model.appendRow(self.listItems())
         self.model.parent().setCurrentIndex(
             self.modelItems.index()
         )  # Parent is, for example, a QTreeView
@@ -2,7 +2,10 @@
 This class overlays points on top of the image stacks. 
 """
 
+import weakref
+
 import numpy as np
+import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore
 from matplotlib import cm
 from numpy import linspace
@@ -11,9 +14,36 @@ from lasagna.ingredients.lasagna_ingredient import lasagna_ingredient
 from lasagna.utils import preferences
 
 
+def density_image(points, extent, bin_size, color, alpha):
+    """
+    Count the points (an n by 2 array of x, y) in square bins of side bin_size covering
+    extent, ((x0, x1), (y0, y1)), and return an RGBA uint8 image with one pixel per bin
+    (axis 0 is x). Bins are coloured color, with an opacity that rises with the log of
+    the count up to alpha. Empty bins are transparent.
+    """
+    (x0, x1), (y0, y1) = extent
+    nx = max(1, int(np.ceil((x1 - x0) / bin_size)))
+    ny = max(1, int(np.ceil((y1 - y0) / bin_size)))
+    ix = np.floor((points[:, 0] - x0) / bin_size).astype(np.intp)
+    iy = np.floor((points[:, 1] - y0) / bin_size).astype(np.intp)
+    keep = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    counts = np.bincount(ix[keep] * ny + iy[keep], minlength=nx * ny).reshape(nx, ny)
+
+    image = np.zeros((nx, ny, 4), dtype=np.ubyte)
+    image[..., :3] = np.asarray(color[:3], dtype=float).astype(np.ubyte)
+    if counts.any():
+        opacity = np.log1p(counts) / np.log1p(counts.max())
+        image[..., 3] = (opacity * alpha).astype(np.ubyte)
+    return image
+
+
+# Attributes with more distinct integer values than this are treated as scalars, not categories
+MAX_CATEGORIES = 256
+
+
 class sparsepoints(lasagna_ingredient):
     def __init__(
-        self, parent=None, data=None, fnameAbsPath="", enable=True, objectName=""
+        self, parent=None, data=None, fnameAbsPath="", enable=True, objectName="", attribute=None
     ):
         super(sparsepoints, self).__init__(
             parent, data, fnameAbsPath, enable, objectName, pgObject="ScatterPlotItem"
@@ -40,6 +70,107 @@ class sparsepoints(lasagna_ingredient):
         color = colors[this_number]
         self.color = [color[0] * 255, color[1] * 255, color[2] * 255]
 
+        # Above this many points in view a slab is drawn as a density map, binned at the
+        # resolution of the view, rather than as individual markers [see plotDensity]
+        self.densityMapPoints = preferences.readPreference("densityMapPoints")
+        self.densityMapBinPixels = max(1, preferences.readPreference("densityMapBinPixels"))
+        self._densityItems = weakref.WeakKeyDictionary()  # ScatterPlotItem -> ImageItem of the density map
+        self._viewState = weakref.WeakKeyDictionary()  # ScatterPlotItem -> the view it was drawn for
+
+        self.setAttribute(attribute)
+
+    # The data are held in a property so that any change to them, including plugins assigning
+    # to _data directly, drops the slab indexes built from them [see slabIndex]
+    @property
+    def _data(self):
+        return self._pointData
+
+    @_data.setter
+    def _data(self, data):
+        self._pointData = data
+        self._slabIndex = {}
+        # Plugins may replace the points. Values for a different number of points no longer apply
+        attribute = getattr(self, "attribute", None)
+        if attribute is not None and (data is None or len(data) != len(attribute)):
+            self.setAttribute(None)
+
+    def slabIndex(self, axisToPlot):
+        """
+        Return the coordinates of the points along axisToPlot, rounded and in ascending order,
+        their in-plane coordinates [see data()] in the same order, and the order itself (the
+        index of each point in _data). This is built once per axis, so the points near a slice
+        are found by searchsorted instead of by testing every point.
+        """
+        index = self._slabIndex.get(axisToPlot)
+        if index is None:
+            z = np.round(np.asarray(self._data, dtype=float)[:, axisToPlot])
+            order = np.argsort(z, kind="stable")
+            index = (z[order], self.data(axisToPlot)[order], order)
+            self._slabIndex[axisToPlot] = index
+        return index
+
+    def setAttribute(self, attribute):
+        """
+        Give each point a value, such as the cell type found by a classifier (a category) or a
+        measured intensity (a scalar). Points are then coloured by value with the jet colormap,
+        and the points of a category can be hidden [see setCategoryVisible]. Strings and
+        integers are categories unless there are more than MAX_CATEGORIES of them. Other
+        numbers are scalars. None removes the attribute.
+        """
+        self.attribute = None
+        self.categories = None  # The distinct values of a categorical attribute, in ascending order
+        self.categoryVisible = None  # True for each category that is shown
+        self._colorIndex = None  # The row of _colorTable that colours each point
+        self._colorTable = None
+        if attribute is None:
+            return
+
+        attribute = np.asarray(attribute)
+        if self._data is None or len(attribute) != len(self._data):
+            print("sparsepoints.setAttribute needs one value per point. Ignoring the attribute")
+            return
+        self.attribute = attribute
+
+        if attribute.dtype.kind == "f" and np.all(attribute == np.round(attribute)):
+            attribute = attribute.astype(np.int64)  # Integer values read from text files
+        categories, index = None, None
+        if attribute.dtype.kind not in "fc":
+            categories, index = np.unique(attribute, return_inverse=True)  # Groups the points in one pass
+            if attribute.dtype.kind in "iu" and len(categories) > MAX_CATEGORIES:
+                categories = None
+
+        if categories is None:
+            attribute = attribute.astype(float)
+            low, high = np.nanmin(attribute), np.nanmax(attribute)
+            scaled = (attribute - low) / (high - low) if high > low else np.zeros(len(attribute))
+            n_colors = 256
+            self._colorIndex = (np.nan_to_num(scaled) * (n_colors - 1)).astype(np.intp)
+        else:
+            n_colors = len(categories)
+            self.categories = categories
+            self.categoryVisible = np.ones(n_colors, dtype=bool)
+            self._colorIndex = index.reshape(-1)
+        self._colorTable = cm.jet(linspace(0, 1, n_colors))[:, :3] * 255
+
+    def setCategoryVisible(self, category, visible=True):
+        """
+        Show or hide the points whose attribute is category. Returns False if there is no such category.
+        """
+        if self.categories is None:
+            return False
+        position = np.searchsorted(self.categories, category)
+        if position >= len(self.categories) or self.categories[position] != category:
+            return False
+        self.categoryVisible[position] = visible
+        return True
+
+    def categoryColor(self, category):
+        """
+        Return the colour of the points of a category as an RGB list
+        """
+        position = np.searchsorted(self.categories, category)
+        return self._colorTable[position].tolist()
+
     def data(self, axisToPlot=0):
         """
         Sparse point data are an n by 3 array where each row defines the location
@@ -55,54 +186,149 @@ class sparsepoints(lasagna_ingredient):
 
         return data
 
-    def plotIngredient(self, pyqtObject, axisToPlot=0, sliceToPlot=0):
+    def plotIngredient(self, pyqtObject, axisToPlot=0, sliceToPlot=0, maxPoints=None):
         """
         Plots the ingredient onto pyqtObject along axisAxisToPlot,
-        onto the object with which it is associated
+        onto the object with which it is associated.
+        If maxPoints is given, at most about that many points are drawn, evenly thinned out.
+        This is used to keep dense layers responsive while the user interacts with the axes.
         """
         if not pyqtObject:
             return
 
-        # check if there is data. Use `is False` because np.array == False returns an array
-        if self.data() is False or len(self.data()) == 0:
+        # check if there is data
+        if self._data is None or len(self._data) == 0:
             pyqtObject.setData([], [])  # make sure there is no left data on plot
+            self.hideDensity(pyqtObject)
             return
 
-        z = np.round(self._data[:, axisToPlot])
-
-        data = self.data(axisToPlot)
-
         # Find points within this z-plane +/- a certain region
         z_range = self.parent.viewZ_spinBoxes[axisToPlot].value() - 1
         from_layer = sliceToPlot - z_range
         to_layer = sliceToPlot + z_range
-        data = data[(z >= from_layer) * (z <= to_layer), :]
-        z = z[(z >= from_layer) * (z <= to_layer)]
+        z, data, order = self.slabIndex(axisToPlot)
+        start = np.searchsorted(z, from_layer, side="left")
+        stop = np.searchsorted(z, to_layer, side="right")
+        z = z[start:stop]
+        data = data[start:stop]
+        order = order[start:stop]
+
+        # Leave out hidden categories
+        if self.categoryVisible is not None and not self.categoryVisible.all():
+            shown = self.categoryVisible[self._colorIndex[order]]
+            z, data, order = z[shown], data[shown], order[shown]
+
+        # Draw slabs with too many points in view as a density map
+        self._viewState.pop(pyqtObject, None)
+        view = self.viewOf(pyqtObject) if self.densityMapPoints else None
+        if view is not None and len(data) > self.densityMapPoints:
+            (x0, x1), (y0, y1), pixel_size = view
+            in_view = (data[:, 0] >= x0) & (data[:, 0] <= x1) & (data[:, 1] >= y0) & (data[:, 1] <= y1)
+            if np.count_nonzero(in_view) > self.densityMapPoints:
+                self.plotDensity(pyqtObject, data, view)
+                return
+            # Zooming out could bring in too many points [see needsRedrawForView]
+            self._viewState[pyqtObject] = dict(extent=((x0, x1), (y0, y1)), binSize=None)
+        self.hideDensity(pyqtObject)
+
+        if maxPoints and len(data) > maxPoints:
+            every_nth = int(np.ceil(len(data) / float(maxPoints)))
+            data = data[::every_nth]
+            z = z[::every_nth]
+            order = order[::every_nth]
 
         # Add points, making points further from the current
         # layer less prominent
         # TODO: make this settable by the user via the YAML or UI elements
-        data_to_add = []
-        for i in range(len(data)):
-            # Get size for out-of layer points
-            size = self.symbolSize - abs(z[i] - sliceToPlot) * 2
-            if size < 1:
-                size = 1
-            # Get opacity for out-of layer points
-            alpha = self.alpha - abs(z[i] - sliceToPlot) * 20
-            if alpha < 10:
-                alpha = 10
-
-            data_to_add.append(
-                {
-                    "pos": (data[i, 0], data[i, 1]),
-                    "symbol": self.symbol,
-                    "brush": self.symbolBrush(alpha=alpha),
-                    "size": size,
-                }
-            )
+        distance, which = np.unique(np.abs(z - sliceToPlot), return_inverse=True)
+        sizes = np.maximum(self.symbolSize - distance * 2, 1)  # Size for out-of layer points
+        alphas = np.maximum(self.alpha - distance * 20, 10)  # Opacity for out-of layer points
+
+        # Points with an attribute are coloured by it, the others all get the ingredient's colour
+        if self._colorIndex is None:
+            color_index = np.zeros(len(order), dtype=np.intp)
+            color_table = np.asarray([self.color[:3]], dtype=float)
+        else:
+            color_index = self._colorIndex[order]
+            color_table = self._colorTable
+
+        # One brush per colour and distance from the slice is shared by all points that have both
+        styles, which = np.unique(color_index * len(distance) + which.reshape(-1), return_inverse=True)
+        colors = color_table[styles // len(distance)]
+        distance_index = styles % len(distance)
+        brushes = np.empty(len(styles), dtype=object)
+        brushes[:] = [pg.mkBrush(*(list(color) + [alpha])) for color, alpha in zip(colors, alphas[distance_index])]
+
+        pyqtObject.setData(
+            x=data[:, 0],
+            y=data[:, 1],
+            symbol=self.symbol,
+            size=sizes[distance_index][which],
+            brush=brushes[which],
+        )
 
-        pyqtObject.setData(data_to_add)
+    def viewOf(self, pyqtObject):
+        """
+        Return the x and y ranges shown by the view of pyqtObject and the size of a screen pixel
+        in data units, or None if the item is not in a view that has been laid out
+        """
+        view_box = pyqtObject.getViewBox()
+        if view_box is None or view_box.width() <= 0 or view_box.height() <= 0:
+            return None
+        x_range, y_range = view_box.viewRange()
+        return x_range, y_range, max(view_box.viewPixelSize())
+
+    def plotDensity(self, pyqtObject, data, view):
+        """
+        Replace the markers of pyqtObject by a density map of the points data (x, y) for the view
+        [see viewOf]. The map covers the view plus half its size on each side, so small pans are
+        drawn without binning again, and it has one bin per densityMapBinPixels screen pixels.
+        """
+        (x0, x1), (y0, y1), pixel_size = view
+        width, height = x1 - x0, y1 - y0
+        extent = ((x0 - width / 2, x1 + width / 2), (y0 - height / 2, y1 + height / 2))
+        bin_size = pixel_size * self.densityMapBinPixels
+
+        density = self._densityItems.get(pyqtObject)
+        if density is None:
+            # A child of the scatter plot item, so it is shown, hidden and removed along with it
+            density = pg.ImageItem()
+            density.setParentItem(pyqtObject)
+            self._densityItems[pyqtObject] = density
+
+        pyqtObject.setData([], [])
+        density.setImage(density_image(data, extent, bin_size, self.color, self.alpha),
+                         autoLevels=False, levels=None, lut=None)
+        density.setTransform(QtGui.QTransform(bin_size, 0, 0, bin_size, extent[0][0], extent[1][0]))
+        density.setVisible(True)
+        self._viewState[pyqtObject] = dict(extent=extent, binSize=bin_size)
+
+    def hideDensity(self, pyqtObject):
+        density = self._densityItems.get(pyqtObject)
+        if density is not None and density.isVisible():
+            density.setVisible(False)
+
+    def needsRedrawForView(self, pyqtObject):
+        """
+        Return True if pyqtObject has to be drawn again because its view changed: it shows a density
+        map and the view left the binned extent or was zoomed by more than a factor of two, or it
+        shows markers because few points were in view and the view now takes in more of the plane.
+        """
+        state = self._viewState.get(pyqtObject)
+        if state is None:
+            return False
+        view = self.viewOf(pyqtObject)
+        if view is None:
+            return False
+
+        (x0, x1), (y0, y1), pixel_size = view
+        (ex0, ex1), (ey0, ey1) = state["extent"]
+        if not (ex0 <= x0 and x1 <= ex1 and ey0 <= y0 and y1 <= ey1):
+            return True
+        if state["binSize"] is None:
+            return False
+        zoom = pixel_size * self.densityMapBinPixels / state["binSize"]
+        return zoom < 0.5 or zoom > 2
 
     def addToList(self):
         """
@@ -138,8 +364,12 @@ class sparsepoints(lasagna_ingredient):
         if not path:
             return
         with open(path, "w") as F:
-            for c in self.raw_data():
-                F.write(",".join(["%s" % i for i in c]) + "\n")
+            if self.attribute is None:
+                for c in self.raw_data():
+                    F.write(",".join(["%s" % i for i in c]) + "\n")
+            else:  # The attribute is written as a fourth column
+                for c, value in zip(self.raw_data(), self.attribute):
+                    F.write(",".join(["%s" % i for i in c] + ["%s" % value]) + "\n")
         print("%s saved as %s" % (fname, path))
 
     # ---------------------------------------------------------------
@@ -0,0 +1,88 @@
+"""
+Tests of the numpy parts of the imagestack ingredient: the image pyramid, the slice keys and
+the oriented copies. The module needs pyqtgraph, PyQt5 and matplotlib [see lasagna/conftest.py],
+but no Lasagna window: stacks are made without running the constructor. Run with:
+    python -m pytest lasagna/ingredients
+"""
+
+import numpy as np
+import pytest
+
+from lasagna.ingredients.imagestack import block_reduce, imagestack, moved_to_another_slice, pyramid_plane
+from lasagna.io_libs.lazy_stack import PlaneCache
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 4000, (3, 37, 21)).astype(np.uint16)
+
+
+@pytest.mark.parametrize("factor", [2, 3, 4])
+def test_block_reduce_has_the_shape_of_decimation(data, factor):
+    assert block_reduce(data[0], factor).shape == data[0][::factor, ::factor].shape
+
+
+def test_block_mean():
+    plane = np.array([[0, 2, 5, 5], [4, 6, 5, 6]], dtype=np.uint8)
+    np.testing.assert_array_equal(block_reduce(plane, 2), [[3, 5]])  # 5.25 is rounded
+    assert block_reduce(plane, 2).dtype == np.uint8
+    np.testing.assert_array_equal(block_reduce(plane.astype(float), 2), [[3, 5.25]])
+
+
+def test_block_max_keeps_labels():
+    labels = np.array([[0, 0, 7, 7], [0, 12, 7, 7], [3, 3, 0, 0]], dtype=np.int32)
+    reduced = block_reduce(labels, 2, reduce="max")
+    np.testing.assert_array_equal(reduced, [[12, 7], [3, 0]])  # The last row is padded with itself
+    assert set(np.unique(reduced)) <= set(np.unique(labels))
+
+
+def test_thin_lines_are_not_lost():
+    plane = np.zeros((16, 16), dtype=np.uint16)
+    plane[:, 5] = 1000  # A line that decimation by 4 would skip
+    assert not plane[::4, ::4].any()
+    np.testing.assert_array_equal(block_reduce(plane, 4)[:, 1], 250)
+
+
+def test_pyramid_levels_are_block_means(data):
+    plane = data[1, :32, :16].astype(float)
+    expected = plane.reshape(8, 4, 4, 4).mean(axis=(1, 3))
+    level = pyramid_plane(data[:, :32, :16].astype(float), 1, 4)
+    np.testing.assert_allclose(level, expected)
+
+
+def test_pyramid_plane_crops_region(data):
+    region = ((4, 20), (2, 15))
+    level = pyramid_plane(data, 2, 2, region)
+    np.testing.assert_array_equal(level, block_reduce(data[2, 4:20, 2:15], 2))
+    np.testing.assert_array_equal(pyramid_plane(data, 2, 1, region), data[2, 4:20, 2:15])
+
+
+def test_pyramid_levels_are_cached(data):
+    levels = PlaneCache()
+    first = pyramid_plane(data, 0, 8, levels=levels, key="slice 0")
+    assert levels.misses == 3  # Levels 8, 4 and 2 were made
+    assert pyramid_plane(data, 0, 8, levels=levels, key="slice 0") is first
+    pyramid_plane(data, 0, 4, levels=levels, key="slice 0")
+    assert levels.misses == 3
+
+
+def test_moved_to_another_slice():
+    # Image keys are (data version, axis, slice, pyramid factor, region, reduce)
+    shown = (1, 0, 10, 1, None, "mean")
+    assert moved_to_another_slice(None, shown)
+    assert moved_to_another_slice(shown, (1, 0, 11, 1, None, "mean"))
+    assert moved_to_another_slice(shown, (1, 1, 10, 1, None, "mean"))
+    assert not moved_to_another_slice(shown, (1, 0, 10, 4, ((0, 8), (0, 8)), "mean"))
+
+
+def test_memory_mapped_stacks_are_not_copied(tmp_path, data):
+    fname = str(tmp_path / "stack.npy")
+    np.save(fname, data)
+    stack = imagestack.__new__(imagestack)
+    stack.parent = None  # Copying would need Lasagna to run the task
+    stack._data = np.load(fname, mmap_mode="c")
+    stack.buildOrientedCopies()
+    assert stack._orientedCopyTask is None
+    assert stack.layoutDescription() == "memory-mapped"
+    np.testing.assert_array_equal(stack.data(2)[3], data[:, :, 3].T)
@@ -0,0 +1,129 @@
+"""
+Tests of the numpy parts of the sparsepoints ingredient. The module needs pyqtgraph, PyQt5 and
+matplotlib [see lasagna/conftest.py], but no Lasagna window: ingredients are made without
+running the constructor, which builds the GUI list entries. Run with:
+    python -m pytest lasagna/ingredients
+"""
+
+import numpy as np
+import pytest
+
+from lasagna.ingredients.sparsepoints import density_image, sparsepoints
+
+
+def make_points(data):
+    """
+    Return a sparsepoints ingredient holding data, without the GUI set up by the constructor
+    """
+    points = sparsepoints.__new__(sparsepoints)
+    points._data = data
+    points.setAttribute(None)
+    return points
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    return rng.uniform(0, 50, (500, 3))
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_slab_index_is_sorted_along_axis(data, axis):
+    z, in_plane, order = make_points(data).slabIndex(axis)
+    assert np.all(np.diff(z) >= 0)
+    np.testing.assert_array_equal(z, np.round(data[order, axis]))
+    np.testing.assert_array_equal(in_plane, make_points(data).data(axis)[order])
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_slab_index_finds_the_points_near_a_slice(data, axis):
+    z, in_plane, order = make_points(data).slabIndex(axis)
+    low = np.searchsorted(z, 20 - 2, side="left")
+    high = np.searchsorted(z, 20 + 2, side="right")
+    near = np.abs(np.round(data[:, axis]) - 20) <= 2
+    assert sorted(order[low:high]) == list(np.flatnonzero(near))
+
+
+def test_slab_index_is_rebuilt_when_data_change(data):
+    points = make_points(data)
+    first = points.slabIndex(0)
+    assert points.slabIndex(0) is first
+    points._data = data[:10]
+    assert len(points.slabIndex(0)[0]) == 10
+
+
+def test_data_drops_the_plotted_axis():
+    points = make_points(np.array([[1.0, 2.0, 3.0]]))
+    np.testing.assert_array_equal(points.data(0), [[2, 3]])
+    np.testing.assert_array_equal(points.data(1), [[1, 3]])
+    np.testing.assert_array_equal(points.data(2), [[2, 1]])
+
+
+def test_density_image_counts_points_per_bin():
+    points = np.array([[0.5, 0.5], [1.5, 0.5], [1.2, 0.1], [3.9, 5.9], [-1, 0], [4, 0]])
+    image = density_image(points, ((0, 4), (0, 6)), 2, (10, 20, 30), 200)
+    assert image.shape == (2, 3, 4)
+    assert image.dtype == np.ubyte
+    assert np.all(image[..., :3] == (10, 20, 30))
+
+    # Bin (0, 0) holds three points and bin (1, 2) one. Points outside the extent are dropped.
+    alpha = image[..., 3]
+    assert alpha[0, 0] == 200
+    assert alpha[1, 2] == int(200 * np.log1p(1) / np.log1p(3))
+    alpha[0, 0] = alpha[1, 2] = 0
+    assert not alpha.any()
+
+
+def test_density_image_of_no_points_is_transparent():
+    image = density_image(np.zeros((0, 2)), ((0, 10), (0, 10)), 3, (255, 0, 0), 255)
+    assert image.shape == (4, 4, 4)
+    assert not image[..., 3].any()
+
+
+def test_categorical_attribute(data):
+    points = make_points(data[:6])
+    points.setAttribute(["b", "a", "c", "a", "b", "a"])
+    assert list(points.categories) == ["a", "b", "c"]
+    np.testing.assert_array_equal(points._colorIndex, [1, 0, 2, 0, 1, 0])
+    assert points.categoryColor("a") != points.categoryColor("c")
+
+    assert points.setCategoryVisible("b", False)
+    assert not points.setCategoryVisible("d", False)
+    np.testing.assert_array_equal(points.categoryVisible, [True, False, True])
+
+
+def test_integer_values_read_as_floats_are_categories(data):
+    points = make_points(data[:4])
+    points.setAttribute(np.array([3.0, 1.0, 3.0, 2.0]))
+    np.testing.assert_array_equal(points.categories, [1, 2, 3])
+
+
+def test_scalar_attribute(data):
+    points = make_points(data[:3])
+    points.setAttribute([0.5, 1.5, 1.0])
+    assert points.categories is None
+    assert not points.setCategoryVisible(0.5, False)
+    np.testing.assert_array_equal(points._colorIndex, [0, 255, 127])
+
+
+def test_too_many_integer_values_are_a_scalar(data):
+    points = make_points(data)
+    points.setAttribute(np.arange(len(data)))
+    assert points.categories is None
+
+
+def test_attribute_needs_one_value_per_point(data):
+    points = make_points(data[:3])
+    points.setAttribute([1, 2])
+    assert points.attribute is None
+
+
+def test_attribute_is_dropped_when_the_number_of_points_changes(data):
+    points = make_points(data[:3])
+    points.setAttribute([1, 2, 1])
+    points._data = data[:3] + 1  # Moved points keep their values
+    assert points.categories is not None
+    points._data = data[:5]
+    assert points.attribute is None
+    assert points.categories is None
+    assert points._colorIndex is None
@@ -5,14 +5,17 @@ https://github.com/sainsburywellcomecentre/lasagna
 """
 
 
+import glob
 import imp  # to look for the presence of a module. Python 3 will require importlib
 import os
 import re
-import struct
+import sys
+import zlib
 
 import numpy as np
 
-from lasagna.utils import preferences, path_utils
+from lasagna.io_libs import volume_cache
+from lasagna.utils import preferences
 
 
 # -------------------------------------------------------------------------------------------
@@ -34,31 +37,442 @@ DATA_TYPES = {
     "uint": "I",
 }
 
+# Numpy dtypes for the MetaImage ElementType field. Sizes follow the MetaIO spec (MET_LONG is 4 bytes)
+MET_TYPES = {
+    "met_char": "i1",
+    "met_uchar": "u1",
+    "met_short": "i2",
+    "met_ushort": "u2",
+    "met_int": "i4",
+    "met_uint": "u4",
+    "met_long": "i4",
+    "met_ulong": "u4",
+    "met_long_long": "i8",
+    "met_ulong_long": "u8",
+    "met_float": "f4",
+    "met_double": "f8",
+}
+
 
-def load_stack(fname):
+def load_stack(fname, lazy=False, roi=None, step=1, block_mean=False, progress=None,
+               volume_cache_bytes=None, plane_cache_bytes=None):
     """
     load_stack determines the data type from the file extension determines what data are to be
     loaded and chooses the approproate function to return the data.
+    If lazy is True, formats that support it return a lazy stack (see lazy_stack.py) which decodes
+    planes on demand rather than reading the whole file.
+    fname may also be a directory or a glob pattern matching one image file per plane
+    (see load_slice_directory).
+    If roi or step are supplied only part of the stack is read (see read_subvolume).
+    Compressed stacks are memory-mapped from the volume cache (see volume_cache.py) if they are
+    in it. Otherwise they are added to the cache when they are read whole: a lazy request is
+    honoured so that large stacks are shown without decoding them first.
+    volume_cache_bytes is the size cap of the volume cache and plane_cache_bytes the memory for
+    decoded planes of a lazy stack. Workers must be given both [see volume_cache]. None reads the
+    preferences, which is only safe on the GUI thread.
     """
-    if fname.lower().endswith(".tif") or fname.lower().endswith(".tiff"):
-        return load_tiff_stack(fname)
+    if volume_cache_bytes is None:
+        volume_cache_bytes = volume_cache.max_cache_bytes()
+    if plane_cache_bytes is None:
+        plane_cache_bytes = lazy_stack_cache_bytes()
+
+    if roi is not None or np.any(np.asarray(step) != 1):
+        return read_subvolume(fname, roi=roi, step=step, block_mean=block_mean, progress=progress,
+                              volume_cache_bytes=volume_cache_bytes)
+
+    if is_slice_set(fname):
+        return load_slice_directory(fname, lazy=lazy, cache_bytes=plane_cache_bytes)
+
+    use_cache = volume_cache.is_enabled(volume_cache_bytes) and decode_is_cpu_bound(fname)
+    if use_cache:
+        data = volume_cache.load(fname, max_bytes=volume_cache_bytes)
+        if data is not None:
+            return data
+        info = probe_stack(fname)
+        n_bytes = int(np.prod(info["shape"])) * info["dtype"].itemsize
+        if n_bytes > volume_cache_bytes:
+            use_cache = False
+
+    if fname.lower().endswith((".tif", ".tiff", ".btf")):
+        data = load_tiff_stack(fname, lazy=lazy, cache_bytes=plane_cache_bytes)
     elif fname.lower().endswith(".mhd"):
-        return mhd_read(fname)
+        data = mhd_read(fname)
     elif fname.lower().endswith(".nrrd") or fname.lower().endswith(".nrd"):
-        return nrrd_read(fname)
+        data = nrrd_read(fname)
     else:
         print("\n\n*{} NOT LOADED. DATA TYPE NOT KNOWN\n\n".format(fname))
+        return None
+
+    if use_cache and isinstance(data, np.ndarray):  # Not lazy stacks, which have not been decoded
+        volume_cache.store(fname, data, max_bytes=volume_cache_bytes)
+    return data
+
+
+def lazy_stack_cache_bytes():
+    """
+    Return the memory for decoded planes of each lazy stack, from the "lazyStackCacheMB"
+    preference. Call this on the GUI thread [see load_stack].
+    """
+    return int(preferences.readPreference("lazyStackCacheMB") or 0) * 2 ** 20
+
 
+def decode_is_cpu_bound(fname):
+    """
+    Returns True if reading fname is dominated by decompression rather than by disk access.
+    Such files are best read in a separate process (see Lasagna.loadImageStacks) whereas
+    raw data are best read with threads or memory-mapped.
+    """
+    info = probe_stack(fname)
+    if info is None or info["format"] == "slices":
+        return False  # Slices are decoded one at a time by a thread pool
+    return info["compression"] is not None
+
+
+# Probes already made, keyed by (path, size, modification time) so that an edited file is probed again
+_PROBES = {}
+
+
+def probe_stack(fname):
+    """
+    Read only the header of the stack in fname and return a dictionary describing it:
+      format - "tiff", "lsm", "mhd" or "nrrd"
+      shape - size of the stack in Lasagna order, i.e. the shape load_stack would return
+      dtype - numpy data type of the voxels as stored in the file (including byte order)
+      byteorder - "<", ">" or "|" if the byte order does not matter
+      spacing - voxel size along the x, y and z axes of the file, or None if the file does not say
+      data_file - the file holding the voxel data
+      data_offset - byte offset of the first voxel in data_file, or None if the data are not
+                    stored as one contiguous block
+      stream_offset - byte offset in data_file at which the (possibly compressed) data start
+      compression - None for raw data, otherwise the name of the compression or encoding
+      file_shape - C-order shape of the voxel block on disk
+      axes - transpose that turns a file_shape array into Lasagna order
+    No voxel data are read, so this is fast even for very large files.
+    Returns None if the format is not known or the header can not be read.
+    """
+    if is_slice_set(fname):
+        return slice_set_probe(fname)  # Not stored, as the directory may gain files at any time
+
+    if not check_file_exists(fname, "probe_stack"):
+        return None
+
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key in _PROBES:
+        return dict(_PROBES[key])
+
+    lower_name = fname.lower()
+    try:
+        if lower_name.endswith((".tif", ".tiff", ".btf", ".lsm")):
+            info = tiff_probe(fname)
+        elif lower_name.endswith(".mhd"):
+            info = mhd_probe(fname)
+        elif lower_name.endswith(".nrrd") or lower_name.endswith(".nrd"):
+            info = nrrd_probe(fname)
+        else:
+            print("probe_stack does not know the data type of {}".format(fname))
+            info = None
+    except Exception as err:  # A damaged header should not stop Lasagna, just this file
+        print("Failed to read the header of {}: {}".format(fname, err))
+        info = None
+
+    if info is None:
+        return None
+    finish_probe(fname, info)
+
+    if len(_PROBES) > 256:
+        _PROBES.clear()
+    _PROBES[key] = info
+    return dict(info)
+
+
+def finish_probe(fname, info):
+    """
+    Fill in the probe fields that are worked out the same way for every format
+    """
+    info["fname"] = fname
+    info["shape"] = tuple(info["file_shape"][a] for a in info["axes"])
+    info["byteorder"] = info["dtype"].byteorder if info["dtype"].byteorder in "<>" else "|"
+    if info["byteorder"] == "|" and info["dtype"].itemsize > 1:
+        info["byteorder"] = "<" if sys.byteorder == "little" else ">"
+    return info
 
-def save_stack(fname, data, fmt="tif"):
+
+def describe_stack(info):
+    """
+    Return a short human-readable summary of a stack probed with probe_stack,
+    e.g. "512 x 512 x 300 uint16, 150 MB"
+    """
+    n_bytes = int(np.prod(info["shape"])) * info["dtype"].itemsize
+    if n_bytes >= 2 ** 30:
+        size = "%0.1f GB" % (n_bytes / 2.0 ** 30)
+    elif n_bytes >= 2 ** 20:
+        size = "%0.0f MB" % (n_bytes / 2.0 ** 20)
+    else:
+        size = "%0.0f kB" % (n_bytes / 2.0 ** 10)
+    description = "%s %s, %s" % (
+        " x ".join(str(s) for s in info["shape"]),
+        info["dtype"].name,
+        size,
+    )
+    if info.get("channels", 1) > 1:
+        description += ", %d channels" % info["channels"]
+    if info["compression"] is not None:
+        description += " (%s)" % info["compression"]
+    return description
+
+
+def memmap_stack(info, file_order=False):
+    """
+    Memory-map the voxel data of a stack described by probe_stack and return it in Lasagna order,
+    or in the order of the data on disk if file_order is True.
+    The returned array keeps the native data type of the file and no data are read until
+    they are accessed. The map is copy-on-write, so the array can be modified in RAM
+    without altering the file on disk.
+    Returns None if the data can not be mapped (compressed or non-contiguous data).
+    """
+    if info["compression"] is not None or info["data_offset"] is None:
+        return None
+    if not check_file_exists(info["data_file"], "memmap_stack"):
+        return None
+
+    try:
+        pix = np.memmap(
+            info["data_file"],
+            dtype=info["dtype"],
+            mode="c",
+            offset=info["data_offset"],
+            shape=info["file_shape"],
+        )
+    except ValueError as err:
+        print("Failed to map {}: {}".format(info["data_file"], err))
+        return None
+    if file_order:
+        return pix
+    return pix.transpose(info["axes"])
+
+
+def read_subvolume(fname, roi=None, step=1, block_mean=False, progress=None, volume_cache_bytes=None):
+    """
+    Read part of a stack, optionally downsampled, reading only the planes that are needed.
+    Raw data are memory-mapped, so only the bytes of the needed planes are read from disk.
+    TIFF stacks only decode the needed pages. Compressed MHD and NRRD data are decompressed
+    plane by plane, keeping only the planes needed and stopping after the last of them.
+
+    roi - region of interest as three (start, stop) pairs in Lasagna order. None, for the whole
+          stack or for one axis, means the whole axis. stop is exclusive and may be None.
+    step - integer stride, either the same for all axes or three numbers in Lasagna order
+    block_mean - if True each output voxel is the mean of a block of step voxels rather than
+                 the first voxel of the block. Incomplete blocks at the end of an axis are dropped.
+    progress - optional callable that is given the fraction of planes read. Compressed data are
+               reported plane by plane as they are decompressed, including the planes skipped.
+    volume_cache_bytes - the size cap of the volume cache, used by formats that can only be read whole
+
+    Returns the sub-volume in Lasagna order with the native byte order, or None on failure.
+    """
+    info = probe_stack(fname)
+    if info is None:
+        return None
+
+    if roi is None:
+        roi = (None, None, None)
+    if np.isscalar(step):
+        step = (step, step, step)
+    if len(roi) != 3 or len(step) != 3:
+        raise ValueError("roi and step must have one entry for each of the three axes")
+    if min(step) < 1:
+        raise ValueError("steps must be positive integers, got {}".format(step))
+
+    # Express the request in the order of the data on disk, where the first axis is the plane axis
+    ranges = [None, None, None]
+    steps = [1, 1, 1]
+    for lasagna_axis, file_axis in enumerate(info["axes"]):
+        limits = roi[lasagna_axis] if roi[lasagna_axis] is not None else (None, None)
+        start, stop, _ = slice(*limits).indices(info["file_shape"][file_axis])
+        steps[file_axis] = int(step[lasagna_axis])
+        stop = max(start, stop)
+        if block_mean:
+            stop = start + (stop - start) // steps[file_axis] * steps[file_axis]
+        ranges[file_axis] = (start, stop)
+
+    (z0, z1), (y0, y1), (x0, x1) = ranges
+    z_step, y_step, x_step = steps
+    indices = range(z0, z1, 1 if block_mean else z_step)
+    n_rows = len(range(y0, y1, y_step))
+    n_cols = len(range(x0, x1, x_step))
+    dtype = info["dtype"].newbyteorder("=")
+
+    planes = []
+    block = None
+    for n, plane in enumerate(iter_planes(info, indices, volume_cache_bytes, progress=progress)):
+        plane = plane[y0:y1, x0:x1]
+        if not block_mean:
+            planes.append(plane[::y_step, ::x_step].astype(dtype))
+        else:
+            plane = plane.reshape(n_rows, y_step, n_cols, x_step).mean(axis=(1, 3))
+            block = plane if block is None else block + plane
+            if (n + 1) % z_step == 0:
+                planes.append(block / z_step)
+                block = None
+
+    if planes:
+        data = np.stack(planes)
+    else:
+        data = np.zeros((0, n_rows, n_cols))
+
+    if block_mean and dtype.kind in "iub":
+        data = np.rint(data)
+    data = np.ascontiguousarray(data.astype(dtype).transpose(info["axes"]))
+
+    print(
+        "Read sub-volume of %s with step %s: cols: %d, rows: %d, layers: %d"
+        % (fname, tuple(step), data.shape[1], data.shape[2], data.shape[0])
+    )
+    return data
+
+
+def iter_planes(info, indices, volume_cache_bytes=None, progress=None):
+    """
+    Yield the planes of a stack described by probe_stack, in the order of the data on disk.
+    indices lists the planes wanted and must be increasing. Where the format allows it, the
+    other planes are not read.
+    progress is an optional callable that is given the fraction of the work done as each plane
+    is read. It is called before each plane is yielded, so it can stop the read by raising.
+    """
+    if len(indices) == 0:
+        return
+    if progress is None:
+        progress = lambda fraction: None
+
+    def in_turn(planes):
+        for n, plane in enumerate(planes):
+            progress(float(n + 1) / len(indices))
+            yield plane
+
+    mapped = memmap_stack(info, file_order=True)
+    if mapped is not None:
+        for plane in in_turn(mapped[index] for index in indices):
+            yield plane
+        return
+
+    if info["format"] == "slices":
+        from tifffile import imread
+
+        for plane in in_turn(imread(info["slice_files"][index], key=0) for index in indices):
+            yield plane
+        return
+
+    if info["format"] == "tiff":
+        from tifffile import TiffFile
+
+        with TiffFile(info["fname"]) as tiff:
+            tiff.pages.useframes = True
+            for plane in in_turn(tiff.pages[index].asarray() for index in indices):
+                yield plane
+        return
+
+    if info["compression"] in ("zlib", "gzip", "gz"):
+        for plane in iter_compressed_planes(info, indices, progress=progress):
+            yield plane
+        return
+
+    # Anything else can only be read whole
+    print("Reading all of {} as its planes can not be read one by one".format(info["fname"]))
+    data = load_stack(info["fname"], volume_cache_bytes=volume_cache_bytes, plane_cache_bytes=0)
+    if data is None or data is False:
+        raise IOError("Failed to read {}".format(info["fname"]))
+    data = np.asarray(data).transpose(np.argsort(info["axes"]))
+    for plane in in_turn(data[index] for index in indices):
+        yield plane
+
+
+def iter_compressed_planes(info, indices, progress=None):
+    """
+    Decompress a zlib or gzip data block one plane at a time, yielding the planes in indices.
+    Only one plane of decompressed data is held in memory and decompression stops after the
+    last plane needed.
+    progress is an optional callable that is given the fraction of the planes up to the last
+    one needed that have been decompressed. It is called for every plane, including those that
+    are not yielded, so a background task can be cancelled part way through a long stretch of
+    skipped planes [see background_task].
+    """
+    plane_shape = info["file_shape"][1:]
+    plane_bytes = int(np.prod(plane_shape)) * info["dtype"].itemsize
+    wanted = set(indices)
+    last = max(wanted)
+
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)  # Accepts both zlib and gzip headers
+    buffer = bytearray()
+    index = 0
+    with open(info["data_file"], "rb") as fid:
+        fid.seek(info["stream_offset"])
+        while index <= last:
+            chunk = decompressor.unconsumed_tail or fid.read(2 ** 20)
+            if not chunk:
+                raise IOError(
+                    "{} ended after {} of {} planes".format(info["data_file"], index, last + 1)
+                )
+            buffer += decompressor.decompress(chunk, plane_bytes - len(buffer))
+            if len(buffer) == plane_bytes:
+                if progress is not None:
+                    progress(float(index + 1) / (last + 1))
+                if index in wanted:
+                    yield np.frombuffer(bytes(buffer), dtype=info["dtype"]).reshape(plane_shape)
+                buffer = bytearray()
+                index += 1
+
+
+def save_stack(fname, data, fmt=None, progress=None):
     """Save the image data
-    Works only for tif for now
+    fmt is one of "tif", "bigtiff" (zlib-compressed BigTIFF), "mhd" or "nrrd" (gzip-compressed).
+    If fmt is None it is chosen from the file extension, with .btf meaning BigTIFF.
+    The data are written a slab of planes at a time, so memory use does not grow with the stack.
+    progress is an optional callable that is given the fraction done and a message.
     """
+    if fmt is None:
+        fmt = os.path.splitext(str(fname))[1]
     fmt = fmt.lower().strip().strip(".")
-    if fmt in ("tif", "tiff"):
-        save_tiff_stack(fname, data)
+    if fmt in ("tif", "tiff", ""):
+        save_tiff_stack(fname, data, progress=progress)
+    elif fmt in ("bigtiff", "btf", "tf8"):
+        save_tiff_stack(fname, data, compression="zlib", bigtiff=True, progress=progress)
+    elif fmt == "mhd":
+        if not mhd_write(data, fname, progress=progress):
+            raise IOError("Failed to write {}".format(fname))
+    elif fmt in ("nrrd", "nrd"):
+        nrrd_write(data, fname, progress=progress)
     else:
-        raise NotImplementedError
+        raise NotImplementedError("Can not save stacks as {}".format(fmt))
+
+
+def save_filter():
+    """
+    Returns a string defining the filter for the Qt save dialog, one entry per format save_stack can write
+    """
+    return "TIFF (*.tif *.tiff);;Compressed BigTIFF (*.btf);;MHD (*.mhd);;NRRD (*.nrrd)"
+
+
+def iter_slabs(data, progress=None, max_slab_bytes=64 * 2 ** 20):
+    """
+    Yield C-contiguous slabs of consecutive planes along the first axis of data, which may be
+    a non-contiguous view or a lazy stack. Each slab holds at most max_slab_bytes (and at least
+    one plane), so writing a stack slab by slab needs a bounded amount of memory.
+    """
+    n_planes = data.shape[0]
+    plane_bytes = max(1, int(np.prod(data.shape[1:])) * data.dtype.itemsize)
+    planes_per_slab = max(1, max_slab_bytes // plane_bytes)
+    for first in range(0, n_planes, planes_per_slab):
+        last = min(n_planes, first + planes_per_slab)
+        yield np.ascontiguousarray(data[first:last])
+        if progress is not None:
+            progress(float(last) / n_planes, "writing")
+
+
+def stack_exists(fname):
+    """
+    Returns True if fname is a stack file or a directory or glob pattern matching slice files
+    """
+    return os.path.isfile(fname) or len(slice_files(fname)) > 0
 
 
 def image_filter():
@@ -67,21 +481,31 @@ def image_filter():
     As image formats are added (or removed) from this module, this
     string should be manually modified accordingly.
     """
-    return "Images (*.mhd *.tiff *.tif *.nrrd *.nrd)"
+    return "Images (*.mhd *.tiff *.tif *.btf *.nrrd *.nrd)"
 
 
-def get_voxel_spacing(fname, fall_back_mode=False):
+def get_voxel_spacing(fname, fall_back_mode=False, step=1, default_ratios=None):
     """
     Attempts to get the voxel spacing in all three dimensions. This allows us to set the axis
-    ratios automatically. TODO: Currently this will only work for MHD files, but we may be able
-    to swing something for TIFFs (e.g. by creating Icy-like metadata files)
+    ratios automatically. The spacing is read from the file header (see probe_stack). Files
+    that do not record a spacing get default_ratios.
+    step is the stride (see read_subvolume) the stack was read with. The spacing is scaled by it.
+    If default_ratios is None the "defaultAxisRatios" preference is read, which is only safe on
+    the GUI thread [see load_stack].
     """
-    if fname.lower().endswith(".mhd"):
-        return mhd_get_ratios(fname)
-    if fname.lower().endswith(".nrrd") or fname.lower().endswith(".nrd"):
-        return nrrd_get_ratios(fname)
-    else:
-        return preferences.readPreference("defaultAxisRatios")  # defaults
+    info = probe_stack(fname)
+    if np.isscalar(step):
+        step = (step, step, step)
+    if info is None or (not info["spacing"] and len(set(step)) == 1):
+        if default_ratios is None:
+            default_ratios = preferences.readPreference("defaultAxisRatios")
+        return default_ratios  # defaults
+
+    spacing = list(info["spacing"] or (1, 1, 1))
+    # The spacing runs x, y, z, which is the reverse of the order of the data on disk
+    for lasagna_axis, file_axis in enumerate(info["axes"]):
+        spacing[2 - file_axis] *= step[lasagna_axis]
+    return spacing_to_ratio(spacing)
 
 
 def spacing_to_ratio(spacing):
@@ -104,17 +528,233 @@ def spacing_to_ratio(spacing):
     return ratios
 
 
+# -------------------------------------------------------------------------------------------
+#   *Directory of slices handling methods*
+# A directory (or glob pattern) of 2-D images, one per plane, is treated as one stack.
+# This is what serial-section imaging rigs produce: one TIFF per physical section.
+SLICE_EXTENSIONS = (".tif", ".tiff")
+
+
+def is_slice_set(fname):
+    """
+    Returns True if fname is a directory or a glob pattern rather than a single file
+    """
+    return os.path.isdir(fname) or glob.has_magic(fname)
+
+
+def natural_sort_key(fname):
+    """
+    Sort key that orders numbers in file names numerically, so that "section_10" comes after "section_9"
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", fname)]
+
+
+def slice_files(fname):
+    """
+    Return the slice files in the directory, or matching the glob pattern, fname in natural sort order.
+    Only TIFF files are taken from a directory. A glob pattern is used as it is.
+    """
+    if os.path.isdir(fname):
+        candidates = [
+            os.path.join(fname, f) for f in os.listdir(fname) if f.lower().endswith(SLICE_EXTENSIONS)
+        ]
+    elif glob.has_magic(fname):
+        candidates = glob.glob(fname)
+    else:
+        return []
+    return sorted([f for f in candidates if os.path.isfile(f)], key=natural_sort_key)
+
+
+def slice_set_probe(fname):
+    """
+    Describe a directory of slices for probe_stack. Only the header of the first slice is read.
+    """
+    from tifffile import TiffFile
+
+    fnames = slice_files(fname)
+    if not fnames:
+        print("No slices found in {}".format(fname))
+        return None
+
+    with TiffFile(fnames[0]) as tiff:
+        page = tiff.pages[0]
+        rows, cols = page.shape[:2]
+        compression = None
+        if page.compression != 1:  # 1 means no compression
+            compression = getattr(page.compression, "name", str(page.compression)).lower()
+        dtype = np.dtype(page.dtype)
+
+    return finish_probe(fname, dict(
+        format="slices",
+        file_shape=(len(fnames), rows, cols),
+        axes=(0, 2, 1),
+        dtype=dtype,
+        spacing=None,
+        data_file=fnames[0],
+        data_offset=None,
+        stream_offset=None,
+        compression=compression,
+        slice_files=fnames,
+    ))
+
+
+def load_slice_directory(fname, lazy=True, cache_bytes=None):
+    """
+    Load a directory (or glob pattern) of slices as a SliceDirectoryStack, which decodes slices
+    on demand and in advance of scrolling. If lazy is False all slices are read into memory.
+    cache_bytes is the memory for decoded slices [see load_stack].
+    """
+    from lasagna.io_libs.lazy_stack import SliceDirectoryStack
+
+    fnames = slice_files(fname)
+    if cache_bytes is None:
+        cache_bytes = lazy_stack_cache_bytes()
+    im = SliceDirectoryStack.open(fnames, cache_bytes=cache_bytes)
+    if im is None:
+        print("No slices found in {}".format(fname))
+        return None
+
+    print(
+        "Found %d slices in %s. cols: %d, rows: %d" % (im.shape[0], fname, im.shape[1], im.shape[2])
+    )
+    if not lazy:
+        from lasagna.utils import loader_pool
+
+        data = np.stack(loader_pool.map_ordered(im.read_plane, range(im.shape[0])))
+        im.close()
+        return data
+    return im
+
+
 # -------------------------------------------------------------------------------------------
 #   *TIFF handling methods*
-def load_tiff_stack(fname, use_lib_tiff=False):
+def tiff_probe(fname):
+    """
+    Describe a TIFF or LSM stack for probe_stack. Only the headers of the first, second and last
+    pages are parsed. The other pages are not read, so probing takes much the same time whatever
+    the number of pages.
+    LSM files hold several channels. The shape of an LSM probe is that of one channel.
+    """
+    from tifffile import TiffFile
+
+    with TiffFile(fname) as tiff:
+        page = tiff.pages[0]
+        is_lsm = tiff.is_lsm
+        n_pages = len(tiff.pages)  # Follows the chain of page offsets without parsing the pages
+
+        series = None
+        if is_lsm:
+            # LSM series are (time, z, channels, rows, cols)
+            series = tiff.series[0]
+            axes = series.axes
+            n_layers = series.shape[axes.index("Z")] if "Z" in axes else 1
+            channels = series.shape[axes.index("C")] if "C" in axes else 1
+            rows, cols = series.shape[-2:]
+        elif tiff.is_imagej or tiff.is_shaped:
+            # The shape is in the metadata. Other stacks would have every page parsed to find their series
+            series = tiff.series[0]
+            n_layers = int(np.prod(series.shape[:-2])) if len(series.shape) > 2 else 1
+            channels = 1
+            rows, cols = series.shape[-2:]
+        else:
+            n_layers = n_pages
+            channels = 1
+            rows, cols = page.shape[:2]
+
+        dtype = np.dtype(page.dtype)
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder(tiff.byteorder)
+
+        compression = None
+        if page.compression != 1:  # 1 means no compression
+            compression = getattr(page.compression, "name", str(page.compression)).lower()
+
+        # The pages form one block only if they are uncompressed, in one strip and back to back.
+        # Pages are written in order, so the second and last pages are enough to tell.
+        data_offset = None
+        if compression is None and not is_lsm and len(page.dataoffsets) == 1:
+            page_bytes = rows * cols * dtype.itemsize
+            first = page.dataoffsets[0]
+            if n_pages == 1 and n_layers > 1 and series is not None:
+                data_offset = series.dataoffset  # ImageJ stacks over 4 GB have one page header for all planes
+            elif n_pages == n_layers == 1:
+                data_offset = first
+            elif n_pages == n_layers:
+                second, last = tiff.pages[1], tiff.pages[n_pages - 1]
+                if (
+                    len(second.dataoffsets) == 1
+                    and len(last.dataoffsets) == 1
+                    and second.dataoffsets[0] - first == page_bytes
+                    and last.dataoffsets[0] - first == (n_pages - 1) * page_bytes
+                ):
+                    data_offset = first
+
+        spacing = tiff_spacing(tiff)
+
+    return dict(
+        format="lsm" if is_lsm else "tiff",
+        file_shape=(n_layers, rows, cols),
+        axes=(0, 2, 1),
+        dtype=dtype,
+        spacing=spacing,
+        data_file=fname,
+        data_offset=data_offset,
+        stream_offset=None,
+        compression=compression,
+        channels=channels,
+    )
+
+
+def tiff_spacing(tiff):
+    """
+    Return the x, y and z voxel size recorded in an open TiffFile, or None if it is not recorded.
+    LSM files store it in their own metadata. ImageJ stacks store z in the ImageJ metadata and
+    x and y in the resolution tags (as pixels per unit).
+    """
+    if tiff.is_lsm:
+        meta = tiff.lsm_metadata
+        spacing = [meta.get("VoxelSizeX"), meta.get("VoxelSizeY"), meta.get("VoxelSizeZ")]
+    elif tiff.is_imagej and "spacing" in tiff.imagej_metadata:
+        tags = tiff.pages[0].tags
+        spacing = []
+        for tag_name in ("XResolution", "YResolution"):
+            if tag_name not in tags:
+                return None
+            numerator, denominator = tags[tag_name].value
+            spacing.append(float(denominator) / numerator if numerator else None)
+        spacing.append(float(tiff.imagej_metadata["spacing"]))
+    else:
+        return None
+
+    if any(not s for s in spacing):
+        return None
+    return spacing
+
+
+def load_tiff_stack(fname, use_lib_tiff=False, lazy=False, cache_bytes=None):
     """
     Read a TIFF stack.
     We're using tifflib by default as, right now, only this works when the application is compile on Windows. [17/08/15]
+    If lazy is True, multi-page stacks are returned as a LazyTiffStack that decodes pages on demand.
+    cache_bytes is the memory for its decoded pages [see load_stack].
     Bugs: known to fail with tiffs produced by Icy [23/07/15]
     """
     if not check_file_exists(fname, "load_tiff_stack"):
         return
 
+    if lazy and not use_lib_tiff:
+        from lasagna.io_libs.lazy_stack import LazyTiffStack
+
+        if cache_bytes is None:
+            cache_bytes = lazy_stack_cache_bytes()
+        im = LazyTiffStack.open(fname, cache_bytes=cache_bytes)
+        if im is not None:
+            print(
+                "Indexed %d pages of %s for lazy loading. cols: %d, rows: %d"
+                % (im.shape[0], fname, im.shape[1], im.shape[2])
+            )
+            return im
+
     if use_lib_tiff:
         try:
             from libtiff import TIFFfile
@@ -138,14 +778,34 @@ def load_tiff_stack(fname, use_lib_tiff=False):
     return im
 
 
-def save_tiff_stack(fname, data, use_lib_tiff=False):
+def save_tiff_stack(fname, data, use_lib_tiff=False, compression=None, bigtiff=None, progress=None):
     """Save data in file fname
+    Pages are handed to tifffile one at a time, so the stack is never copied as a whole.
+    compression is a tifffile compression name such as "zlib". BigTIFF is used if bigtiff is True,
+    or if bigtiff is None and the stack is too big for a classic TIFF.
     """
     if use_lib_tiff:
         raise NotImplementedError
-    from tifffile import imsave
+    from tifffile import TiffWriter
+
+    # TIFF pages are (rows, cols)
+    pages = data.swapaxes(1, 2)
+    if bigtiff is None:
+        bigtiff = data.nbytes > 2 ** 32 - 2 ** 25
+    n_pages = pages.shape[0]
 
-    imsave(str(fname), data.swapaxes(1, 2))
+    def iter_pages():
+        for index in range(n_pages):
+            yield np.ascontiguousarray(pages[index])
+            if progress is not None:
+                progress(float(index + 1) / n_pages, "writing")
+
+    with TiffWriter(str(fname), bigtiff=bigtiff) as tiff:
+        try:
+            tiff.write(iter_pages(), shape=pages.shape, dtype=data.dtype, compression=compression)
+        except TypeError:  # tifffile before 2020.9.30 calls the argument "compress"
+            tiff.write(iter_pages(), shape=pages.shape, dtype=data.dtype,
+                       compress=6 if compression else 0)
 
 
 # -------------------------------------------------------------------------------------------
@@ -153,9 +813,13 @@ def save_tiff_stack(fname, data, use_lib_tiff=False):
 def mhd_read(fname, fall_back_mode=False):
     """ Read an MHD image file
 
-    Read an MHD file using either VTK (if available) or the slower-built in reader
+    Uncompressed data are memory-mapped using the header read by probe_stack. VTK (if available)
+    is only used for data the memory-mapped reader can not handle, such as compressed data.
     if fallBackMode is true we force use of the built-in reader
     """
+    info = probe_stack(fname)
+    if info is not None and info["compression"] is None:
+        fall_back_mode = True
 
     if not fall_back_mode:
         # Attempt to load vtk
@@ -165,7 +829,7 @@ def mhd_read(fname, fall_back_mode=False):
             from vtk.util.numpy_support import vtk_to_numpy
         except ImportError:
             print(
-                "Failed to find VTK. Falling back to built in (but slower) MHD reader"
+                "Failed to find VTK. Falling back to built in memory-mapped MHD reader"
             )
             fall_back_mode = True
 
@@ -191,15 +855,17 @@ def mhd_read(fname, fall_back_mode=False):
         return a
 
 
-def mhd_write(im_stack, fname):
+def mhd_write(im_stack, fname, progress=None):
     """ Write an MHD file
 
-    Write MHD file, updating both the MHD and raw file.
+    Write MHD file, updating both the MHD and raw file. If the header file exists, its
+    other fields (e.g. the spacing) are kept. Otherwise a new header and raw file are made.
+    The ElementType and byte order are set from the data type of im_stack.
     imStack - is the image stack volume ndarray
     fname - is the absolute path to the mhd file.
     """
-    im_stack = np.swapaxes(im_stack, 1, 2)
-    out = mhd_write_raw_file(im_stack, fname)
+    im_stack = im_stack.swapaxes(1, 2)
+    out = mhd_write_raw_file(im_stack, fname, progress=progress)
     if not out:
         return False
     else:
@@ -221,65 +887,125 @@ def mhd_read_fallback(fname):
     """
     if not check_file_exists(fname, "mhd_read_fallback"):
         return False
-    else:
-        info = mhd_read_header_file(fname)
-        if len(info) == 0:
-            print("No data extracted from header file")
-            return False
 
-    if "dimsize" not in info:
-        print("Can not find dimension size information in MHD file. Not importing data")
+    info = probe_stack(fname)
+    if info is None:
         return False
 
-    # read the raw file
-    if "elementdatafile" not in info:
-        print(
-            "Can not find the data file as the key 'elementdatafile' does not exist in the MHD file"
-        )
+    if info["compression"] is not None:
+        print("\n **The built-in MHD reader can not read compressed data. Install VTK to read {}** \n".format(fname))
         return False
 
-    return mhd_read_raw_file(fname, info)
+    pix = memmap_stack(info)
+    if pix is None:
+        return False
+
+    print(
+        "Mapped MHD image of size: cols: %d, rows: %d, layers: %d (%s)"
+        % (info["shape"][1], info["shape"][2], info["shape"][0], info["dtype"])
+    )
+    return pix
 
 
-def mhd_read_raw_file(fname, header):
+def mhd_probe(fname):
     """
-    Raw .raw file associated with the MHD header file
+    Describe an MHD stack for probe_stack using only the header file.
     CAUTION: this may not adhere to MHD specs! Report bugs to author.
     """
+    header = mhd_read_header_file(fname)
+    if len(header) == 0:
+        print("No data extracted from header file")
+        return None
 
-    if "headersize" in header and header["headersize"] > 0:
+    if "dimsize" not in header:
+        print("Can not find dimension size information in MHD file. Not importing data")
+        return None
+
+    if "elementdatafile" not in header:
         print(
-            "\n\n **MHD reader can not currently cope with header information in .raw file. "
-            "Contact the author** \n\n"
+            "Can not find the data file as the key 'elementdatafile' does not exist in the MHD file"
         )
-        return False
+        return None
 
-    # Set the endian type correctly
-    endian = "<"  # default little endian
-    if "byteorder" in header and header["byteorder"].lower == "true":
-        endian = ">"  # big endian
-
-    format_type = get_format_type_from_mhd_header(header)
-    if not format_type:
+    dtype = get_dtype_from_mhd_header(header)
+    if dtype is None:
         print("\nCan not find data format type in MHD file. **CONTACT AUTHOR**\n")
-        return False
+        return None
 
-    path_to_file = path_utils.stripTrailingFileFromPath(fname)
-    print(header["elementdatafile"])  # TODO: CLEAN THIS SHIT
+    # Round it to keep python 3 happy
+    dim_size = [int(round(d)) for d in header["dimsize"]]
+    file_shape = (dim_size[2], dim_size[1], dim_size[0])
+    n_bytes = int(np.prod(file_shape)) * dtype.itemsize
+
+    # LOCAL means that the data follow the header in the same file, after the ElementDataFile line
+    if header["elementdatafile"].upper() == "LOCAL":
+        data_file = fname
+        with open(fname, "rb") as fid:
+            for line in fid:
+                if line.strip().lower().startswith(b"elementdatafile"):
+                    break
+            header_size = fid.tell()
+    else:
+        data_file = os.path.join(os.path.dirname(fname), header["elementdatafile"])
+        # HeaderSize is the number of bytes to skip at the start of the raw file. A value of -1
+        # means that the data are at the end of the file and the header size must be calculated.
+        header_size = int(float(header.get("headersize", 0)))
+
+    compression = None
+    stream_offset = max(header_size, 0)
+    if str(header.get("compresseddata", "false")).strip().lower() == "true":
+        compression = "zlib"
+        data_offset = None
+    elif header_size < 0:
+        data_offset = os.path.getsize(data_file) - n_bytes if os.path.exists(data_file) else None
+    else:
+        data_offset = header_size
+
+    spacing = header.get("elementspacing", header.get("elementsize"))
+    if not isinstance(spacing, list) or len(spacing) != 3:
+        spacing = None
+
+    return dict(
+        format="mhd",
+        file_shape=file_shape,
+        axes=(0, 2, 1),
+        dtype=dtype,
+        spacing=spacing,
+        data_file=data_file,
+        data_offset=data_offset,
+        stream_offset=stream_offset,
+        compression=compression,
+    )
 
-    raw_fname = os.path.join(path_to_file, header["elementdatafile"])
-    with open(raw_fname, "rb") as fid:
-        data = fid.read()
 
-    dim_size = header["dimsize"]
-    # from: http://stackoverflow.com/questions/26542345/reading-data-from-a-16-bit-unsigned-big-endian-raw-image-file-in-python
-    fmt = "{}{}{}".format(endian, (int(np.prod(dim_size))), format_type)
-    pix = np.asarray(struct.unpack(fmt, data))
+def mhd_is_big_endian(header):
+    """ Determine the byte order of the data from an MHD header
 
-    # Round it to keep python 3 happy
-    dim_size = [round(d) for d in dim_size]
+    Returns True if the data are big endian. Little endian is the default.
+    """
+    for key in ("elementbyteordermsb", "binarydatabyteordermsb", "byteordermsb"):
+        if key in header:
+            return str(header[key]).strip().lower() == "true"
+    return False
+
+
+def get_dtype_from_mhd_header(header):
+    """ Return the numpy dtype, including byte order, of the data described by an MHD header
+
+    Returns None if the data type can not be determined.
+    """
+    format_type = get_format_type_from_mhd_header(header)
+    if not format_type:
+        return None
+
+    dtype = np.dtype(format_type)
+    if dtype.itemsize == 1:
+        return dtype
 
-    return pix.reshape((dim_size[2], dim_size[1], dim_size[0])).swapaxes(1, 2)
+    if mhd_is_big_endian(header):
+        return dtype.newbyteorder(">")
+    else:
+        return dtype.newbyteorder("<")
 
 
 def get_format_type_from_mhd_header(header):
@@ -295,53 +1021,99 @@ def get_format_type_from_mhd_header(header):
         except KeyError:
             format_type = False
 
-    # If we couldn't find it, look in the ElenentType field
+    # If we couldn't find it, look in the ElementType field
     if not format_type:
         if "elementtype" in header:
             datatype = header["elementtype"].lower()
-            if datatype == "met_short":
-                format_type = "h"
+            format_type = MET_TYPES.get(datatype, False)
 
     return format_type
 
 
-def mhd_write_raw_file(im_stack, fname, info=None):
+def mhd_write_raw_file(im_stack, fname, info=None, progress=None):
     """
     Write raw MHD file.
-    imStack - is the image stack volume ndarray
+    imStack - is the image stack volume ndarray (or lazy stack) in (layers, rows, cols) order
     fname - is the absolute path to the mhd file.
     info - is a dictionary containing imported data from the mhd file. This is optional.
-        If info is missing, we read the data from the mhd file
+        If info is missing, we read the data from the mhd file if it exists.
+    The data are streamed to the raw file a slab at a time. Returns the updated header
+    dictionary, or False if writing failed.
     """
 
     if info is None:
-        info = mhd_read_header_file(fname)
+        info = mhd_read_header_file(fname) if os.path.exists(fname) else dict()
 
-    # Get the name of the raw file and check it exists
-    path = os.path.dirname(fname)
-    path_to_raw = path + os.path.sep + info["elementdatafile"]
+    # Local data and new files get a raw file named after the header
+    if str(info.get("elementdatafile", "LOCAL")).upper() == "LOCAL":
+        info["elementdatafile"] = os.path.splitext(os.path.basename(fname))[0] + ".raw"
+    path_to_raw = os.path.join(os.path.dirname(fname), info["elementdatafile"])
 
-    if not os.path.exists(path_to_raw):
-        print(
-            "Unable to find raw file at {}. Aborting mhd_write_raw_file".format(
-                path_to_raw
-            )
-        )
+    element_type = dtype_to_met_type(im_stack.dtype)
+    if element_type is None:
+        print("MHD files can not hold data of type {}".format(im_stack.dtype))
         return False
 
     # replace the stack dimension sizes in the info stack in case the user changed this
-    info["dimsize"] = im_stack.shape[::-1]  # We need to flip the list for some reason
-
-    # TODO: the endianness is not set here or defined in the MHD file. Does this matter?
+    info["ndims"] = 3
+    info["dimsize"] = im_stack.shape[::-1]  # MHD lists the fastest-varying axis first
+    info["elementtype"] = element_type
+    info["elementbyteordermsb"] = dtype_is_big_endian(im_stack.dtype)
+    info["binarydatabyteordermsb"] = info["elementbyteordermsb"]
+    info["compresseddata"] = False
+    for key in ("datatype", "headersize", "byteordermsb", "compresseddatasize"):
+        info.pop(key, None)  # These would contradict the data we write
+
+    # On Windows a file can not be replaced while it is memory-mapped, so copy the data first
+    if os.name != "posix" and maps_file(im_stack, path_to_raw):
+        im_stack = np.array(im_stack)
+
+    # The stack may be a memory-mapped view of the very file we are about to overwrite, so
+    # the data go to a temporary file that replaces the raw file once it is complete.
+    tmp_path = path_to_raw + ".tmp"
     try:
-        with open(path_to_raw, "wb") as fid:
-            fid.write(bytearray(im_stack.ravel()))
+        with open(tmp_path, "wb") as fid:
+            for slab in iter_slabs(im_stack, progress=progress):
+                slab.tofile(fid)
+        os.replace(tmp_path, path_to_raw)
         return info
-    except IOError:
-        print("Failed to write raw file in mhd_write_raw_file")
+    except IOError as err:
+        print("Failed to write raw file in mhd_write_raw_file: {}".format(err))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return False
 
 
+def dtype_to_met_type(dtype):
+    """
+    Return the MetaImage ElementType for a numpy dtype, or None if there is none
+    """
+    code = np.dtype(dtype).str[1:]  # e.g. "u2"
+    for met_type, met_code in MET_TYPES.items():
+        if met_code == code:
+            return met_type.upper()
+    return None
+
+
+def dtype_is_big_endian(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.byteorder == "=":
+        return sys.byteorder == "big"
+    return dtype.byteorder == ">"
+
+
+def maps_file(array, fname):
+    """
+    Return True if array is a (view of a) memory-mapped array backed by the file fname
+    """
+    while array is not None:
+        if isinstance(array, np.memmap) and array.filename is not None:
+            if os.path.exists(fname) and os.path.samefile(array.filename, fname):
+                return True
+        array = getattr(array, "base", None)
+    return False
+
+
 def mhd_read_header_file(fname):
     """
     Read an MHD plain text header file and return contents as a dictionary
@@ -350,12 +1122,17 @@ def mhd_read_header_file(fname):
     mhd_header = dict()
     mhd_header["FileName"] = fname
 
-    with open(fname, "r") as fid:
-        contents = fid.read()
+    # ElementDataFile is the last field of the header. Stop there, since LOCAL data follow it.
+    lines = []
+    with open(fname, "r", errors="replace") as fid:
+        for line in fid:
+            lines.append(line.rstrip("\r\n"))
+            if line.lower().startswith("elementdatafile"):
+                break
 
     info = dict()  # header data stored here
 
-    for line in contents.split("\n"):
+    for line in lines:
         if not line:
             continue
 
@@ -408,13 +1185,28 @@ def mhd_write_header_file(fname, info):
     It can only cope with the fields hard-coded described below.
     """
 
+    def numbers_to_str(numbers):
+        # "%.10g" keeps integers looking like integers without truncating non-integer spacings
+        return " ".join("%.10g" % number for number in numbers)
+
+    def bool_to_str(value):
+        return "True" if str(value).strip().lower() == "true" else "False"
+
     file_str = ""  # Build a string that we will write to a file
+    file_str += "ObjectType = Image\n"
     if "ndims" in info:
         file_str += "NDims = %d\n" % info["ndims"]
 
     if "datatype" in info:
         file_str += "DataType = %s\n" % info["datatype"]
 
+    if "binarydatabyteordermsb" in info:
+        file_str += "BinaryData = True\n"
+        file_str += "BinaryDataByteOrderMSB = %s\n" % bool_to_str(info["binarydatabyteordermsb"])
+
+    if "compresseddata" in info:
+        file_str += "CompressedData = %s\n" % bool_to_str(info["compresseddata"])
+
     if "dimsize" in info:
         numbers = " ".join(
             map(str, (list(map(int, info["dimsize"]))))
@@ -422,18 +1214,16 @@ def mhd_write_header_file(fname, info):
         file_str += "DimSize = %s\n" % numbers
 
     if "elementsize" in info:
-        numbers = " ".join(map(str, (list(map(int, info["elementsize"])))))
-        file_str += "ElementSize = %s\n" % numbers
+        file_str += "ElementSize = %s\n" % numbers_to_str(info["elementsize"])
 
     if "elementspacing" in info:
-        numbers = " ".join(map(str, (list(map(int, info["elementspacing"])))))
-        file_str += "ElementSpacing = %s\n" % numbers
+        file_str += "ElementSpacing = %s\n" % numbers_to_str(info["elementspacing"])
 
     if "elementtype" in info:
         file_str += "ElementType = %s\n" % info["elementtype"]
 
     if "elementbyteordermsb" in info:
-        file_str += "ElementByteOrderMSB = %s\n" % str(info["elementbyteordermsb"])
+        file_str += "ElementByteOrderMSB = %s\n" % bool_to_str(info["elementbyteordermsb"])
 
     if "elementdatafile" in info:
         file_str += "ElementDataFile = %s\n" % info["elementdatafile"]
@@ -447,49 +1237,51 @@ def mhd_get_ratios(fname):
     """
     Get relative axis ratios from MHD file defined by fname
     """
-    if not check_file_exists(fname, mhd_get_ratios):
+    if not check_file_exists(fname, "mhd_get_ratios"):
         return
 
-    try:
-        # Attempt to use the vtk module to read the element spacing
-        imp.find_module("vtk")
-        import vtk
-
-        imr = vtk.vtkMetaImageReader()
-        imr.SetFileName(fname)
-        imr.Update()
-
-        im = imr.GetOutput()
-        spacing = im.GetSpacing()
-    except ImportError:
-        # If the vtk module fails, we try to read the spacing using the built-in reader
-        info = mhd_read_header_file(fname)
-        if "elementspacing" in info:
-            spacing = info["elementspacing"]
-        else:
-            print(
-                "Failed to find spacing info in MHA file. Using default axis length values"
-            )
-            return preferences.readPreference("defaultAxisRatios")  # defaults
-
-    if not spacing:
+    info = probe_stack(fname)
+    if info is None or not info["spacing"]:
         print(
             "Failed to find spacing valid spacing info in MHA file. Using default axis length values"
         )
         return preferences.readPreference("defaultAxisRatios")  # defaults
 
-    return spacing_to_ratio(spacing)
+    return spacing_to_ratio(info["spacing"])
 
 
 # -------------------------------------------------------------------------------------------
 #   *NRRD handling methods*
+# NRRD type names and the numpy data type each one stands for
+NRRD_TYPES = {
+    "i1": ("signed char", "int8", "int8_t"),
+    "u1": ("uchar", "unsigned char", "uint8", "uint8_t"),
+    "i2": ("short", "short int", "signed short", "signed short int", "int16", "int16_t"),
+    "u2": ("ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"),
+    "i4": ("int", "signed int", "int32", "int32_t"),
+    "u4": ("uint", "unsigned int", "uint32", "uint32_t"),
+    "i8": ("longlong", "long long", "long long int", "signed long long",
+           "signed long long int", "int64", "int64_t"),
+    "u8": ("ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"),
+    "f4": ("float",),
+    "f8": ("double",),
+}
+
+
 def nrrd_read(fname):
     """
     Read NRRD file
+    Raw data are memory-mapped. Encoded data (e.g. gzip) are decoded in full with pynrrd.
     """
     if not check_file_exists(fname, "nrrd_read"):
         return
 
+    info = probe_stack(fname)
+    if info is not None:
+        pix = memmap_stack(info)
+        if pix is not None:
+            return pix
+
     import nrrd
 
     data, header = nrrd.read(fname)
@@ -511,6 +1303,119 @@ def nrrd_header_read(fname):
     return header
 
 
+def nrrd_probe(fname):
+    """
+    Describe a NRRD stack for probe_stack using only the header
+    """
+    import nrrd
+
+    with open(fname, "rb") as fid:
+        header = nrrd.read_header(fid)
+        end_of_header = fid.tell()
+
+    sizes = [int(s) for s in header["sizes"]]
+    if len(sizes) != 3:
+        print("Lasagna can only read 3-D NRRD files. {} has {} dimensions".format(fname, len(sizes)))
+        return None
+
+    type_name = header["type"].strip().lower()
+    codes = [code for code, names in NRRD_TYPES.items() if type_name in names]
+    if not codes:
+        print("Unknown NRRD data type {} in {}".format(type_name, fname))
+        return None
+    dtype = np.dtype(codes[0])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(">" if header.get("endian", "little") == "big" else "<")
+
+    # Data may be in a detached file
+    data_file = header.get("data file", header.get("datafile"))
+    if data_file is None:
+        data_file = fname
+        stream_offset = end_of_header
+    else:
+        data_file = os.path.join(os.path.dirname(fname), data_file)
+        stream_offset = 0
+
+    encoding = header.get("encoding", "raw")
+    compression = None if encoding == "raw" else encoding
+    n_bytes = int(np.prod(sizes)) * dtype.itemsize
+    byte_skip = int(header.get("byte skip", header.get("byteskip", 0)))
+    line_skip = int(header.get("line skip", header.get("lineskip", 0)))
+    if compression is not None or line_skip:
+        data_offset = None  # The start of the voxels is only known after decoding
+    elif byte_skip < 0:
+        data_offset = os.path.getsize(data_file) - n_bytes if os.path.exists(data_file) else None
+    else:
+        data_offset = stream_offset + byte_skip
+
+    spacing = None
+    if "space directions" in header:
+        directions = np.asarray(header["space directions"], dtype=float)
+        if directions.shape == (3, 3) and not np.isnan(directions).any():
+            spacing = [float(np.linalg.norm(d)) for d in directions]
+    elif "spacings" in header:
+        spacing = [float(s) for s in header["spacings"]]
+
+    # The first NRRD axis varies fastest, so the C-order block on disk is (z, y, x).
+    # pynrrd returns (x, y, z) and nrrd_read then swaps the last two axes.
+    return dict(
+        format="nrrd",
+        file_shape=(sizes[2], sizes[1], sizes[0]),
+        axes=(2, 0, 1),
+        dtype=dtype,
+        spacing=spacing,
+        data_file=data_file,
+        data_offset=data_offset,
+        stream_offset=stream_offset,
+        compression=compression,
+    )
+
+
+def nrrd_write(im_stack, fname, encoding="gzip", spacing=None, progress=None):
+    """
+    Write a NRRD file with an attached header, streaming the data a slab at a time.
+    im_stack is in Lasagna order and is written so that nrrd_read returns it unchanged.
+    encoding is "gzip" or "raw". spacing is an optional list of the x, y and z voxel sizes.
+    """
+    # Undo the axis order produced by nrrd_read: the C-order block on disk is (z, y, x)
+    file_data = im_stack.swapaxes(0, 1).swapaxes(1, 2)  # swapaxes also works for lazy stacks
+    dtype = im_stack.dtype
+    codes = [code for code in NRRD_TYPES if np.dtype(code).str[1:] == dtype.str[1:]]
+    if not codes:
+        raise ValueError("NRRD files can not hold data of type {}".format(dtype))
+
+    header = "NRRD0004\n"
+    header += "# Complete NRRD file format specification at:\n"
+    header += "# http://teem.sourceforge.net/nrrd/format.html\n"
+    header += "type: %s\n" % NRRD_TYPES[codes[0]][0]
+    header += "dimension: 3\n"
+    header += "sizes: %d %d %d\n" % tuple(file_data.shape[::-1])
+    if spacing is not None:
+        header += "spacings: %s\n" % " ".join("%.10g" % s for s in spacing)
+    if dtype.itemsize > 1:
+        header += "endian: %s\n" % ("big" if dtype_is_big_endian(dtype) else "little")
+    header += "encoding: %s\n\n" % encoding
+
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    elif encoding == "raw":
+        compressor = None
+    else:
+        raise ValueError("Can not write NRRD files with {} encoding".format(encoding))
+
+    tmp_path = str(fname) + ".tmp"
+    with open(tmp_path, "wb") as fid:
+        fid.write(header.encode("ascii"))
+        for slab in iter_slabs(file_data, progress=progress):
+            if compressor is None:
+                slab.tofile(fid)
+            else:
+                fid.write(compressor.compress(slab.tobytes()))
+        if compressor is not None:
+            fid.write(compressor.flush())
+    os.replace(tmp_path, fname)  # The file being replaced may be memory-mapped by Lasagna
+
+
 def nrrd_get_ratios(fname):
     """
     Get the aspect ratios from the NRRD file
@@ -518,14 +1423,11 @@ def nrrd_get_ratios(fname):
     if not check_file_exists(fname, "nrrd_get_rations"):
         return
 
-    header = nrrd_header_read(fname)
-    ax_sizes = header["space directions"]
-
-    spacing = []
-    for i in range(len(ax_sizes)):
-        spacing.append(ax_sizes[i][i])
+    info = probe_stack(fname)
+    if info is None or not info["spacing"]:
+        return preferences.readPreference("defaultAxisRatios")  # defaults
 
-    return spacing_to_ratio(spacing)
+    return spacing_to_ratio(info["spacing"])
 
 
 def check_file_exists(file_path, source_function_name):
@@ -0,0 +1,414 @@
+"""
+Lazily loaded image stacks
+
+A lazy stack looks enough like a 3-D numpy array (shape, dtype, size, slicing, swapaxes)
+to be used as the data of an imagestack ingredient, but it only decodes the planes
+that are actually requested. Decoded planes are kept in a size-limited LRU cache so that
+moving back and forth through a stack, or building views along the other two axes,
+does not decode the same plane twice.
+
+Planes are always returned in Lasagna orientation, i.e. with the same axis order that
+image_stack_loader.load_stack would produce for the file.
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PlaneCache(object):
+    """
+    Thread-safe least-recently-used cache of decoded planes.
+    max_bytes is the memory budget of the cache. At least one plane is always kept.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._planes = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Return the plane stored under key. If it is absent, call loader(key) to produce it
+        and store the result. The loader runs outside the lock, so different planes can be
+        decoded concurrently.
+        """
+        with self._lock:
+            if key in self._planes:
+                self._planes.move_to_end(key)
+                self.hits += 1
+                return self._planes[key]
+            self.misses += 1
+
+        plane = loader(key)
+
+        with self._lock:
+            if key not in self._planes:
+                self._planes[key] = plane
+                self._n_bytes += plane.nbytes
+            while self._n_bytes > self.max_bytes and len(self._planes) > 1:
+                _, dropped = self._planes.popitem(last=False)
+                self._n_bytes -= dropped.nbytes
+        return plane
+
+    def __contains__(self, key):
+        return key in self._planes
+
+    def clear(self):
+        with self._lock:
+            self._planes.clear()
+            self._n_bytes = 0
+
+
+def _is_integer(key):
+    return isinstance(key, (int, np.integer))
+
+
+class LazyStack(object):
+    """
+    Base class for lazily loaded stacks. Sub-classes implement read_plane(index), which
+    returns plane "index" along the first axis of the stack as a 2-D array.
+
+    Views produced by swapaxes and flip share the plane cache of the stack they came from.
+    Indexing a stack returns an ordinary numpy array holding just the requested region.
+    """
+
+    def __init__(self, shape, dtype, cache_bytes=512 * 2 ** 20):
+        if len(shape) != 3:
+            raise ValueError("Lazy stacks must be 3-D, got shape {}".format(shape))
+        self._shape = tuple(int(s) for s in shape)  # shape of the stack as stored
+        self.dtype = np.dtype(dtype)
+        self._axes = (0, 1, 2)  # stored axis shown along each axis of this view
+        self._flipped = (False, False, False)  # which stored axes are reversed
+        self._cache = PlaneCache(cache_bytes)
+
+    def read_plane(self, index):
+        """
+        Decode plane "index" along the first stored axis. Must be implemented by sub-classes.
+        """
+        raise NotImplementedError
+
+    def plane(self, index):
+        """
+        Return stored plane "index", decoding it only if it is not already cached
+        """
+        return self._cache.get(index, self.read_plane)
+
+    def prepare_planes(self, indices):
+        """
+        Called before the planes in indices are read one after the other. Sub-classes that can
+        decode planes concurrently override this to decode the missing ones in parallel.
+        """
+        pass
+
+    def is_cached(self, index):
+        return index in self._cache
+
+    def close(self):
+        """
+        Free the decoded planes and anything else the stack holds open, e.g. when its ingredient
+        is removed. Views made by swapaxes and flip share these and are closed too.
+        """
+        self._cache.clear()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    # ------------------------------------------------------------------
+    # numpy-like attributes
+    @property
+    def shape(self):
+        return tuple(self._shape[a] for a in self._axes)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return int(np.prod(self._shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def swapaxes(self, axis1, axis2):
+        """
+        Return a view of the stack with axis1 and axis2 swapped. No data are read.
+        """
+        axes = list(self._axes)
+        axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        view = copy.copy(self)
+        view._axes = tuple(axes)
+        return view
+
+    def flip(self, axis):
+        """
+        Return a view of the stack reversed along axis. No data are read.
+        """
+        flipped = list(self._flipped)
+        flipped[self._axes[axis]] = not flipped[self._axes[axis]]
+        view = copy.copy(self)
+        view._flipped = tuple(flipped)
+        return view
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        if len(key) > 3:
+            raise IndexError("too many indices for a 3-D stack")
+        key = key + (slice(None),) * (3 - len(key))
+
+        # Express the request in the order the data are stored
+        stored_key = [None, None, None]
+        for view_axis, k in enumerate(key):
+            stored_key[self._axes[view_axis]] = k
+        result = self._read_region(stored_key)
+
+        # Put the remaining axes back into the order of this view
+        kept_stored = [a for a in range(3) if not _is_integer(stored_key[a])]
+        kept_view = [self._axes[a] for a in range(3) if not _is_integer(key[a])]
+        if kept_stored != kept_view:
+            result = result.transpose([kept_stored.index(a) for a in kept_view])
+        return result
+
+    def _read_region(self, key):
+        """
+        Read the region defined by key, which is expressed in stored axis order
+        """
+        n_planes = self._shape[0]
+        flip_rows, flip_cols = self._flipped[1], self._flipped[2]
+
+        def read(index):
+            plane = self.plane(int(index))
+            if flip_rows:
+                plane = plane[::-1, :]
+            if flip_cols:
+                plane = plane[:, ::-1]
+            return plane[key[1], key[2]]
+
+        if _is_integer(key[0]):
+            index = int(key[0])
+            if index < -n_planes or index >= n_planes:
+                raise IndexError(
+                    "index {} is out of bounds for axis with size {}".format(index, n_planes)
+                )
+            index %= n_planes
+            if self._flipped[0]:
+                index = n_planes - 1 - index
+            return read(index)
+
+        indices = np.arange(n_planes)[key[0]]
+        if self._flipped[0]:
+            indices = n_planes - 1 - indices
+        self.prepare_planes(indices)
+
+        if len(indices) == 0:
+            # np.broadcast_to gives the shape of the in-plane region without allocating a plane
+            region = np.broadcast_to(np.zeros((), self.dtype), self._shape[1:])[key[1], key[2]]
+            return np.zeros((0,) + region.shape, dtype=self.dtype)
+
+        return np.stack([read(i) for i in indices])
+
+
+class LazyTiffStack(LazyStack):
+    """
+    A multi-page TIFF that is decoded one page at a time.
+    The page offsets are indexed when the file is opened, after which each page is decoded
+    only when it is first requested. Use LazyTiffStack.open to create one.
+    """
+
+    def __init__(self, tiff, n_pages, page_shape, dtype, cache_bytes=512 * 2 ** 20):
+        # Pages are (rows, cols) and Lasagna expects (layers, cols, rows)
+        super(LazyTiffStack, self).__init__(
+            (n_pages, page_shape[1], page_shape[0]), dtype, cache_bytes=cache_bytes
+        )
+        self.tiff = tiff
+        self.fname = tiff.filehandle.path
+        self._read_lock = threading.Lock()  # TiffFile shares one file handle between pages
+
+    @classmethod
+    def open(cls, fname, cache_bytes=512 * 2 ** 20):
+        """
+        Index the pages of the TIFF fname. Returns None if the file is not a stack
+        of identical 2-D pages, in which case the caller should read it in one go.
+        """
+        import tifffile
+
+        tiff = tifffile.TiffFile(fname)
+        pages = tiff.pages
+        pages.cache = True
+        n_pages = len(pages)  # walks the IFD chain once, storing the offset of every page
+        if n_pages < 2:
+            tiff.close()
+            return None
+
+        first = pages[0]
+        if tiff.is_imagej or tiff.is_shaped:
+            series = tiff.series[0]  # Its shape comes from the metadata
+            uniform = len(series.shape) == 3 and series.shape[0] == n_pages
+        else:
+            # Finding the series of other files parses every page. Stacks are written page by page,
+            # so the second and last pages are enough to tell whether all pages are alike.
+            uniform = all(
+                pages[i].shape == first.shape and pages[i].dtype == first.dtype for i in (1, n_pages - 1)
+            )
+        if len(first.shape) != 2 or not uniform:
+            tiff.close()
+            return None
+
+        # Pages after the first are read as light-weight frames that share the tags of page 0
+        pages.useframes = True
+        try:
+            pages.set_keyframe(0)
+        except AttributeError:
+            pages.keyframe = 0
+
+        return cls(tiff, n_pages, first.shape, first.dtype, cache_bytes=cache_bytes)
+
+    def read_plane(self, index):
+        with self._read_lock:
+            page = self.tiff.pages[index].asarray()
+        return page.T
+
+    def close(self):
+        self._cache.clear()
+        self.tiff.close()
+
+
+class SliceDirectoryStack(LazyStack):
+    """
+    A stack assembled from a list of 2-D image files, one file per plane, such as the one TIFF
+    per physical section written by serial-section imaging rigs. Use SliceDirectoryStack.open
+    to create one. Planes are decoded on demand. Each time a plane is requested, the planes that
+    follow it (and, to a lesser extent, those before it) are decoded in the background by a pool
+    of threads, so that scrolling through the stack rarely waits for a file to be decoded.
+    """
+
+    def __init__(self, fnames, page_shape, dtype, cache_bytes=512 * 2 ** 20, max_workers=None,
+                 prefetch_ahead=4, prefetch_behind=2):
+        # Files are (rows, cols) and Lasagna expects (layers, cols, rows)
+        super(SliceDirectoryStack, self).__init__(
+            (len(fnames), page_shape[1], page_shape[0]), dtype, cache_bytes=cache_bytes
+        )
+        from lasagna.utils import loader_pool
+
+        self.fnames = list(fnames)
+        self.page_shape = tuple(page_shape)
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self._pool = loader_pool.thread_pool(max_workers)
+        self._pending = dict()  # plane index -> future of a background decode
+        self._pending_lock = threading.Lock()
+        self._closed = threading.Event()  # An object, so that views share it
+
+    @classmethod
+    def open(cls, fnames, cache_bytes=512 * 2 ** 20, max_workers=None):
+        """
+        Make a stack from the list of TIFF files fnames, which must be in plane order.
+        Only the header of the first file is read. Returns None if fnames is empty.
+        """
+        import tifffile
+
+        if not fnames:
+            return None
+        with tifffile.TiffFile(fnames[0]) as tiff:
+            page = tiff.pages[0]
+            page_shape = page.shape
+            dtype = page.dtype
+        if len(page_shape) != 2:
+            print("Slices must be 2-D images. {} has shape {}".format(fnames[0], page_shape))
+            return None
+        return cls(fnames, page_shape, dtype, cache_bytes=cache_bytes, max_workers=max_workers)
+
+    def read_plane(self, index):
+        import tifffile
+
+        page = tifffile.imread(self.fnames[index], key=0)
+        if page.shape != self.page_shape:
+            # One bad section should not stop the rest of the stack from being viewed
+            print(
+                "Slice {} has shape {} rather than {}. Showing it as blank.".format(
+                    self.fnames[index], page.shape, self.page_shape
+                )
+            )
+            page = np.zeros(self.page_shape, dtype=self.dtype)
+        return page.astype(self.dtype, copy=False).T
+
+    def plane(self, index):
+        with self._pending_lock:
+            future = self._pending.get(index)
+        if future is not None:
+            future.result()  # Already being decoded in the background. Wait for it.
+        plane = super(SliceDirectoryStack, self).plane(index)
+        self.prefetch(index)
+        return plane
+
+    def prefetch(self, index):
+        """
+        Decode the planes around index in the background, nearest first and those ahead of it first
+        """
+        n_planes = self._shape[0]
+        ahead = [index + i for i in range(1, self.prefetch_ahead + 1)]
+        behind = [index - i for i in range(1, self.prefetch_behind + 1)]
+        for neighbour in ahead + behind:
+            if 0 <= neighbour < n_planes:
+                self._submit(neighbour)
+
+    def prepare_planes(self, indices):
+        """
+        Decode all of the missing planes in indices concurrently and wait for them
+        """
+        futures = [self._submit(int(index)) for index in indices]
+        for future in futures:
+            if future is not None:
+                future.result()
+
+    def _submit(self, index):
+        """
+        Start decoding plane index in the background unless it is cached or already being decoded.
+        Returns the future of the decode, or None if the plane is already cached or the stack is
+        closed, in which case planes are only decoded when they are read.
+        """
+        if self.is_cached(index):
+            return None
+        with self._pending_lock:
+            if self._closed.is_set():
+                return None
+            if index not in self._pending:
+                self._pending[index] = self._pool.submit(self._decode_in_background, index)
+            return self._pending[index]
+
+    def _decode_in_background(self, index):
+        try:
+            self._cache.get(index, self.read_plane)
+        finally:
+            with self._pending_lock:
+                self._pending.pop(index, None)
+
+    def close(self):
+        with self._pending_lock:
+            self._closed.set()
+            for future in self._pending.values():
+                future.cancel()  # Planes still waiting to be decoded. Those being decoded finish.
+            self._pending.clear()
+        self._pool.shutdown(wait=False)
+        self._cache.clear()
@@ -0,0 +1,177 @@
+"""
+Tests of the stack readers and writers in image_stack_loader. They need numpy and tifffile
+but no GUI. Run with:
+    python -m pytest lasagna/io_libs
+"""
+
+import numpy as np
+import pytest
+
+from lasagna.io_libs import image_stack_loader
+
+# Preferences are passed explicitly so that the tests neither read nor write the user's preferences
+NO_CACHE = dict(volume_cache_bytes=0, plane_cache_bytes=0)
+
+
+@pytest.fixture
+def stack():
+    """
+    A small stack in Lasagna order with a different size along each axis
+    """
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 4000, (6, 7, 5)).astype(np.uint16)
+
+
+@pytest.mark.parametrize("fmt", ["tif", "mhd", "nrrd"])
+def test_save_stack_round_trip(tmp_path, stack, fmt):
+    fname = str(tmp_path / ("stack." + fmt))
+    image_stack_loader.save_stack(fname, stack)
+    loaded = image_stack_loader.load_stack(fname, **NO_CACHE)
+    assert loaded.dtype == stack.dtype
+    np.testing.assert_array_equal(np.asarray(loaded), stack)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.uint16, np.float32])
+def test_mhd_keeps_native_dtype(tmp_path, stack, dtype):
+    data = stack.astype(dtype)
+    fname = str(tmp_path / "stack.mhd")
+    image_stack_loader.save_stack(fname, data)
+    loaded = image_stack_loader.load_stack(fname, **NO_CACHE)
+    assert loaded.dtype == np.dtype(dtype)
+    assert isinstance(loaded, np.memmap)  # Raw MHD data are memory-mapped, not read
+    np.testing.assert_array_equal(loaded, data)
+
+
+@pytest.mark.parametrize("fmt", ["tif", "mhd", "nrrd"])
+def test_probe_describes_stack(tmp_path, stack, fmt):
+    fname = str(tmp_path / ("stack." + fmt))
+    image_stack_loader.save_stack(fname, stack)
+    info = image_stack_loader.probe_stack(fname)
+    assert tuple(info["shape"]) == stack.shape
+    assert info["dtype"].newbyteorder("=") == stack.dtype
+
+
+def test_probe_finds_contiguous_tiff_pages(tmp_path, stack):
+    import tifffile
+
+    plain = str(tmp_path / "plain.tif")
+    compressed = str(tmp_path / "compressed.tif")
+    file_order = stack.transpose(0, 2, 1)  # TIFF pages are (rows, cols)
+    tifffile.imwrite(plain, file_order, photometric="minisblack", metadata=None)
+    tifffile.imwrite(compressed, file_order, photometric="minisblack", compression="zlib")
+
+    info = image_stack_loader.probe_stack(plain)
+    assert info["data_offset"] is not None
+    assert info["compression"] is None
+    assert info["file_shape"] == file_order.shape
+
+    info = image_stack_loader.probe_stack(compressed)
+    assert info["data_offset"] is None
+    assert info["compression"] is not None
+    assert image_stack_loader.decode_is_cpu_bound(compressed)
+
+
+def test_probe_of_missing_file_is_none(tmp_path):
+    assert image_stack_loader.probe_stack(str(tmp_path / "missing.tif")) is None
+
+
+@pytest.mark.parametrize("fmt", ["tif", "mhd", "nrrd"])
+def test_read_subvolume_strided(tmp_path, stack, fmt):
+    fname = str(tmp_path / ("stack." + fmt))
+    image_stack_loader.save_stack(fname, stack)
+    roi = ((1, 5), (None, None), (2, None))
+    step = (2, 3, 1)
+    sub = image_stack_loader.read_subvolume(fname, roi=roi, step=step, volume_cache_bytes=0)
+    np.testing.assert_array_equal(sub, stack[1:5:2, ::3, 2::1])
+
+
+@pytest.mark.parametrize("fmt", ["tif", "nrrd"])
+def test_read_subvolume_block_mean(tmp_path, stack, fmt):
+    fname = str(tmp_path / ("stack." + fmt))
+    image_stack_loader.save_stack(fname, stack)
+    sub = image_stack_loader.read_subvolume(fname, step=2, block_mean=True, volume_cache_bytes=0)
+
+    # Incomplete blocks at the end of each axis are dropped
+    blocks = stack[:6, :6, :4].astype(float).reshape(3, 2, 3, 2, 2, 2).mean(axis=(1, 3, 5))
+    assert sub.dtype == stack.dtype
+    np.testing.assert_array_equal(sub, np.rint(blocks))
+
+
+def test_read_subvolume_reports_progress(tmp_path, stack):
+    fname = str(tmp_path / "stack.nrrd")
+    image_stack_loader.save_stack(fname, stack)
+    reports = []
+    image_stack_loader.read_subvolume(fname, step=2, progress=reports.append, volume_cache_bytes=0)
+    assert reports == sorted(reports)
+    assert reports[-1] == 1
+
+
+def test_read_subvolume_can_be_stopped_by_progress(tmp_path, stack):
+    fname = str(tmp_path / "stack.nrrd")
+    image_stack_loader.save_stack(fname, stack)
+
+    def progress(fraction):
+        if fraction > 0.5:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        image_stack_loader.read_subvolume(fname, step=2, progress=progress, volume_cache_bytes=0)
+
+
+def test_load_stack_with_step_reads_subvolume(tmp_path, stack):
+    fname = str(tmp_path / "stack.tif")
+    image_stack_loader.save_stack(fname, stack)
+    sub = image_stack_loader.load_stack(fname, step=2, **NO_CACHE)
+    np.testing.assert_array_equal(sub, stack[::2, ::2, ::2])
+
+
+def test_lazy_tiff_matches_full_read(tmp_path, stack):
+    from lasagna.io_libs.lazy_stack import LazyStack
+
+    fname = str(tmp_path / "stack.tif")
+    image_stack_loader.save_stack(fname, stack)
+    lazy = image_stack_loader.load_stack(fname, lazy=True, volume_cache_bytes=0, plane_cache_bytes=2 ** 20)
+    assert isinstance(lazy, LazyStack)
+    try:
+        assert lazy.shape == stack.shape
+        np.testing.assert_array_equal(lazy[2], stack[2])
+        np.testing.assert_array_equal(np.asarray(lazy), stack)
+    finally:
+        lazy.close()
+
+
+def test_slice_directory(tmp_path, stack):
+    import tifffile
+
+    for i, plane in enumerate(stack):
+        tifffile.imwrite(str(tmp_path / "section_{}.tif".format(i + 1)), plane.T)
+    fname = str(tmp_path)
+    assert image_stack_loader.is_slice_set(fname)
+    assert tuple(image_stack_loader.probe_stack(fname)["shape"]) == stack.shape
+
+    lazy = image_stack_loader.load_stack(fname, lazy=True, volume_cache_bytes=0, plane_cache_bytes=2 ** 20)
+    try:
+        np.testing.assert_array_equal(np.asarray(lazy), stack)
+    finally:
+        lazy.close()
+
+
+def test_closed_slice_directory_stops_decoding_in_background(tmp_path, stack):
+    import tifffile
+
+    for i, plane in enumerate(stack):
+        tifffile.imwrite(str(tmp_path / "section_{}.tif".format(i + 1)), plane.T)
+    lazy = image_stack_loader.load_stack(str(tmp_path), lazy=True, volume_cache_bytes=0, plane_cache_bytes=2 ** 20)
+    view = lazy.swapaxes(1, 2)
+    lazy.close()
+    assert lazy._pool._shutdown
+    np.testing.assert_array_equal(view[2], stack[2].T)  # Planes are still read, just not ahead
+    assert not lazy._pending
+
+
+def test_slice_files_sort_naturally(tmp_path):
+    for i in (1, 2, 10):
+        (tmp_path / "section_{}.tif".format(i)).write_bytes(b"")
+    names = [f.rsplit("_", 1)[-1] for f in image_stack_loader.slice_files(str(tmp_path))]
+    assert names == ["1.tif", "2.tif", "10.tif"]
+
@@ -0,0 +1,125 @@
+"""
+Tests of the lazy stacks and their plane cache. Run with:
+    python -m pytest lasagna/io_libs
+"""
+
+import numpy as np
+import pytest
+
+from lasagna.io_libs.lazy_stack import LazyStack, PlaneCache
+
+
+class ArrayStack(LazyStack):
+    """
+    A lazy stack backed by an array, which counts the planes it decodes
+    """
+
+    def __init__(self, data, cache_bytes=2 ** 20):
+        super(ArrayStack, self).__init__(data.shape, data.dtype, cache_bytes=cache_bytes)
+        self.data = data
+        self.reads = []
+
+    def read_plane(self, index):
+        self.reads.append(index)
+        return self.data[index].copy()
+
+
+@pytest.fixture
+def data():
+    return np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6)
+
+
+KEYS = [
+    (1,),
+    (-1,),
+    (slice(None), 2),
+    (slice(None), slice(None), 3),
+    (slice(1, 3), slice(None, None, 2), slice(4, 0, -1)),
+    (Ellipsis, 2),
+    (2, Ellipsis),
+    (slice(None, None, -1),),
+    (slice(3, 3),),
+]
+
+
+@pytest.mark.parametrize("key", KEYS)
+def test_getitem_matches_numpy(data, key):
+    np.testing.assert_array_equal(ArrayStack(data)[key], data[key])
+
+
+@pytest.mark.parametrize("key", KEYS)
+@pytest.mark.parametrize("axes", [(0, 1), (0, 2), (1, 2)])
+def test_swapaxes_matches_numpy(data, key, axes):
+    lazy = ArrayStack(data).swapaxes(*axes)
+    expected = data.swapaxes(*axes)
+    assert lazy.shape == expected.shape
+    np.testing.assert_array_equal(lazy[key], expected[key])
+
+
+@pytest.mark.parametrize("key", KEYS)
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_flip_matches_numpy(data, key, axis):
+    np.testing.assert_array_equal(ArrayStack(data).flip(axis)[key], np.flip(data, axis)[key])
+
+
+def test_flip_of_swapped_view(data):
+    lazy = ArrayStack(data).swapaxes(0, 2).flip(0).swapaxes(1, 2).flip(2)
+    expected = np.flip(np.flip(data.swapaxes(0, 2), 0).swapaxes(1, 2), 2)
+    np.testing.assert_array_equal(np.asarray(lazy), expected)
+
+
+def test_views_share_decoded_planes(data):
+    lazy = ArrayStack(data)
+    lazy[1]
+    lazy.swapaxes(0, 1)[:, 1]  # The same stored plane, seen along another axis
+    lazy.flip(1)[1]
+    assert lazy.reads == [1]
+
+
+def test_out_of_range_plane(data):
+    with pytest.raises(IndexError):
+        ArrayStack(data)[4]
+    with pytest.raises(IndexError):
+        ArrayStack(data)[1, 2, 3, 4]
+
+
+def test_numpy_like_attributes(data):
+    lazy = ArrayStack(data)
+    assert (lazy.ndim, lazy.size, lazy.nbytes, len(lazy)) == (3, data.size, data.nbytes, 4)
+    assert np.asarray(lazy, dtype=float).dtype == float
+    with pytest.raises(ValueError):
+        ArrayStack(data[0])
+
+
+def test_plane_cache_evicts_least_recently_used():
+    plane = np.zeros(10, dtype=np.uint8)
+    cache = PlaneCache(max_bytes=3 * plane.nbytes)
+    loads = []
+
+    def loader(key):
+        loads.append(key)
+        return plane.copy()
+
+    for key in (0, 1, 2):
+        cache.get(key, loader)
+    cache.get(0, loader)  # 1 is now the least recently used
+    cache.get(3, loader)
+    assert 1 not in cache
+    assert all(key in cache for key in (0, 2, 3))
+    assert loads == [0, 1, 2, 3]
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_plane_cache_keeps_one_plane_over_budget():
+    cache = PlaneCache(max_bytes=1)
+    cache.get(0, lambda key: np.zeros(100))
+    cache.get(1, lambda key: np.zeros(100))
+    assert 0 not in cache
+    assert 1 in cache
+
+
+def test_plane_cache_clear():
+    cache = PlaneCache()
+    cache.get(0, lambda key: np.zeros(10))
+    cache.clear()
+    assert 0 not in cache
@@ -0,0 +1,98 @@
+"""
+Tests of the decoded-volume cache. The cache is kept in a temporary directory and its size is
+passed explicitly, so the user's cache and preferences are not touched. Run with:
+    python -m pytest lasagna/io_libs
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from lasagna.io_libs import volume_cache
+
+MB = 2 ** 20
+
+
+@pytest.fixture(autouse=True)
+def cache_in_tmp(tmp_path, monkeypatch):
+    monkeypatch.setattr(volume_cache, "get_lasagna_pref_dir", lambda: str(tmp_path / "prefs"))
+
+
+def source_file(tmp_path, name, contents=b"compressed stack"):
+    path = tmp_path / name
+    path.write_bytes(contents)
+    return str(path)
+
+
+def test_store_and_load(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    data = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+    assert not volume_cache.is_cached(fname, max_bytes=MB)
+    assert volume_cache.store(fname, data, max_bytes=MB)
+    assert volume_cache.is_cached(fname, max_bytes=MB)
+
+    cached = volume_cache.load(fname, max_bytes=MB)
+    assert cached.dtype == data.dtype
+    np.testing.assert_array_equal(cached, data)
+
+    cached[0, 0, 0] = 100  # Copy on write: the cache entry is not altered
+    np.testing.assert_array_equal(volume_cache.load(fname, max_bytes=MB), data)
+
+
+def test_disabled_cache(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    assert not volume_cache.is_enabled(0)
+    assert not volume_cache.store(fname, np.zeros(10), max_bytes=0)
+    assert volume_cache.load(fname, max_bytes=0) is None
+
+
+def test_variants_are_separate(tmp_path):
+    fname = source_file(tmp_path, "a.lsm")
+    volume_cache.store(fname, np.zeros(4), max_bytes=MB)
+    assert not volume_cache.is_cached(fname, variant="lsm", max_bytes=MB)
+
+
+def test_changed_file_is_not_found(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    volume_cache.store(fname, np.zeros(4), max_bytes=MB)
+    source_file(tmp_path, "a.tif", b"a different compressed stack")
+    assert volume_cache.load(fname, max_bytes=MB) is None
+
+
+def test_volume_larger_than_cache_is_not_stored(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    assert not volume_cache.store(fname, np.zeros(MB, dtype=np.uint8), max_bytes=MB // 2)
+    assert not volume_cache.is_cached(fname, max_bytes=MB)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    data = np.zeros(MB // 5, dtype=np.uint8)
+    fnames = [source_file(tmp_path, "{}.tif".format(i)) for i in range(4)]
+    for age, fname in enumerate(fnames[:3]):
+        volume_cache.store(fname, data, max_bytes=MB)
+        # Entries record their last use in the modification time. Space them out.
+        os.utime(volume_cache.entry_path(fname), (1000 + age, 1000 + age))
+
+    volume_cache.load(fnames[0], max_bytes=MB)  # The oldest entry is now the most recently used
+    volume_cache.store(fnames[3], np.zeros(MB // 2, dtype=np.uint8), max_bytes=MB)
+
+    cached = [volume_cache.is_cached(fname, max_bytes=MB) for fname in fnames]
+    assert cached == [True, False, True, True]
+    assert sum(size for _, size, _ in volume_cache.entries()) <= MB
+
+
+def test_unreadable_entry_is_removed(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    volume_cache.store(fname, np.zeros(4), max_bytes=MB)
+    with open(volume_cache.entry_path(fname), "wb") as fid:
+        fid.write(b"not a numpy file")
+    assert volume_cache.load(fname, max_bytes=MB) is None
+    assert not volume_cache.is_cached(fname, max_bytes=MB)
+
+
+def test_clear(tmp_path):
+    fname = source_file(tmp_path, "a.tif")
+    volume_cache.store(fname, np.zeros(4), max_bytes=MB)
+    volume_cache.clear()
+    assert volume_cache.entries() == []
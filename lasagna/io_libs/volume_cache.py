@@ -0,0 +1,169 @@
+"""
+On-disk cache of decoded image stacks
+
+Decoding compressed stacks (zlib TIFF, gzip NRRD, LSM, etc) is slow and has to be repeated every
+time the file is opened. The first time such a stack is read, the decoded volume is saved as a
+.npy file in ~/.lasagna/cache. Later reads memory-map the .npy file instead, so re-opening the
+stack is almost instant and its voxels are only paged in from disk as they are displayed.
+
+Entries are keyed by the absolute path, size and modification time of the source file, so an
+edited file is decoded again. The total size of the cache is capped by the "volumeCacheMB"
+preference (0 disables the cache). When the cap is reached the least recently used entries are
+deleted.
+
+readPreference may rewrite the preferences file, so it must not be called from loader threads
+or processes. The functions below take the cap as max_bytes. Read it with max_cache_bytes on
+the GUI thread and pass it to workers. max_bytes=None reads the preference, which is only
+safe on the GUI thread.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from lasagna.utils import preferences
+from lasagna.utils.pref_utils import get_lasagna_pref_dir
+
+# Change this if the orientation or content of stored volumes changes, so old entries are not used
+CACHE_VERSION = "1"
+
+
+def cache_dir():
+    """
+    Return the cache directory, creating it if needed
+    """
+    path = os.path.join(get_lasagna_pref_dir(), "cache")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def max_cache_bytes():
+    """
+    Return the size cap of the cache from the "volumeCacheMB" preference. Call this on the GUI thread.
+    """
+    return int(preferences.readPreference("volumeCacheMB") or 0) * 2 ** 20
+
+
+def is_enabled(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_cache_bytes()
+    return max_bytes > 0
+
+
+def cache_key(fname, variant=""):
+    """
+    Return the key of the cache entry for fname. variant distinguishes different decodings
+    of the same file (e.g. the LSM loader, which keeps all channels).
+    """
+    stat = os.stat(fname)
+    identity = "|".join(
+        [CACHE_VERSION, os.path.abspath(fname), str(stat.st_size), str(stat.st_mtime_ns), variant]
+    )
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def entry_path(fname, variant=""):
+    return os.path.join(cache_dir(), cache_key(fname, variant) + ".npy")
+
+
+def is_cached(fname, variant="", max_bytes=None):
+    """
+    Returns True if a decoded copy of fname is in the cache
+    """
+    if not is_enabled(max_bytes) or not os.path.exists(fname):
+        return False
+    return os.path.exists(entry_path(fname, variant))
+
+
+def load(fname, variant="", max_bytes=None):
+    """
+    Return the cached copy of fname as a copy-on-write memory map, or None if there isn't one.
+    The array can be modified in RAM without altering the cache.
+    """
+    if not is_cached(fname, variant, max_bytes):
+        return None
+
+    path = entry_path(fname, variant)
+    try:
+        data = np.load(path, mmap_mode="c")
+    except (IOError, OSError, ValueError) as err:
+        print("Removing unreadable cache entry {}: {}".format(path, err))
+        remove_entry(path)
+        return None
+
+    os.utime(path)  # The modification time records when the entry was last used
+    print("Mapped cached copy of {}".format(fname))
+    return data
+
+
+def store(fname, data, variant="", max_bytes=None):
+    """
+    Save the decoded volume data of fname to the cache, evicting the least recently used
+    entries if needed. Volumes larger than the whole cache (max_bytes) are not stored.
+    Returns True if the volume was stored.
+    """
+    if max_bytes is None:
+        max_bytes = max_cache_bytes()
+    data = np.asarray(data)
+    if max_bytes <= 0 or data.nbytes > max_bytes:
+        return False
+
+    evict(max_bytes - data.nbytes)
+
+    path = entry_path(fname, variant)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as fid:
+            np.save(fid, data)
+        os.replace(tmp_path, path)  # Readers never see a half-written entry
+    except (IOError, OSError) as err:
+        print("Failed to add {} to the volume cache: {}".format(fname, err))
+        remove_entry(tmp_path)
+        return False
+    return True
+
+
+def entries():
+    """
+    Return a list of (path, size in bytes, last use time) for every entry, least recently used first
+    """
+    found = []
+    for name in os.listdir(cache_dir()):
+        if not name.endswith(".npy"):
+            continue
+        path = os.path.join(cache_dir(), name)
+        try:
+            stat = os.stat(path)
+        except OSError:  # Deleted by another Lasagna
+            continue
+        found.append((path, stat.st_size, stat.st_mtime))
+    return sorted(found, key=lambda entry: entry[2])
+
+
+def evict(max_bytes):
+    """
+    Delete least recently used entries until the cache holds at most max_bytes
+    """
+    cached = entries()
+    total = sum(size for _, size, _ in cached)
+    for path, size, _ in cached:
+        if total <= max_bytes:
+            break
+        remove_entry(path)
+        total -= size
+
+
+def clear():
+    """
+    Delete every entry in the cache
+    """
+    evict(0)
+
+
+def remove_entry(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -2,12 +2,16 @@
 this file describes a class that handles the axis behavior for the lasagna viewer
 """
 
+import numpy as np
 import pyqtgraph as pg
+from PyQt5 import QtCore
 
 
 from lasagna.ingredients.imagestack import imagestack as lasagna_imagestack
-from lasagna.utils.lasagna_qt_helper_functions import find_pyqt_graph_object_name_in_plot_widget
+from lasagna.ingredients.sparsepoints import sparsepoints as lasagna_sparsepoints
 from lasagna.utils import preferences
+from lasagna.utils.stack_compositor import StackCompositor
+from lasagna.utils.cursor_overlay import CursorOverlay
 
 
 class projection2D():
@@ -41,15 +45,50 @@ class projection2D():
 
         # Loop through the ingredients list and add them to the ViewBox
         self.lasagna = lasagna_serving
-        self.items = []  # a list of added plot items TODO: check if we really need this
+        self.itemsByName = {}  # objectName -> the plot item showing that ingredient [see getPlotItemByName]
         self.addItemsToPlotWidget(self.lasagna.ingredientList)
 
         # The currently plotted slice
         self.currentSlice = None
 
+        # The in-plane downsampling of the image pyramid level currently shown (see pyramidFactor)
+        self.currentPyramidFactor = 1
+
+        # Only the part of large planes in view, plus a margin, is drawn (see visibleRegion)
+        self.clipToViewport = preferences.readPreference('clipToViewport')
+        self.tileSize = preferences.readPreference('renderTileSize')
+        self.currentRegion = None
+
+        # While the user drags, zooms or scrolls through slices the axis is drawn coarsely: image stacks
+        # at a lower resolution and dense point layers with fewer points. Full resolution is restored
+        # once the user has been idle for refineDelayMs (see beginInteraction)
+        self.interacting = False
+        self.drawnCoarse = False
+        self.interactionDownsample = max(1, preferences.readPreference('interactionDownsample'))
+        self.interactionMaxPoints = preferences.readPreference('interactionMaxPoints')
+        self.refineTimer = QtCore.QTimer()
+        self.refineTimer.setSingleShot(True)
+        self.refineTimer.setInterval(preferences.readPreference('refineDelayMs'))
+        self.refineTimer.timeout.connect(self.refine)
+
         # Link the progressLayer signal to a slot that will move through image layers as the wheel is turned
         self.view.getViewBox().progressLayer.connect(self.wheel_layer_slot)
 
+        # Zooming may require a different level of the image pyramid
+        self.view.getViewBox().sigRangeChanged.connect(self.viewRangeChanged_slot)
+
+        # Only panning and zooming by the user is drawn coarsely. Programmatic range changes are drawn at full resolution
+        self.view.getViewBox().userInteraction.connect(self.userInteraction_slot)
+
+        # Optionally blend all image stacks into a single image with numpy [see stack_compositor]
+        if preferences.readPreference('compositeStacks'):
+            self.compositor = StackCompositor(self)
+        else:
+            self.compositor = None
+
+        # Cross hairs and other decorations that follow the mouse [see cursor_overlay]
+        self.cursorOverlay = CursorOverlay(self)
+
     def addItemToPlotWidget(self, ingredient):
         """
         Adds an ingredient to the PlotWidget as an item (i.e. the ingredient manages the process of 
@@ -63,8 +102,13 @@ class projection2D():
         if verbose:
             print("\nlasagna_axis.addItemToPlotWidget adds item " + ingredient.objectName + " as: " + str(_item))
 
+        # Names are unique, as in the ingredient registry: an item added under a name in use replaces the old one
+        old_item = self.itemsByName.get(_item.objectName)
+        if old_item is not None:
+            self.view.removeItem(old_item)
+
         self.view.addItem(_item)
-        self.items.append(_item)
+        self.itemsByName[_item.objectName] = _item
 
     def removeItemFromPlotWidget(self, item):
         """
@@ -75,32 +119,19 @@ class projection2D():
 
         "item" is either a string defining an objectName or the object itself
         """
-        items = list(self.view.items())
-        n_items_before = len(items)  # to determine if an item was removed
         if isinstance(item, str):
-            removed = False
-            for this_item in items:
-                if hasattr(this_item, 'objectName') and this_item.objectName == item:
-                        self.view.removeItem(this_item)
-                        removed = True
-            if not removed:
+            this_item = self.itemsByName.pop(item, None)
+            if this_item is None:
                 print("lasagna_axis.removeItemFromPlotWidget failed to remove item defined by string " + item)
-        else:  # it should be an image item
-            self.view.removeItem(item)
-
-        # Optionally return True of False depending on whether the removal was successful
-        n_items_after = len(list(self.view.items()))
+                return False
+            item = this_item
+        elif self.itemsByName.get(getattr(item, 'objectName', None)) is item:  # the plot item itself
+            del self.itemsByName[item.objectName]
 
-        if n_items_after < n_items_before:
-            return True
-        elif n_items_after == n_items_before:
-            return False
-        else:
-            print('** removeItemFromPlotWidget: %d items before removal and %d after removal **' % (n_items_before,
-                                                                                                    n_items_after))
-            return False
-
-        print("%d items after remove call" % len(list(self.view.items())))  # FIXME: unreachable code
+        # Return True of False depending on whether the removal was successful
+        removed = item in self.view.getPlotItem().items
+        self.view.removeItem(item)
+        return removed
 
     def addItemsToPlotWidget(self, ingredients):
         """
@@ -134,8 +165,14 @@ class projection2D():
         """
         returns the first plot item in the list bearing the objectName 'objName'
         because of the way we generally add objects, there *should* never be 
-        multiple objects with the same name
+        multiple objects with the same name.
+        Ingredients are looked up in itemsByName. Other named items, such as those of
+        the cursor overlay, are searched for in the PlotWidget.
         """
+        item = self.itemsByName.get(objName)
+        if item is not None:
+            return item
+
         for item in list(self.view.items()):
             if hasattr(item, 'objectName') and isinstance(item.objectName, str):
                 if item.objectName == objName:
@@ -162,6 +199,95 @@ class projection2D():
         print("NEED TO WRITE lasagna.axis.hideItem()")
         return
 
+    def pyramidFactor(self):
+        """
+        Returns the downsampling factor (1, 2, 4, 8...) of the coarsest image pyramid level that
+        still provides at least one data pixel for every screen pixel of the view.
+        """
+        view_box = self.view.getViewBox()
+        width, height = view_box.width(), view_box.height()
+        if width <= 0 or height <= 0:
+            return 1
+
+        x_range, y_range = view_box.viewRange()
+        data_pixels_per_screen_pixel = min((x_range[1] - x_range[0]) / width,
+                                           (y_range[1] - y_range[0]) / height)
+        if data_pixels_per_screen_pixel < 2:
+            return 1
+        return 2 ** int(np.log2(data_pixels_per_screen_pixel))
+
+    def targetPyramidFactor(self):
+        """
+        Returns the pyramid level to draw: the one suited to the zoom, made coarser while the user interacts
+        """
+        pyramid_factor = self.pyramidFactor()
+        if self.interacting:
+            pyramid_factor *= self.interactionDownsample
+        return pyramid_factor
+
+    def beginInteraction(self):
+        """
+        Draw coarsely until the user has been idle for the refine delay, then draw at full resolution
+        """
+        if self.interactionDownsample == 1 and not self.interactionMaxPoints:
+            return  # Coarse drawing is switched off
+        self.interacting = True
+        self.refineTimer.start()  # Restarts the countdown if it is already running
+
+    def refine(self):
+        """
+        Re-draw at full resolution whatever was drawn coarsely while the user interacted
+        """
+        self.interacting = False
+        if self.drawnCoarse and self.currentSlice is not None:
+            self.lasagna.requestRedraw(axes=[self.axisIndex()], properties=["resolution"])
+
+    def axisIndex(self):
+        """
+        Returns the index of this axis in lasagna.axes2D, by which redraws of it are requested
+        """
+        return self.lasagna.axes2D.index(self)
+
+    def visibleRegion(self, pyramidFactor=1):
+        """
+        Returns the part of the image planes to draw, ((x0, x1), (y0, y1)) in data coordinates, or
+        None if planes are drawn whole. This is the view range plus a margin of one tile, snapped
+        outwards to a grid of tiles (tileSize pixels at the current pyramid level). The region
+        therefore only changes when a new tile comes into view, and tiles rendered earlier are
+        re-used while panning.
+        """
+        if not self.clipToViewport:
+            return None
+
+        span = self.tileSize * pyramidFactor
+        x_range, y_range = self.view.getViewBox().viewRange()
+
+        def snap(low, high):
+            low = max(0, int(np.floor(low / span)) - 1) * span
+            high = max(low + span, (int(np.ceil(high / span)) + 1) * span)
+            return low, high
+
+        return snap(*x_range), snap(*y_range)
+
+    def regionNeedsRedraw(self, pyramidFactor):
+        """
+        Returns True if the view has moved outside the region drawn, or has shrunk so much that
+        drawing a smaller region would be worthwhile
+        """
+        region = self.visibleRegion(pyramidFactor)
+        if region == self.currentRegion:
+            return False
+        if region is None or self.currentRegion is None:
+            return True
+
+        def area(r):
+            return (r[0][1] - r[0][0]) * (r[1][1] - r[1][0])
+
+        (x0, x1), (y0, y1) = region
+        (cx0, cx1), (cy0, cy1) = self.currentRegion
+        inside = cx0 <= x0 and x1 <= cx1 and cy0 <= y0 and y1 <= cy1
+        return not inside or 4 * area(region) < area(self.currentRegion)
+
     def updatePlotItems_2D(self, ingredientsList, sliceToPlot=None, resetToMiddleLayer=False):
         """
         Update all plot items on axis, redrawing so everything associated with a specified 
@@ -169,6 +295,10 @@ class projection2D():
         """
         verbose = False
 
+        self.currentPyramidFactor = self.targetPyramidFactor()
+        self.currentRegion = self.visibleRegion(self.currentPyramidFactor)
+        self.drawnCoarse = self.interacting
+
         # loop through all plot items searching for imagestack items (these need to be plotted first)
         for ingredient in ingredientsList:
             if isinstance(ingredient, lasagna_imagestack):
@@ -188,18 +318,26 @@ class projection2D():
 
                 self.currentSlice = sliceToPlot
 
+                if self.compositor is not None:
+                    continue  # All stacks are drawn together below
+
                 if verbose:
                     print("lasagna_axis.updatePlotItems_2D - plotting ingredient " + ingredient.objectName)
 
                 ingredient.plotIngredient(
-                    pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
-                                                                          ingredient.objectName,
-                                                                          verbose=verbose),
+                    pyqtObject=self.itemsByName.get(ingredient.objectName, False),
                     axisToPlot=self.axisToPlot,
-                    sliceToPlot=self.currentSlice
+                    sliceToPlot=self.currentSlice,
+                    pyramidFactor=self.currentPyramidFactor,
+                    region=self.currentRegion
                 )
                 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
 
+        if self.compositor is not None and any(isinstance(i, lasagna_imagestack) for i in ingredientsList):
+            # Unchanged stacks are not coloured again, so the blend includes every stack
+            self.compositor.draw(self.lasagna.returnIngredientByType('imagestack'),
+                                 self.currentSlice, self.currentPyramidFactor, self.currentRegion)
+
         # the image is now displayed
 
         # loop through all plot items searching for non-image items (these need to be overlaid on top of the image)
@@ -208,12 +346,15 @@ class projection2D():
                 if verbose:
                     print("lasagna_axis.updatePlotItems_2D - plotting ingredient " + ingredient.objectName)
 
+                plot_args = {}
+                if isinstance(ingredient, lasagna_sparsepoints) and self.interacting:
+                    plot_args['maxPoints'] = self.interactionMaxPoints
+
                 ingredient.plotIngredient(
-                    pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
-                                                                          ingredient.objectName,
-                                                                          verbose=verbose),
+                    pyqtObject=self.itemsByName.get(ingredient.objectName, False),
                     axisToPlot=self.axisToPlot,
-                    sliceToPlot=self.currentSlice
+                    sliceToPlot=self.currentSlice,
+                    **plot_args
                 )
 
     def updateDisplayedSlices_2D(self, ingredients, slicesToPlot):
@@ -224,8 +365,20 @@ class projection2D():
         """
         # self.updatePlotItems_2D(ingredients)  # TODO: Not have this here. This should be set when the mouse enters the axis and then not changed.
                                                # Like this it doesn't work if we are to change the displayed slice in the current axis using the mouse wheel.
+        self.linkedYprojection.beginInteraction()
+        self.linkedXprojection.beginInteraction()
         self.linkedYprojection.updatePlotItems_2D(ingredients, slicesToPlot[0])
         self.linkedXprojection.updatePlotItems_2D(ingredients, slicesToPlot[1])
+        self.linkedYprojection.prefetchNextSlices()
+        self.linkedXprojection.prefetchNextSlices()
+
+    def prefetchNextSlices(self):
+        """
+        Tell the slice prefetcher that the user moved to a new slice, so it can prepare the next ones
+        """
+        prefetcher = getattr(self.lasagna, 'slicePrefetcher', None)
+        if prefetcher is not None and self.currentSlice is not None:
+            prefetcher.sliceChanged(self, self.currentSlice)
 
     def getMousePositionInCurrentView(self, pos):
         # TODO: figure out what pos is and where best to put it. Then can integrate this call into updateDisplayedSlices
@@ -243,9 +396,51 @@ class projection2D():
 
     # ------------------------------------------------------
     # slots
+    def viewRangeChanged_slot(self):
+        """
+        Re-draw the image stacks if a zoom means that a different pyramid level should be shown,
+        or a pan or zoom brings parts of the planes into view that have not been drawn
+        """
+        if self.currentSlice is None:
+            return
+        if self.interacting:
+            self.refineTimer.start()  # Still moving, so put off the full resolution redraw
+        self.redrawPointsForView()
+        pyramid_factor = self.targetPyramidFactor()
+        if pyramid_factor == self.currentPyramidFactor and not self.regionNeedsRedraw(pyramid_factor):
+            return
+        stacks = self.lasagna.returnIngredientByType('imagestack')
+        if stacks:
+            # Linked axes move together, so their redraws are merged [see redraw_scheduler]
+            self.lasagna.requestRedraw(ingredients=stacks, axes=[self.axisIndex()], properties=["view"])
+
+    def redrawPointsForView(self):
+        """
+        Re-draw the point layers whose drawing depends on the view, e.g. those shown as density maps
+        """
+        for ingredient in self.lasagna.returnIngredientByType('sparsepoints') or []:
+            item = self.itemsByName.get(ingredient.objectName)
+            if item and ingredient.needsRedrawForView(item):
+                ingredient.plotIngredient(
+                    pyqtObject=item,
+                    axisToPlot=self.axisToPlot,
+                    sliceToPlot=self.currentSlice,
+                    maxPoints=self.interactionMaxPoints if self.interacting else None
+                )
+
+    def userInteraction_slot(self):
+        """
+        The user is panning or zooming this axis. The linked axes move with it, so all are drawn coarsely.
+        """
+        for projection in (self, self.linkedXprojection, self.linkedYprojection):
+            if projection is not None:
+                projection.beginInteraction()
+
     def wheel_layer_slot(self):
         """
         Handle the wheel action that allows the user to move through stack layers
         """
+        self.beginInteraction()
         self.updatePlotItems_2D(self.lasagna.ingredientList,
                                 sliceToPlot=round(self.currentSlice + self.view.getViewBox().progressBy))  # round creates an int that supresses a warning in p3
+        self.prefetchNextSlices()
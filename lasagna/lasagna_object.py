@@ -14,21 +14,99 @@ from PyQt5.QtWidgets import qApp, QMainWindow
 # import nrrd
 
 from lasagna import lasagna_mainWindow, lasagna_axis, ingredients
-from lasagna.io_libs import image_stack_loader
+from lasagna.io_libs import image_stack_loader, volume_cache
 from lasagna.plugins import plugin_handler
-from lasagna.utils import preferences, path_utils
-from lasagna.utils.lasagna_qt_helper_functions import (
-    find_pyqt_graph_object_name_in_plot_widget,
-)
+from lasagna.ingredients.imagestack import calc_histogram, default_hist_range
+from lasagna.utils import preferences, path_utils, loader_pool
+from lasagna.utils.background_task import BackgroundTask
+from lasagna.utils.ingredient_registry import IngredientRegistry
+from lasagna.utils.redraw_scheduler import HISTOGRAM_PROPERTIES, RedrawScheduler
+from lasagna.utils.slice_prefetcher import SlicePrefetcher
+from lasagna.utils.slice_renderer import SliceRenderer, TileCache
+
+
+def loader_preferences():
+    """
+    Read the preferences that read_image_stack needs and return them as its keyword arguments.
+    readPreference may rewrite the preferences file, so this is called on the GUI thread
+    before any worker starts and the values are handed to the workers.
+    """
+    return dict(
+        volume_cache_bytes=volume_cache.max_cache_bytes(),
+        plane_cache_bytes=image_stack_loader.lazy_stack_cache_bytes(),
+        default_ratios=preferences.readPreference("defaultAxisRatios"),
+    )
+
+
+def read_image_stack(fname, progress=None, process_pool=None, roi=None, step=1, block_mean=False,
+                     volume_cache_bytes=None, plane_cache_bytes=None, default_ratios=None):
+    """
+    Read an image stack and do the calculations needed before it can be displayed:
+    voxel spacing, intensity histogram and default display range. Nothing here touches
+    the GUI, so this can run on a worker thread (see Lasagna.loadImageStack).
+    progress is an optional callable that is given the fraction done and a message. The first
+    message describes the stack (size and data type), or is empty if its header can not be read.
+    process_pool is an optional concurrent.futures.ProcessPoolExecutor. If supplied, files
+    whose decoding is CPU-bound are decoded in it rather than in the calling thread.
+    roi, step and block_mean read a cropped and/or downsampled stack (see image_stack_loader.read_subvolume)
+    volume_cache_bytes, plane_cache_bytes and default_ratios are the preferences the loaders need.
+    Workers must be given them [see loader_preferences]: None reads the preference, which is
+    only safe on the GUI thread.
+    Returns a dictionary of results or None if the stack could not be read.
+    """
+    if progress is None:
+        progress = lambda fraction, message="": None
+
+    # Only the header is read, so the size of the stack is reported straight away
+    info = image_stack_loader.probe_stack(fname)
+    progress(0, image_stack_loader.describe_stack(info) if info is not None else "")
+
+    cache_sizes = dict(volume_cache_bytes=volume_cache_bytes, plane_cache_bytes=plane_cache_bytes)
+    progress(0, "reading")
+    if roi is not None or np.any(np.asarray(step) != 1):
+        data = image_stack_loader.load_stack(
+            fname,
+            roi=roi,
+            step=step,
+            block_mean=block_mean,
+            progress=lambda fraction: progress(0.4 * fraction, "reading"),
+            **cache_sizes
+        )
+    elif (
+        process_pool is not None
+        and image_stack_loader.decode_is_cpu_bound(fname)
+        # Mapping the cached copy is faster than sending it between processes
+        and not volume_cache.is_cached(fname, max_bytes=volume_cache_bytes)
+    ):
+        data = process_pool.submit(image_stack_loader.load_stack, fname, **cache_sizes).result()
+    else:
+        data = image_stack_loader.load_stack(fname, lazy=True, **cache_sizes)
+    if data is None or data is False or len(data) == 0:
+        return None
+
+    progress(0.4, "reading voxel spacing")
+    ax_ratio = image_stack_loader.get_voxel_spacing(fname, step=step, default_ratios=default_ratios)
+
+    progress(0.5, "calculating histogram")
+    histogram = calc_histogram(data)
+
+    progress(0.8, "calculating display range")
+    min_max = [0, default_hist_range(data)]
+
+    progress(1, "done")
+    return dict(data=data, axisRatios=ax_ratio, histogram=histogram, minMax=min_max)
 
 
 
 class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
-    def __init__(self, embed_console=False, parent=None):
+    def __init__(self, embed_console=False, parent=None, maxLoaderWorkers=None):
         """
         Create default values for properties then call initialiseUI to set up main window
+        maxLoaderWorkers caps the number of files that loaders read concurrently.
+        None means one per CPU.
         """
         super(Lasagna, self).__init__(parent)
+        self.maxLoaderWorkers = maxLoaderWorkers
 
         # Create widgets defined in the designer file
         # self.win = QMainWindow()
@@ -42,8 +120,9 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         self.recentLoadActions = []
         self.updateRecentlyOpenedFiles()
 
-        # We will maintain a list of classes of loaded items that can be added to plots
-        self.ingredientList = []
+        # We will maintain a registry of classes of loaded items that can be added to plots [see ingredientList]
+        self.ingredientRegistry = IngredientRegistry()
+        self._selectedStackName = None  # Cached by selectedStackName until the selection changes
 
         # Set up GUI based on preferences
         self.view1Z_spinBox.setValue(
@@ -142,8 +221,8 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         self.axes2D[1].linkedYprojection = self.axes2D[0]
 
         # UI elements updated during mouse moves over an axis
-        self.crossHairVLine = None
-        self.crossHairHLine = None
+        self.crossHairColor = (220, 200, 0, 180)
+        self.crossHairHighlightColor = (240, 0, 0, 200)  # While ctrl-dragging
         self.showCrossHairs = preferences.readPreference("showCrossHairs")
         self.mouseX = None
         self.mouseY = None
@@ -156,6 +235,46 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         # Ensure that the menu on OS X appears the same as in Linux and Windows
         self.menuBar.setNativeMenuBar(False)
 
+        # Redraw requests are merged and performed once per event loop turn [see initialiseAxes()]
+        self.redrawScheduler = RedrawScheduler(self.redrawPlots, parent=self)
+
+        # Image stack slices are scaled and coloured on worker threads [see slice_renderer]
+        if preferences.readPreference("renderSlicesInBackground"):
+            self.sliceRenderer = SliceRenderer(parent=self)
+        else:
+            self.sliceRenderer = None
+
+        # Tiles of large planes, coloured in the background, are re-used while panning [see lasagna_axis.visibleRegion]
+        self.renderTileSize = preferences.readPreference("renderTileSize")
+        self.tileCache = TileCache(preferences.readPreference("tileCacheMB") * 2 ** 20)
+
+        # Slices about to be reached by the wheel or a ctrl-drag are prepared ahead of time [see slice_prefetcher]
+        prefetch_slices = preferences.readPreference("prefetchSlices")
+        if prefetch_slices:
+            self.slicePrefetcher = SlicePrefetcher(
+                self,
+                ahead=prefetch_slices,
+                max_bytes=preferences.readPreference("prefetchCacheMB") * 2 ** 20,
+            )
+        else:
+            self.slicePrefetcher = None
+
+        # Slow operations (e.g. stack loading) run as BackgroundTasks. While any are running the
+        # status bar shows a progress bar and a button to cancel the latest one the user started.
+        # [see runInBackground()]
+        self.backgroundTasks = []
+        self.taskProgressBar = QtGui.QProgressBar()
+        self.taskProgressBar.setMaximumWidth(150)
+        self.taskCancelButton = QtGui.QPushButton("Cancel")
+        self.taskCancelButton.setToolTip(
+            "Cancel the latest load or save. It stops after the file or plane being read"
+        )
+        self.taskCancelButton.released.connect(self.cancelLatestBackgroundTask)
+        self.statusBar.addPermanentWidget(self.taskProgressBar)
+        self.statusBar.addPermanentWidget(self.taskCancelButton)
+        self.taskProgressBar.hide()
+        self.taskCancelButton.hide()
+
         # Lists of functions that are used as hooks for plugins to modify the behavior of built-in methods.
         # Hooks are named using the following convention: <lasagnaMethodName_[Start|End]>
         # So:
@@ -240,7 +359,7 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         self.imageStackLayers_Model = QtGui.QStandardItemModel(
             self.imageStackLayers_TreeView
         )
-        self.imageStackLayers_Model.setHorizontalHeaderLabels(["Name"])
+        self.imageStackLayers_Model.setHorizontalHeaderLabels(["Name", "Layout"])
         self.imageStackLayers_TreeView.setModel(self.imageStackLayers_Model)
         self.imageStackLayers_TreeView.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.imageStackLayers_TreeView.customContextMenuRequested.connect(
@@ -425,15 +544,87 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 print("Error running plugin method {}; main error {}".format(hook, err))
                 raise
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Methods for running slow operations on worker threads
+    def runInBackground(self, task, cancellable=True):
+        """
+        Start the BackgroundTask "task", reporting its progress on the status bar.
+        The caller connects to the task's succeeded signal to use the result.
+        If cancellable is False the Cancel button does not stop the task. This is for work the
+        user did not ask for, such as building oriented copies of a stack.
+        """
+        task.userCancellable = cancellable
+        self.backgroundTasks.append(task)
+        task.progressed.connect(
+            lambda percent, message: self.backgroundTaskProgress_slot(task, percent, message)
+        )
+        task.failed.connect(
+            lambda err: self.statusBar.showMessage("{} failed: {}".format(task.description, err))
+        )
+        task.cancelled.connect(
+            lambda: self.statusBar.showMessage("{} cancelled".format(task.description))
+        )
+        task.finished.connect(lambda: self.backgroundTaskFinished_slot(task))
+
+        self.taskProgressBar.setValue(0)
+        self.taskProgressBar.show()
+        self.taskCancelButton.setVisible(self.latestCancellableTask() is not None)
+        self.statusBar.showMessage(task.description)
+        task.start()
+        return task
+
+    def backgroundTaskProgress_slot(self, task, percent, message):
+        self.taskProgressBar.setValue(percent)
+        self.statusBar.showMessage("{}: {}".format(task.description, message))
+
+    def backgroundTaskFinished_slot(self, task):
+        if task in self.backgroundTasks:
+            self.backgroundTasks.remove(task)
+        if not self.backgroundTasks:
+            self.taskProgressBar.hide()
+        self.taskCancelButton.setVisible(self.latestCancellableTask() is not None)
+
+    def latestCancellableTask(self):
+        """
+        Return the most recently started task that the Cancel button stops, or None
+        """
+        for task in reversed(self.backgroundTasks):
+            if task.userCancellable and not task.isCancelled():
+                return task
+        return None
+
+    def cancelLatestBackgroundTask(self):
+        """
+        Cancel the most recently started load or save. Tasks stop at their next progress
+        report, i.e. after the file or plane being read [see background_task].
+        """
+        task = self.latestCancellableTask()
+        if task is not None:
+            task.cancel()
+        self.taskCancelButton.setVisible(self.latestCancellableTask() is not None)
+
+    def cancelBackgroundTasks(self):
+        """
+        Cancel all running background tasks
+        """
+        for task in self.backgroundTasks:
+            task.cancel()
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # File menu and methods associated with loading the base image stack.
-    def loadImageStack(self, fnameToLoad):
+    def loadImageStack(self, fnameToLoad, asynchronous=False, roi=None, step=1, blockMean=False):
         """
         Loads an image image stack.
+        fnameToLoad may be a stack file or a directory (or glob pattern) of slices, one per plane.
+        If asynchronous is True, the stack is read on a worker thread and the function returns
+        the BackgroundTask immediately. The stack is then added and the axes re-drawn once the
+        data are ready. The loadImageStack_End hook runs after the stack has been added.
+        roi, step and blockMean load only part of the stack and/or downsample it as it is read
+        (see image_stack_loader.read_subvolume).
         """
         self.runHook(self.hooks["loadImageStack_Start"])
 
-        if not os.path.isfile(fnameToLoad):
+        if not image_stack_loader.stack_exists(fnameToLoad):
             msg = "Unable to find " + fnameToLoad
             print(msg)
             self.statusBar.showMessage(msg)
@@ -441,30 +632,92 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
         print(("Loading image stack " + fnameToLoad))
 
-        # TODO: The axis swap likely shouldn't be hard-coded here
-        loaded_image_stack = image_stack_loader.load_stack(fnameToLoad)
+        if not asynchronous:
+            loaded = read_image_stack(fnameToLoad, roi=roi, step=step, block_mean=blockMean, **loader_preferences())
+            return self.addLoadedImageStack(fnameToLoad, loaded)
+
+        task = BackgroundTask(
+            read_image_stack,
+            fnameToLoad,
+            description="Loading " + fnameToLoad.rstrip(os.path.sep).split(os.path.sep)[-1],
+            roi=roi,
+            step=step,
+            block_mean=blockMean,
+            **loader_preferences()
+        )
+        task.succeeded.connect(
+            lambda loaded: self.addLoadedImageStack(fnameToLoad, loaded, redraw=True)
+        )
+
+        # The header is read by the task, not here, as probing some files takes a while.
+        # Its first progress report describes the stack [see read_image_stack]
+        def describeStack(percent, message):
+            task.progressed.disconnect(describeStack)
+            if message:
+                task.description += " (" + message + ")"
+
+        task.progressed.connect(describeStack)
+        return self.runInBackground(task)
+
+    def loadImageStacks(self, fnamesToLoad):
+        """
+        Loads several image stacks concurrently, then adds them in the order given.
+        Raw and uncompressed data are read with threads. Compressed files are decoded
+        in separate processes. At most self.maxLoaderWorkers files are read at once.
+        """
+        fnames = []
+        for fname in fnamesToLoad:
+            self.runHook(self.hooks["loadImageStack_Start"])
+            if image_stack_loader.stack_exists(fname):
+                fnames.append(fname)
+            else:
+                msg = "Unable to find " + fname
+                print(msg)
+                self.statusBar.showMessage(msg)
+
+        print("Loading {} image stacks".format(len(fnames)))
+        settings = loader_preferences()  # Read here: the workers must not read preferences
+        with loader_pool.process_pool(self.maxLoaderWorkers) as processes:
+            loaded_stacks = loader_pool.map_ordered(
+                lambda fname: read_image_stack(fname, process_pool=processes, **settings),
+                fnames,
+                max_workers=self.maxLoaderWorkers,
+            )
+
+        return [self.addLoadedImageStack(fname, loaded) for fname, loaded in zip(fnames, loaded_stacks)]
 
-        if len(loaded_image_stack) == 0 and not loaded_image_stack:
+    def addLoadedImageStack(self, fnameToLoad, loaded, redraw=False):
+        """
+        Add an image stack read by read_image_stack as an ingredient and display it.
+        This runs on the GUI thread. If redraw is True the axes are re-drawn.
+        """
+        if loaded is None:
+            self.statusBar.showMessage("Failed to load " + fnameToLoad)
             return False
 
         # Set up default values in tabs
         # It's ok to load images of different sizes but their voxel sizes need to be the same
-        ax_ratio = image_stack_loader.get_voxel_spacing(fnameToLoad)
+        ax_ratio = loaded["axisRatios"]
         for i in range(len(ax_ratio)):
             self.axisRatioLineEdits[i].setText(str(ax_ratio[i]))
 
         # Add to the ingredients list
-        obj_name = fnameToLoad.split(os.path.sep)[-1]
+        obj_name = fnameToLoad.rstrip(os.path.sep).split(os.path.sep)[-1]  # Directories of slices may end in a separator
         self.addIngredient(
             objectName=obj_name,
             kind="imagestack",
-            data=loaded_image_stack,
+            data=loaded["data"],
             fname=fnameToLoad,
+            histogram=loaded["histogram"],
+            minMax=loaded["minMax"],
         )
 
         # Add item to all three 2D plots
         self.returnIngredientByName(obj_name).addToPlots()
 
+        # Make contiguous copies for the other two views in the background, memory permitting
+        self.returnIngredientByName(obj_name).buildOrientedCopies()
+
         # If only one stack is present, we will display it as gray (see imagestack class)
         # if more than one stack has been added, we will colour successive stacks according
         # to the colorOrder preference in the parameter file
@@ -486,6 +739,11 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
         self.runHook(self.hooks["loadImageStack_End"])
 
+        if redraw:
+            self.initialiseAxes()
+            self.statusBar.showMessage("Loaded " + obj_name)
+        return True
+
     def showStackLoadDialog(
         self, triggered=None, fileFilter=image_stack_loader.image_filter()
     ):
@@ -507,8 +765,7 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             return
 
         if os.path.isfile(fname):
-            self.loadImageStack(str(fname))
-            self.initialiseAxes()
+            self.loadImageStack(str(fname), asynchronous=True)  # Axes are re-drawn when loading finishes
         else:
             self.statusBar.showMessage("Unable to find " + str(fname))
 
@@ -585,8 +842,7 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         """
         self.runHook(self.hooks["loadRecentFileSlot_Start"])
         fname = str(self.sender().text())
-        self.loadImageStack(fname)
-        self.initialiseAxes()
+        self.loadImageStack(fname, asynchronous=True)  # Axes are re-drawn when loading finishes
 
     def quitLasagna(self):
         """
@@ -600,6 +856,19 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 ].confirmOnClose:  # TODO: handle cases where plugins want confirmation to close
                     self.stopPlugin(thisPlugin)
 
+        # Give running background tasks the chance to stop before the threads are destroyed
+        self.cancelBackgroundTasks()
+        for task in self.backgroundTasks[:]:
+            task.wait(2000)
+        if self.sliceRenderer is not None:
+            self.sliceRenderer.shutdown()
+        if self.slicePrefetcher is not None:
+            stats = self.slicePrefetcher.stats()
+            if stats["hits"] + stats["misses"]:
+                print("Slice prefetch: {hits} hits, {misses} misses ({hitRate:.0%}), "
+                      "{prefetched} slices prepared, {skipped} abandoned".format(**stats))
+            self.slicePrefetcher.shutdown()
+
         qApp.quit()
         if self.embed_console:
             from prompt_toolkit.application.current import get_app
@@ -611,12 +880,13 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
     # ------------------------------------------------------------------------
     # Ingredient handling methods
-    def addIngredient(self, kind="", objectName="", data=None, fname=""):
+    def addIngredient(self, kind="", objectName="", data=None, fname="", **kwargs):
         """
         Adds an ingredient to the list of ingredients.
         Scans the list of ingredients to see if an ingredient is already present.
         If so, it removes it before adding a new one with the same name.
         ingredients are classes that are defined in the ingredients package
+        Any further keyword arguments are passed to the ingredient's constructor.
         """
 
         print(
@@ -639,12 +909,20 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         ingredient_class_obj = getattr(
             getattr(ingredients, kind), kind
         )  # make an ingredient of type "kind"
-        self.ingredientList.append(
+        self.ingredientRegistry.add(
             ingredient_class_obj(
-                parent=self, fnameAbsPath=fname, data=data, objectName=objectName
+                parent=self, fnameAbsPath=fname, data=data, objectName=objectName, **kwargs
             )
         )
 
+    @property
+    def ingredientList(self):
+        """
+        All ingredients in the order they were added. Do not modify this list: use
+        addIngredient and removeIngredient, which keep ingredientRegistry up to date.
+        """
+        return self.ingredientRegistry.ingredients()
+
     def removeIngredient(self, ingredientInstance):
         """
         Removes the ingredient "ingredientInstance" from self.ingredientList
@@ -652,9 +930,11 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         ingredient name or type
         """
         ingredientInstance.removePlotItem()  # remove from axes
-        self.ingredientList.remove(
-            ingredientInstance
-        )  # Remove ingredient from the list of ingredients
+        if self.ingredientRegistry.byName(ingredientInstance.objectName) is ingredientInstance:
+            self.ingredientRegistry.remove(
+                ingredientInstance.objectName
+            )  # Remove ingredient from the list of ingredients
+        self._selectedStackName = None
         ingredientInstance.removeFromList()  # remove ingredient from the list with which it is associated
         self.selectedStackName()  # Ensures something is highlighted
 
@@ -676,13 +956,13 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             return
 
         removed_ingredient = False
-        for thisIngredient in self.ingredientList[:]:
-            if thisIngredient.objectName == objectName:
-                if verbose:
-                    print(("Removing ingredient " + objectName))
-                self.removeIngredient(thisIngredient)
-                self.selectedStackName()  # Ensures something is highlighted
-                removed_ingredient = True
+        thisIngredient = self.ingredientRegistry.byName(objectName)
+        if thisIngredient is not None:
+            if verbose:
+                print(("Removing ingredient " + objectName))
+            self.removeIngredient(thisIngredient)
+            self.selectedStackName()  # Ensures something is highlighted
+            removed_ingredient = True
 
         if not removed_ingredient and verbose:
             print(("** Failed to remove ingredient %s **" % objectName))
@@ -699,24 +979,17 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 print("removeIngredientByType finds no ingredients in list!")
             return
 
-        for thisIngredient in self.ingredientList[:]:
-            if thisIngredient.__module__.endswith(
-                ingredientType
-            ):  # TODO: fix this so we look for it by instance not name
-                if verbose:
-                    print(("Removing ingredient " + thisIngredient.objectName))
-                self.selectedStackName()  # Ensures something is highlighted
-                self.removeIngredient(thisIngredient)
+        for thisIngredient in self.ingredientRegistry.byKind(ingredientType):
+            if verbose:
+                print(("Removing ingredient " + thisIngredient.objectName))
+            self.selectedStackName()  # Ensures something is highlighted
+            self.removeIngredient(thisIngredient)
 
     def listIngredients(self):
         """
         Return a list of ingredient objectNames
         """
-        ingredient_names = []
-        for thisIngredient in self.ingredientList:
-            ingredient_names.append(thisIngredient.objectName)
-
-        return ingredient_names
+        return self.ingredientRegistry.names()
 
     def returnIngredientByType(self, ingredientType):
         """
@@ -728,12 +1001,7 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 print("returnIngredientByType finds no ingredients in list!")
             return False
 
-        returned_ingredients = []
-        for thisIngredient in self.ingredientList:
-            if thisIngredient.__module__.endswith(
-                ingredientType
-            ):  # TODO: fix this so we look for it by instance not name
-                returned_ingredients.append(thisIngredient)
+        returned_ingredients = self.ingredientRegistry.byKind(ingredientType)
 
         if verbose and not returned_ingredients:
             print(
@@ -757,9 +1025,9 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 print("returnIngredientByName finds no ingredients in list!")
             return False
 
-        for ingredient in self.ingredientList:
-            if ingredient.objectName == objectName:
-                return ingredient
+        ingredient = self.ingredientRegistry.byName(objectName)
+        if ingredient is not None:
+            return ingredient
 
         if verbose:
             print(("returnIngredientByName finds no ingredient called " + objectName))
@@ -775,50 +1043,88 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             return
         [axis.resetAxes() for axis in self.axes2D]
 
-    def initialiseAxes(self, resetAxes=False):
+    def initialiseAxes(self, resetAxes=False, immediate=False):
         """
         Initial display of images in axes and also update other parts of the GUI.
         We will initially choose default images that are the middlemost layer of each axis
+        The redraw is done by the redraw scheduler once control returns to the event loop, so
+        several calls in a row cause one redraw. Use requestRedraw to redraw only part of the
+        display. If immediate is True the plots are drawn before this returns, together with
+        any other redraw still pending. Plugins that go on to read the displayed slices or
+        plot items need this.
+        """
+        # initialize cross hair. The lines stay in the views and are only moved or hidden [see cursor_overlay]
+        if self.showCrossHairs:
+            for axis in self.axes2D:
+                if not axis.cursorOverlay.hasCrossHairs():
+                    axis.cursorOverlay.addCrossHairs(self.crossHairColor)
+
+        self.redrawScheduler.request(resetAxes=resetAxes)
+        if immediate:
+            self.redrawScheduler.flush()
+
+    def requestRedraw(self, ingredients=None, axes=None, properties=("all",), resetToMiddleLayer=False):
+        """
+        Ask for the plot items of some ingredients on some axes to be redrawn, e.g.
+        requestRedraw(ingredients=["myStack"], properties=["lut"]). See RedrawScheduler.request.
+        """
+        self.redrawScheduler.request(
+            ingredients=ingredients,
+            axes=axes,
+            properties=properties,
+            resetToMiddleLayer=resetToMiddleLayer,
+        )
+
+    def redrawPlots(self, ingredients=None, axes=None, properties=("all",),
+                    resetToMiddleLayer=False, resetAxes=False):
+        """
+        Redraw the plot items of the named ingredients (None for all) on the axes with the
+        given indices (None for all). Called by the redraw scheduler.
         """
         if not self.stacksInTreeList():
             self.plotImageStackHistogram()  # wipes the histogram
+            for axis in self.axes2D:
+                if axis.compositor is not None:
+                    axis.compositor.clear()  # The blend of the last stack is still on display
             return
 
+        if ingredients is None:
+            to_draw = self.ingredientList
+        else:
+            wanted = set(ingredients)
+            to_draw = [i for i in self.ingredientList if i.objectName in wanted]
+        if axes is None:
+            axes = range(len(self.axes2D))
 
-        self.update_2D_plot_ingredients_in_axes(resetAxes=resetAxes)
-
-        # initialize cross hair
-        if self.showCrossHairs:
-            if self.crossHairVLine is None:
-                self.crossHairVLine = pg.InfiniteLine(
-                    pen=(220, 200, 0, 180), angle=90, movable=False
-                )
-                self.crossHairVLine.objectName = "crossHairVLine"
-            if self.crossHairHLine is None:
-                self.crossHairHLine = pg.InfiniteLine(
-                    pen=(220, 200, 0, 180), angle=0, movable=False
-                )
-                self.crossHairHLine.objectName = "crossHairHLine"
+        for axis_index in axes:
+            axis = self.axes2D[axis_index]
+            axis.updatePlotItems_2D(
+                to_draw,
+                sliceToPlot=axis.currentSlice,
+                resetToMiddleLayer=resetToMiddleLayer,
+            )
 
-        self.plotImageStackHistogram()
+        if HISTOGRAM_PROPERTIES.intersection(properties):
+            self.plotImageStackHistogram()
 
-        for i in range(len(self.axisRatioLineEdits)):
-            self.axes2D[i].view.setAspectLocked(
-                True, float(self.axisRatioLineEdits[i].text())
-            )
+        if "all" in properties:
+            for i in range(len(self.axisRatioLineEdits)):
+                self.axes2D[i].view.setAspectLocked(
+                    True, float(self.axisRatioLineEdits[i].text())
+                )
 
         if resetAxes:
             self.resetAxes()
 
-    def update_2D_plot_ingredients_in_axes(self,resetAxes=False):
-        [
-            axis.updatePlotItems_2D(
-                self.ingredientList,
-                sliceToPlot=axis.currentSlice,
-                resetToMiddleLayer=resetAxes,
-            )
-            for axis in self.axes2D
-        ]
+    def update_2D_plot_ingredients_in_axes(self, resetAxes=False, immediate=False):
+        """
+        Redraw the plot items on all three axes. resetAxes shows the middle layer of the stacks.
+        The redraw is merged with any others requested in this event loop turn, unless
+        immediate is True [see initialiseAxes].
+        """
+        self.redrawScheduler.request(properties=("display",), resetToMiddleLayer=resetAxes)
+        if immediate:
+            self.redrawScheduler.flush()
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Slots for image stack tab
@@ -834,14 +1140,14 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not ingredient:
             return
         self.returnIngredientByName(ingredient).alpha = int(value)
-        self.initialiseAxes()
+        self.requestRedraw(ingredients=[ingredient], properties=["alpha"])
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Slots for points tab
     # In each case, we set the values of the currently selected ingredient using the spinbox value
     # TODO: this is an example of code that is not flexible. These UI elements should be created by the ingredient
     def viewZ_spinBoxes_slot(self):
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(properties=["zSpread"])
 
     def markerSymbol_comboBox_slot(self, index):
         symbol = str(self.markerSymbol_comboBox.currentText())
@@ -849,28 +1155,28 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not ingredient:
             return
         ingredient.symbol = symbol
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredients=[ingredient], properties=["symbol"])
 
     def markerSize_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.symbolSize = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredients=[ingredient], properties=["symbolSize"])
 
     def markerAlpha_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.alpha = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredients=[ingredient], properties=["alpha"])
 
     def lineWidth_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.lineWidth = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredients=[ingredient], properties=["lineWidth"])
 
     def markerColor_pushButton_slot(self):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
@@ -880,7 +1186,7 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         col = QtGui.QColorDialog.getColor()
         rgb = [col.toRgb().red(), col.toRgb().green(), col.toRgb().blue()]
         ingredient.color = rgb
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredients=[ingredient], properties=["color"])
 
     def selectedPointsName(self):
         """
@@ -912,8 +1218,32 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         action = QtGui.QAction("Save", self)
         action.triggered.connect(self.saveLayerPoints_Slot)
         menu.addAction(action)
+
+        # Points with a categorical attribute can be shown and hidden one category at a time
+        ingredient = self.returnIngredientByName(self.selectedPointsName())
+        if getattr(ingredient, "categories", None) is not None:
+            categories_menu = QtGui.QMenu("Categories", self)
+            for category, visible in zip(ingredient.categories, ingredient.categoryVisible):
+                action = QtGui.QAction(str(category), self)
+                action.setCheckable(True)
+                action.setChecked(bool(visible))
+                action.category = category
+                action.toggled.connect(self.togglePointsCategory_Slot)
+                categories_menu.addAction(action)
+            menu.addAction(categories_menu.menuAction())
+
         menu.exec_(self.points_TreeView.viewport().mapToGlobal(position))
 
+    def togglePointsCategory_Slot(self, visible):
+        """
+        Show or hide one category of the selected points ingredient
+        """
+        obj_name = self.selectedPointsName()
+        ingredient = self.returnIngredientByName(obj_name)
+        if not ingredient or not ingredient.setCategoryVisible(self.sender().category, visible):
+            return
+        self.requestRedraw(ingredients=[obj_name], properties=["visibility"])
+
     def saveLayerPoints_Slot(self):
         """call ingredient save method if any"""
         obj_name = self.selectedPointsName()
@@ -998,19 +1328,14 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         for thisStack in image_stacks:
             thisStack.flipAlongAxis(axisToFlip)
 
-        self.initialiseAxes()
+        self.requestRedraw(ingredients=image_stacks, properties=["data"])
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Methods that are run during navigation
-    def removeCrossHairs(self):
+    def removeCrossHairs(self, keepAxis=None):
         """
-        Remove the cross hairs from all plots
+        Hide the cross hairs in all plots, except in axis number keepAxis if it is given
         """
-        # NOTE: I'm a little unhappy about this as I don't understand what's going on.
-        # I've noticed that removing the cross hairs from any one plot is sufficient to remove
-        # them from the other two. However, if all three axes are not explicitly removed I've
-        # seen peculiar behavior with plugins that query the PlotWidgets. RAAC 21/07/2015
-
         self.runHook(
             self.hooks["removeCrossHairs_Start"]
         )  # This will be run each time a plot is updated
@@ -1018,8 +1343,9 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not self.showCrossHairs:
             return
 
-        [axis.removeItemFromPlotWidget(self.crossHairVLine) for axis in self.axes2D]
-        [axis.removeItemFromPlotWidget(self.crossHairHLine) for axis in self.axes2D]
+        for axis_id, axis in enumerate(self.axes2D):
+            if axis_id != keepAxis:
+                axis.cursorOverlay.hideCrossHairs()
 
     def updateCrossHairs(self, highlightCrossHairs=False):
         """
@@ -1034,16 +1360,11 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             QtGui.QApplication.keyboardModifiers() == QtCore.Qt.ControlModifier
             and highlightCrossHairs
         ):
-            self.crossHairVLine.setPen(240, 0, 0, 200)
-            self.crossHairHLine.setPen(240, 0, 0, 200)
+            color = self.crossHairHighlightColor
         else:
-            self.crossHairVLine.setPen(220, 200, 0, 180)
-            self.crossHairHLine.setPen(220, 200, 0, 180)
+            color = self.crossHairColor
 
-        self.crossHairVLine.setPos(
-            self.mouseX + 0.5
-        )  # Add 0.5 to add line to middle of pixel
-        self.crossHairHLine.setPos(self.mouseY + 0.5)
+        self.axes2D[self.inAxis].cursorOverlay.showCrossHairs(self.mouseX, self.mouseY, color)
 
     def updateStatusBar(self):
         """
@@ -1054,20 +1375,22 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         y = self.mouseY
 
         # get pixels under image
-        image_items = self.axes2D[self.inAxis].getPlotItemByType("ImageItem")
+        image_stacks = self.returnIngredientByType("imagestack") or []
+        axis = self.axes2D[self.inAxis]
         pixel_values = []
 
-        # Get the pixel intensity of all displayed image layers under the mouse
+        # Get the pixel intensity of all image layers under the mouse. Values are read from the
+        # stacks rather than the image items, which may show a downsampled pyramid level.
         # The following assumes that images have their origin at (0,0)
-        for thisImageItem in image_items:
-            im_shape = thisImageItem.image.shape
+        for thisStack in image_stacks:
+            data = thisStack.data(axis.axisToPlot)
 
-            if x < 0 or y < 0:
+            if x < 0 or y < 0 or axis.currentSlice is None or axis.currentSlice < 0:
                 pixel_values.append(0)
-            elif x >= im_shape[0] or y >= im_shape[1]:
+            elif axis.currentSlice >= data.shape[0] or x >= data.shape[1] or y >= data.shape[2]:
                 pixel_values.append(0)
             else:
-                pixel_values.append(thisImageItem.image[x, y])
+                pixel_values.append(data[axis.currentSlice, x, y])
 
         # Build a text string to house these values
         value_str = ""
@@ -1084,6 +1407,17 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
         self.statusBar.showMessage(self.statusBarText)
 
+    def renderingBehind(self):
+        """
+        Return True while the slices requested by a ctrl-drag are still being rendered in the background.
+        Mouse moves are then held back so that only the latest position is drawn.
+        """
+        if self.sliceRenderer is None:
+            return False
+        if not any(axis.view.getViewBox().controlDrag for axis in self.axes2D):
+            return False
+        return self.sliceRenderer.pendingCount() > 0
+
     def axisClicked(self, event):
         """
         Run plugin events whenver the user clicks on an axis
@@ -1225,6 +1559,11 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
         menu.addAction(change_color_menu.menuAction())
 
+        ingredient = self.returnIngredientByName(self.selectedStackName())
+        action = QtGui.QAction("Hide" if ingredient and ingredient.enable else "Show", self)
+        action.triggered.connect(self.toggleLayerStackVisibility_Slot)
+        menu.addAction(action)
+
         action = QtGui.QAction("Delete", self)
         action.triggered.connect(self.deleteLayerStack_Slot)
         menu.addAction(action)
@@ -1240,9 +1579,20 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         color = str(self.sender().text())
         obj_name = self.selectedStackName()
         self.returnIngredientByName(obj_name).lut = color
-        self.initialiseAxes()
+        self.requestRedraw(ingredients=[obj_name], properties=["lut"])
         self.runHook(self.hooks["changeImageStackColorMap_Slot_End"])
 
+    def toggleLayerStackVisibility_Slot(self):
+        """
+        Hide the selected image stack if it is shown and show it if it is hidden
+        """
+        obj_name = self.selectedStackName()
+        ingredient = self.returnIngredientByName(obj_name)
+        if not ingredient:
+            return
+        ingredient.enable = not ingredient.enable
+        self.requestRedraw(ingredients=[obj_name], properties=["visibility"])
+
     def deleteLayerStack_Slot(self):
         """
         Remove an imagestack ingredient and list item
@@ -1263,13 +1613,10 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
     def stacksInTreeList(self):
         """
-        Goes through the list of image stack layers in the QTreeView list
-        and pull out the names.
+        Return the names of the image stack layers in the QTreeView list,
+        which has one row per image stack in the order they were added.
         """
-        stacks = []
-        for i in range(self.imageStackLayers_Model.rowCount()):
-            stack_name = self.imageStackLayers_Model.index(i, 0).data()
-            stacks.append(stack_name)
+        stacks = self.ingredientRegistry.names("imagestack")
 
         if stacks:
             return stacks
@@ -1279,7 +1626,11 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
     def selectedStackName(self):
         """
         Return the name of the selected image stack. If no stack selected, returns the first stack in the list.
+        The name is cached until the selection changes [see imageStackLayers_TreeView_slot].
         """
+        if self._selectedStackName is not None and self._selectedStackName in self.ingredientRegistry:
+            return self._selectedStackName
+
         if self.imageStackLayers_Model.rowCount() == 0:
             print("lasagna.selectedStackName finds no image stacks in list")
             return False
@@ -1290,12 +1641,15 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             self.imageStackLayers_TreeView.setCurrentIndex(first_item)
             print("lasagna.selectedStackName forced highlighting of first image stack")
 
-        return self.imageStackLayers_TreeView.selectedIndexes()[0].data()
+        index = self.imageStackLayers_TreeView.selectedIndexes()[0]
+        self._selectedStackName = index.sibling(index.row(), 0).data()  # The name, whichever column was clicked
+        return self._selectedStackName
 
     def imageStackLayers_TreeView_slot(self):
         """
         Runs when the user selects one of the stacks on the list
         """
+        self._selectedStackName = None
 
         if not self.ingredientList:
             return
@@ -1322,22 +1676,16 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not all_image_stacks:
             return
 
-        # Loop through all imagestacks and set their levels in each axis
+        # Set the levels of the selected imagestack. The plot items pick them up when they are re-drawn.
+        # Rendered slices have the levels baked in, so they can not be set directly on the items.
         for img_stack in all_image_stacks:
             object_name = img_stack.objectName
 
             if object_name != self.selectedStackName():  # TODO: LAYERS
                 continue
 
-            for thisAxis in self.axes2D:
-                img = find_pyqt_graph_object_name_in_plot_widget(
-                    thisAxis.view, object_name
-                )
-                img.setLevels([min_x, max_x])  # Sets levels immediately
-                img_stack.minMax = [
-                    min_x,
-                    max_x,
-                ]  # ensures levels stay set during all plot updates that follow
+            img_stack.minMax = [min_x, max_x]
+            self.requestRedraw(ingredients=[object_name], properties=["levels"])
 
     def mouseMoved(self, evt):
         """
@@ -1349,19 +1697,12 @@ class Lasagna(QtGui.QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         axis_id = self.sender().axisID
 
         pos = evt[0]
-        self.removeCrossHairs()
+        in_view = self.axes2D[axis_id].view.sceneBoundingRect().contains(pos)
+        self.removeCrossHairs(keepAxis=axis_id if in_view else None)  # updateCrossHairs moves the kept ones
         if not (QtGui.QApplication.keyboardModifiers() == QtCore.Qt.ControlModifier):
             self.axes2D[axis_id].view.getViewBox().controlDrag = False
 
-        if self.axes2D[axis_id].view.sceneBoundingRect().contains(pos):
-            if self.showCrossHairs:
-                self.axes2D[axis_id].view.addItem(
-                    self.crossHairVLine, ignoreBounds=True
-                )
-                self.axes2D[axis_id].view.addItem(
-                    self.crossHairHLine, ignoreBounds=True
-                )
-
+        if in_view:
             self.mouseX, self.mouseY = self.axes2D[
                 axis_id
             ].getMousePositionInCurrentView(pos)
@@ -17,6 +17,8 @@ class lasagna_viewBox(pg.ViewBox):
     # This fires when the user mouse-wheels without keyboard modifiers
     progressLayer = (QtCore.pyqtSignal())
     mouseClicked = QtCore.pyqtSignal(object)  # Make a mouseClicked signal
+    # This fires just before the user pans or zooms by dragging or with the wheel. Programmatic range changes do not fire it
+    userInteraction = QtCore.pyqtSignal()
 
     def __init__(self, linkedAxis={}):
         super(lasagna_viewBox, self).__init__(enableMenu=False)
@@ -68,6 +70,8 @@ class lasagna_viewBox(pg.ViewBox):
         else:
             self.controlDrag = False
 
+        self.userInteraction.emit()
+
         # Call the built-in mouseDragEvent
         pg.ViewBox.mouseDragEvent(self, ev, axis)
 
@@ -160,6 +164,7 @@ class lasagna_viewBox(pg.ViewBox):
             )
             # center = ev.pos()
 
+            self.userInteraction.emit()
             self._resetTarget()
             self.scaleBy(s, center)
             self.sigRangeChangedManually.emit(self.state["mouseEnabled"])
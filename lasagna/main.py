@@ -24,8 +24,9 @@ import os
 import sys
 import argparse
 from PyQt5.QtWidgets import QApplication
-import pyqtgraph as pg
+from lasagna.utils import preferences
 from lasagna.lasagna_object import Lasagna
+from lasagna.utils.adaptive_signal_proxy import AdaptiveSignalProxy
 
 
 def get_parser():
@@ -53,6 +54,8 @@ def get_parser():
                         help='Start a ipython console')
     parser.add_argument('-D', '--demo', action='store_true',
                         help='Load demo images')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Maximum number of files to read concurrently. Defaults to one per CPU')
     return parser
 
 
@@ -76,23 +79,22 @@ def download_sample_stacks():
 
 # Set up the figure window
 def main(im_stack_fnames_to_load=None, sparse_points_to_load=None, lines_to_load=None, trees_to_load=None,
-         plugin_to_start=None, embed_console=False):
+         plugin_to_start=None, embed_console=False, max_loader_workers=None):
 
     app = QApplication([])
 
-    tasty = Lasagna(embed_console=embed_console)
+    tasty = Lasagna(embed_console=embed_console, maxLoaderWorkers=max_loader_workers)
     tasty.app = app
 
     # Data from command line input if the user specified this
+    # Files are read concurrently but added in the order they were listed
     if im_stack_fnames_to_load is not None:
-        for fname in im_stack_fnames_to_load:
-            print("Loading stack {}".format(fname))
-            tasty.loadImageStack(fname)
+        print("Loading stacks {}".format(", ".join(im_stack_fnames_to_load)))
+        tasty.loadImageStacks(im_stack_fnames_to_load)
 
     if sparse_points_to_load is not None:
-        for fname in sparse_points_to_load:
-            print("Loading points {}".format(fname))
-            tasty.loadActions['sparse_point_reader'].showLoadDialog(fname)
+        print("Loading points {}".format(", ".join(sparse_points_to_load)))
+        tasty.loadActions['sparse_point_reader'].showLoadDialog(sparse_points_to_load)
 
     if lines_to_load is not None:
         for fname in lines_to_load:
@@ -115,15 +117,23 @@ def main(im_stack_fnames_to_load=None, sparse_points_to_load=None, lines_to_load
 
     # Link slots to signals
     # connect views to the mouseMoved slot. After connection this runs in the background.
-    sigProxies = [] # This list will be populated this with pyqtgraph.SignalProxy objects for linking signals and slots
+    # The proxies deliver only the latest event, as often as the time taken to redraw allows.
+    min_interval = preferences.readPreference('mouseMoveMinIntervalMs') / 1000.0
+    max_interval = preferences.readPreference('mouseMoveMaxIntervalMs') / 1000.0
+    load = preferences.readPreference('mouseMoveLoad')
+    sigProxies = [] # This list will be populated this with AdaptiveSignalProxy objects for linking signals and slots
     for i in range(3):
-        thisProxy = pg.SignalProxy(tasty.axes2D[i].view.scene().sigMouseMoved, rateLimit=30, slot=tasty.mouseMoved)
+        thisProxy = AdaptiveSignalProxy(tasty.axes2D[i].view.scene().sigMouseMoved, slot=tasty.mouseMoved,
+                                        minInterval=min_interval, maxInterval=max_interval, load=load,
+                                        busy=tasty.renderingBehind)
         thisProxy.axisID = i  # this is picked up the mouseMoved slot
         sigProxies.append(thisProxy)
 
-        thisProxy = pg.SignalProxy(tasty.axes2D[i].view.getViewBox().mouseClicked, rateLimit=30, slot=tasty.axisClicked)
+        thisProxy = AdaptiveSignalProxy(tasty.axes2D[i].view.getViewBox().mouseClicked, slot=tasty.axisClicked,
+                                        minInterval=min_interval, maxInterval=max_interval, load=load)
         thisProxy.axisID = i  # this is picked up the mouseMoved slot
         sigProxies.append(thisProxy)
+    tasty.sigProxies = sigProxies
 
     if embed_console:
         from traitlets.config import Config
@@ -148,7 +158,7 @@ def run():
 
     main(im_stack_fnames_to_load=img_stack_fnames_to_load, sparse_points_to_load=args.sparse_points,
          lines_to_load=args.lines, trees_to_load=args.tree,
-         plugin_to_start=args.plugin, embed_console=args.console)
+         plugin_to_start=args.plugin, embed_console=args.console, max_loader_workers=args.jobs)
 
 
 # Start Qt event loop unless running in interactive mode.
@@ -166,10 +166,11 @@ class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
 
         # self.setARAcolors()
         # self.lasagna.initialiseAxes(resetAxes=True)
-        self.lasagna.returnIngredientByName(
-            self.data["currentlyLoadedAtlasName"]
-        ).minMax = [0, 1.2e3]
-        self.lasagna.initialiseAxes(resetAxes=True)
+        atlas = self.lasagna.returnIngredientByName(self.data["currentlyLoadedAtlasName"])
+        atlas.minMax = [0, 1.2e3]
+        atlas.pyramidReduce = "max"  # Zoomed out views must show area labels, not means of them
+        # Drawn now, as area contours and names are looked up in the slices on display
+        self.lasagna.initialiseAxes(resetAxes=True, immediate=True)
 
     def addOverlay(self, fname):
         """
@@ -186,7 +187,7 @@ class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
         self.lasagna.returnIngredientByName(
             self.data["currentlyLoadedOverlay"]
         ).minMax = [0, 1.5e3]
-        self.lasagna.initialiseAxes(resetAxes=True)
+        self.lasagna.initialiseAxes(resetAxes=True, immediate=True)
 
     # ---------------
     # Methods to handle the tree
@@ -191,7 +191,7 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
             
         # Replace the data in the ingredient so they are plotted
         self.lasagna.returnIngredientByName(self.contourName)._data = all_contours
-        self.lasagna.initialiseAxes()
+        self.lasagna.requestRedraw(ingredients=[self.contourName], properties=["data"])
 
     def setARAcolors(self):
         # Make up a disjointed colormap
@@ -211,6 +211,7 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
         self.ARAlayerName = self.lasagna.imageStackLayers_Model.index(0, 0).data().toString()  # FIXME: a bit horrible
         first_layer = self.lasagna.returnIngredientByName(self.ARAlayerName)
         first_layer.lut = lut
+        first_layer.pyramidReduce = "max"  # The values are area labels, so they must not be averaged
         # Specify what colors the histogram should be so it doesn't end up megenta and
         # vomit-yellow, or who knows what, due to the weird color map we use here.
         first_layer.histPenCustomColor = [180, 180, 180, 255]
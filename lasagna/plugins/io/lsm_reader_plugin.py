@@ -6,6 +6,7 @@ import os
 
 import tifffile
 
+from lasagna.io_libs import image_stack_loader, volume_cache
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
 from lasagna.utils import preferences
 
@@ -31,7 +32,21 @@ class loaderClass(IoBasePlugin):
 
         color_order = preferences.readPreference('colorOrder')
         if os.path.isfile(fname): 
-            im = tifffile.imread(str(fname))
+            info = image_stack_loader.probe_stack(fname)
+            if info is not None:
+                self.lasagna.statusBar.showMessage("Loading {}: {}".format(
+                    os.path.basename(fname), image_stack_loader.describe_stack(info)))
+                if info["spacing"]:
+                    # The layers are added as (rows, cols), not transposed like other stacks, so swap x and y
+                    x, y, z = info["spacing"]
+                    ax_ratio = image_stack_loader.spacing_to_ratio([y, x, z])
+                    for i in range(len(ax_ratio)):
+                        self.lasagna.axisRatioLineEdits[i].setText(str(ax_ratio[i]))
+
+            im = volume_cache.load(fname, variant="lsm")
+            if im is None:
+                im = tifffile.imread(str(fname), maxworkers=self.lasagna.maxLoaderWorkers)  # Decompress in parallel
+                volume_cache.store(fname, im, variant="lsm")
             print("Found LSM stack with dimensions:")
             print(im.shape)
             for i in range(im.shape[2]):
@@ -0,0 +1,41 @@
+"""
+Load a directory of slices, one TIFF per plane, as a single image stack.
+
+Serial-section imaging rigs write one file per physical section. The files are sorted in
+natural order (so section_10 comes after section_9) and decoded on demand as the stack
+is browsed. There is no need to concatenate them into one file first.
+"""
+
+from PyQt5 import QtGui
+
+from lasagna.io_libs import image_stack_loader
+from lasagna.plugins.io.io_plugin_base import IoBasePlugin
+from lasagna.utils import preferences
+
+
+class loaderClass(IoBasePlugin):
+    def __init__(self, lasagna_serving):
+        self.objectName = 'slice_directory_reader'
+        self.kind = 'imagestack'
+        self.icon_name = 'overlay'
+        self.actionObjectName = 'sliceDirectoryRead'
+        super(loaderClass, self).__init__(lasagna_serving)
+
+    # Slots follow
+    def showLoadDialog(self):
+        """
+        This slot brings up a directory chooser and loads the slices in the chosen directory as one stack
+        """
+        dir_name = QtGui.QFileDialog.getExistingDirectory(
+            self.lasagna, "Directory of slices", preferences.readPreference('lastLoadDir')
+        )
+        dir_name = str(dir_name)
+        if not dir_name:
+            return
+
+        if not image_stack_loader.slice_files(dir_name):
+            self.lasagna.statusBar.showMessage("No TIFF slices found in {}".format(dir_name))
+            return
+
+        preferences.preferenceWriter('lastLoadDir', dir_name)
+        self.lasagna.loadImageStack(dir_name, asynchronous=True)  # Axes are re-drawn when loading finishes
@@ -20,10 +20,10 @@ z_position,x_position,y_position,data_series_number\n
 ...
 
 
-In the second format, each data point is associated with a scalar value.
-All points with the same scalar value are grouped together as one ingredient. 
-This allows points of different sorts to be overlaid easily on the same 
-image and have their properties changed together. 
+In the second format, each data point is associated with a value, such as a cell type.
+The points are loaded as one ingredient that colours each point by its value. When the
+values are categories (integers or names), the points of each category can be shown or
+hidden from the right-click menu of the points list.
 
 
 """
@@ -35,6 +35,26 @@ import numpy as np
 from lasagna.io_libs.sparse_point_io import read_pts_file, read_masiv_roi, read_lasagna_pts, read_cell_xml
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
 from lasagna.loader_dialog import LoaderDialog
+from lasagna.utils.loader_pool import map_ordered
+
+
+def read_points_file(fname):
+    """
+    Read a points file in any of the supported formats and return its rows as a list of lists
+    """
+    if fname.endswith('.pts'):
+        data, roi_type = read_pts_file(fname)
+        if roi_type == 'point':
+            print('!!! WARNING points are set in real world coordinates. I assume a pixel size of 1')
+    elif fname.endswith('.yml'):
+        data = read_masiv_roi(fname)
+        # re-order in lasagna order Z X Y
+        data = [[d[2], d[0], d[1], d[3]] for d in data]
+    elif fname.endswith('.xml'):
+        data = read_cell_xml(fname)
+    else:
+        data = read_lasagna_pts(fname)
+    return data
 
 
 class loaderClass(IoBasePlugin):
@@ -49,8 +69,9 @@ class loaderClass(IoBasePlugin):
     def showLoadDialog(self, fnames=None):
         """
         This slot brings up the load dialog and retrieves the file name.
-        If a filename is provided then this is loaded and no dialog is brought up.
+        If a filename (or list of file names) is provided then this is loaded and no dialog is brought up.
         If the file name is valid, it loads the image stack using the load method.
+        Multiple files are read concurrently and added in the order given.
         """
 
         if not fnames:
@@ -62,92 +83,62 @@ class loaderClass(IoBasePlugin):
                 return
             res = load_dial.get_results()
             fnames = res['fnames']
+        else:
+            # No dialog so the data are not rescaled
+            res = dict(first_slice=0, last_slice=-1, xy_scale=1, z_scale=1)
+            if isinstance(fnames, str):
+                fnames = [fnames]
 
         if not fnames:
             return
 
         for fname in fnames:
-            if os.path.isfile(fname):
-                if fname.endswith('.pts'):
-                    data, roi_type = read_pts_file(fname)
-                    if roi_type == 'point':
-                        print('!!! WARNING points are set in real world coordinates. I assume a pixel size of 1')
-                elif fname.endswith('.yml'):
-                    data = read_masiv_roi(fname)
-                    # re-order in lasagna order Z X Y
-                    data = [[d[2], d[0], d[1], d[3]] for d in data]
-                elif fname.endswith('.xml'):
-                    data = read_cell_xml(fname)
-                else:
-                    data = read_lasagna_pts(fname)
+            if not os.path.isfile(fname):
+                self.lasagna.statusBar.showMessage("Unable to find {}".format(fname))
+        fnames = [fname for fname in fnames if os.path.isfile(fname)]
 
-                # Downsample the data according to the what was entered in the dialog
-                rescaled_data = []
-                for d in data:
-                    if d[0] < res['first_slice']:
-                        continue
-                    if (res['last_slice'] != -1) and (d[1] > res['last_slice']):
-                        continue
-                    d[1] *= res['xy_scale']
-                    d[2] *= res['xy_scale']
-                    d[0] *= res['z_scale']
-                    rescaled_data.append(d)
-                data = rescaled_data
-                if not len(data):
-                    print('No data in this file for this slice range')
+        all_data = map_ordered(read_points_file, fnames, max_workers=self.lasagna.maxLoaderWorkers)
+
+        for fname, data in zip(fnames, all_data):
+            if data is not None:
+                if len(data) and len(data[0]) not in (3, 4):
+                    print(("Point series has %d columns. Only 3 or 4 columns are supported" % len(data[0])))
                     continue
+
                 # A point series should be a list of lists where each list has a length of 3,
                 # corresponding to the position of each point in 3D space. However, point
                 # series could also have a length of 4. If this is the case, the fourth
-                # value is the index of the series. This allows a single file to hold multiple
-                # different point series. We handle these two cases differently. First we deal
-                # with the the standard case:
-                if len(data[0]) == 3:
-                    # Create an ingredient with the same name as the file name
-
-                    obj_name = fname.split(os.path.sep)[-1]
-                    self.lasagna.addIngredient(objectName=obj_name,
-                                               kind=self.kind,
-                                               data=np.asarray(data),
-                                               fname=fname
-                                               )
-                    # Add this ingredient to all three plots
-                    self.lasagna.returnIngredientByName(obj_name).addToPlots()
-                    # Update the plots
-                    self.lasagna.initialiseAxes()
-
-                elif len(data[0]) == 4:
-                    # What are the unique data series values?
-                    d_series = [x[3] for x in data]
-                    d_series = list(set(d_series))
-
-                    # Loop through these unique series and add as separate sparse point objects
-
-                    for idx in d_series:
-                        tmp = []
-                        for row in data:
-                            if row[3] == idx:
-                                tmp.append(row[:3])
-
-                        print("Adding point series %d with %d points" % (idx, len(tmp)))
-
-                        # Create an ingredient with the same name as the file name
-                        obj_name = "%s #%d" % (fname.split(os.path.sep)[-1], idx)
-
-                        self.lasagna.addIngredient(objectName=obj_name,
-                                                   kind=self.kind,
-                                                   data=np.asarray(tmp),
-                                                   fname=fname
-                                                   )
-
-                        # Add this ingredient to all three plots
-                        self.lasagna.returnIngredientByName(obj_name).addToPlots()
-
-                        # Update the plots
-                        self.lasagna.initialiseAxes()
-
-                else:
-                    print(("Point series has %d columns. Only 3 or 4 columns are supported" % len(data[1])))
-
-            else:
-                self.lasagna.statusBar.showMessage("Unable to find {}".format(fname))
+                # value is an attribute of the point, e.g. the index of the series. This
+                # allows a single file to hold multiple different point series.
+                coords = np.array([d[:3] for d in data], dtype=float).reshape(-1, 3)
+                attribute = np.asarray([d[3] for d in data]) if len(data) and len(data[0]) == 4 else None
+
+                # Downsample the data according to the what was entered in the dialog
+                keep = coords[:, 0] >= res['first_slice']
+                if res['last_slice'] != -1:
+                    keep &= coords[:, 1] <= res['last_slice']
+                coords = coords[keep]
+                coords[:, 1:] *= res['xy_scale']
+                coords[:, 0] *= res['z_scale']
+                if attribute is not None:
+                    attribute = attribute[keep]
+                if not len(coords):
+                    print('No data in this file for this slice range')
+                    continue
+
+                # Create an ingredient with the same name as the file name
+                obj_name = fname.split(os.path.sep)[-1]
+                self.lasagna.addIngredient(objectName=obj_name,
+                                           kind=self.kind,
+                                           data=coords,
+                                           fname=fname,
+                                           attribute=attribute
+                                           )
+                ingredient = self.lasagna.returnIngredientByName(obj_name)
+                if ingredient.categories is not None:
+                    print("Adding %d points in %d categories" % (len(coords), len(ingredient.categories)))
+
+                # Add this ingredient to all three plots
+                ingredient.addToPlots()
+                # Update the plots
+                self.lasagna.initialiseAxes()
@@ -0,0 +1,65 @@
+"""
+Load a cropped and/or downsampled image stack.
+
+Only the slices in the chosen range are read and, if the stack is downsampled, only every n-th
+plane, row and column (or the mean of each n x n x n block). This makes it possible to open a
+low-resolution preview of a stack that is too large to fit in RAM.
+
+The scale values in the dialog set the downsampling: a scale of 0.25 keeps one voxel in four.
+Scales above 1 are not supported for image stacks and are treated as 1.
+"""
+
+import os
+
+from PyQt5.QtWidgets import QCheckBox, QDialog
+
+from lasagna.io_libs import image_stack_loader
+from lasagna.loader_dialog import LoaderDialog
+from lasagna.plugins.io.io_plugin_base import IoBasePlugin
+
+
+def scale_to_step(scale):
+    """
+    Convert a scale (e.g. 0.25) into an integer stride (e.g. 4)
+    """
+    if scale <= 0 or scale >= 1:
+        return 1
+    return max(1, int(round(1.0 / scale)))
+
+
+class loaderClass(IoBasePlugin):
+    def __init__(self, lasagna_serving):
+        self.objectName = 'subvolume_stack_reader'
+        self.kind = 'imagestack'
+        self.icon_name = 'overlay'
+        self.actionObjectName = 'subvolumeStackRead'
+        super(loaderClass, self).__init__(lasagna_serving)
+
+    # Slots follow
+    def showLoadDialog(self):
+        """
+        This slot brings up the load dialog and retrieves the file names, the slice range and the scales.
+        Each stack is then read on a worker thread, loading only the data that are needed.
+        """
+        load_dial = LoaderDialog(fileFilter=image_stack_loader.image_filter())
+        load_dial.setWindowTitle("Load part of an image stack")
+        block_mean_check_box = QCheckBox("Average blocks of voxels when downsampling", load_dial)
+        load_dial.verticalLayout_2.insertWidget(load_dial.verticalLayout_2.count() - 1, block_mean_check_box)
+        if load_dial.exec_() != QDialog.Accepted:
+            return
+        res = load_dial.get_results()
+
+        # The slice range applies to the first axis. The last slice is included.
+        last_slice = None if res['last_slice'] == -1 else res['last_slice'] + 1
+        roi = ((res['first_slice'], last_slice), None, None)
+        xy_step = scale_to_step(res['xy_scale'])
+        step = (scale_to_step(res['z_scale']), xy_step, xy_step)
+
+        for fname in res['fnames']:
+            if not fname:
+                continue
+            if os.path.isfile(fname):
+                self.lasagna.loadImageStack(fname, asynchronous=True, roi=roi, step=step,
+                                            blockMean=block_mean_check_box.isChecked())
+            else:
+                self.lasagna.statusBar.showMessage("Unable to find {}".format(fname))
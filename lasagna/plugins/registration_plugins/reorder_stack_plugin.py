@@ -116,6 +116,7 @@ class plugin(LasagnaPlugin, QtGui.QWidget, reorder_stack_UI.Ui_reorderStack):  #
         for stck_name in values:
             stk = self.lasagna.returnIngredientByName(str(stck_name))
             stk._data = stk._data[order, :, :]
+        self.lasagna.initialiseAxes(immediate=True)  # Show the reordered stack before the slice list is rebuilt
         self.initialise()
 
     # The following methods are involved in shutting down the plugin window
@@ -65,9 +65,11 @@ class plugin(
 
         # Extract data from base image
         if image_item is not None:
-            if image_item.image.shape[1] <= y or y < 0:
+            # Slices rendered in the background are shown as RGBA. Their intensities are kept in dataPlane.
+            image = getattr(image_item, "dataPlane", image_item.image)
+            if image.shape[1] <= y or y < 0:
                 return
-            x_data = image_item.image[:, y]
+            x_data = image[:, y]
 
             self.graphicsView.clear()
             self.graphicsView.plot(x_data)
@@ -0,0 +1,97 @@
+"""
+Rate-limit a signal according to how long its slot takes to run.
+
+pg.SignalProxy delivers at most a fixed number of signals per second. When the slot is cheap this
+makes the UI lag behind the mouse, and when it is expensive the deliveries still pile up.
+AdaptiveSignalProxy measures how long each delivery takes, including the events Qt processes
+straight after it (such as repainting), and spaces deliveries so that the slot uses about "load"
+of the time. Only the latest arguments are delivered: positions that arrive while a delivery is
+waiting replace each other, so the UI always catches up with the cursor.
+
+As with pg.SignalProxy the slot receives the signal arguments as one tuple, and self.sender() in
+the slot is the proxy, so attributes set on the proxy (e.g. axisID) are available to the slot.
+"""
+
+import time
+
+from PyQt5 import QtCore
+
+
+class AdaptiveSignalProxy(QtCore.QObject):
+    sigDelayed = QtCore.pyqtSignal(object)
+
+    def __init__(self, signal, slot=None, minInterval=0.005, maxInterval=0.25, load=0.5, busy=None,
+                 parent=None):
+        """
+        signal - the signal to rate-limit
+        slot - called with the tuple of the latest signal arguments
+        minInterval, maxInterval - bounds, in seconds, on the time between deliveries
+        load - the fraction of the time the slot may use
+        busy - optional callable. While it returns True deliveries are held back (for at most maxInterval),
+               e.g. because the slices requested by the last delivery are still being rendered.
+        """
+        super(AdaptiveSignalProxy, self).__init__(parent)
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.load = load
+        self.busy = busy
+
+        self.interval = minInterval  # The current time between deliveries
+        self.meanCost = 0.0  # Smoothed duration of a delivery in seconds
+        self.received = 0
+        self.delivered = 0
+
+        self._args = None  # The arguments waiting to be delivered
+        self._lastDelivery = 0.0
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+
+        signal.connect(self.signalReceived)
+        if slot is not None:
+            self.sigDelayed.connect(slot)
+
+    def signalReceived(self, *args):
+        self.received += 1
+        self._args = args  # Replaces any arguments not yet delivered
+        if self._timer.isActive():
+            return
+        wait = self._lastDelivery + self.interval - time.perf_counter()
+        self._timer.start(max(0, int(wait * 1000)))
+
+    def flush(self):
+        """
+        Deliver the latest arguments now, unless the consumer is busy
+        """
+        if self._args is None:
+            return
+        if self.busy is not None and self.busy() and \
+                time.perf_counter() - self._lastDelivery < self.maxInterval:
+            self._timer.start(max(1, int(self.minInterval * 1000)))
+            return
+
+        args, self._args = self._args, None
+        start = time.perf_counter()
+        self._lastDelivery = start
+        self.delivered += 1
+        self.sigDelayed.emit(args)
+        # The zero timer fires once Qt has handled the events queued by the slot, e.g. repaints
+        QtCore.QTimer.singleShot(0, lambda: self.measured(time.perf_counter() - start))
+
+    def measured(self, cost):
+        """
+        Update the interval between deliveries from the cost of the last one
+        """
+        self.meanCost = cost if self.delivered == 1 else 0.8 * self.meanCost + 0.2 * cost
+        interval = self.meanCost * (1 - self.load) / self.load
+        self.interval = min(self.maxInterval, max(self.minInterval, interval))
+
+    def dropped(self):
+        """
+        Return the number of signals that were replaced by newer ones before they were delivered
+        """
+        return self.received - self.delivered - (self._args is not None)
+
+    def counters(self):
+        return dict(received=self.received, delivered=self.delivered, dropped=self.dropped(),
+                    interval=self.interval, meanCost=self.meanCost)
@@ -0,0 +1,71 @@
+"""
+Run slow functions (loading, saving, etc) on a worker thread so that the GUI stays responsive.
+
+The function is called with a "progress" keyword argument. This is a callable that takes the
+fraction done (0 to 1) and an optional message. It is also the point at which cancellation
+happens: once the task has been cancelled the next call to progress raises TaskCancelled.
+Functions that never call progress simply run to completion and their result is discarded.
+So a task stops between the files or planes it reports on. A single call that reports nothing,
+such as decoding a whole compressed file or waiting on a process pool, runs to the end first.
+"""
+
+from PyQt5 import QtCore
+
+
+class TaskCancelled(Exception):
+    """
+    Raised inside a background function when the user cancels the task
+    """
+    pass
+
+
+class BackgroundTask(QtCore.QThread):
+    progressed = QtCore.pyqtSignal(int, str)  # percent done, message
+    succeeded = QtCore.pyqtSignal(object)  # the value returned by the function
+    failed = QtCore.pyqtSignal(str)  # the error message
+    cancelled = QtCore.pyqtSignal()
+
+    def __init__(self, func, *args, description="", parent=None, **kwargs):
+        """
+        func - the function to run. It is called as func(*args, progress=callback, **kwargs)
+        description - short text shown in the status bar while the task runs
+        """
+        super(BackgroundTask, self).__init__(parent)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.description = description
+        self._cancelled = False
+
+    def run(self):
+        try:
+            result = self.func(*self.args, progress=self.reportProgress, **self.kwargs)
+        except TaskCancelled:
+            self.cancelled.emit()
+            return
+        except Exception as err:  # Report any failure to the GUI rather than losing it in the thread
+            print("{} failed: {}".format(self.description, err))
+            self.failed.emit(str(err))
+            return
+
+        if self._cancelled:
+            self.cancelled.emit()
+        else:
+            self.succeeded.emit(result)
+
+    def reportProgress(self, fraction, message=""):
+        """
+        Progress callback handed to the function. Raises TaskCancelled if the task was cancelled.
+        """
+        if self._cancelled:
+            raise TaskCancelled
+        self.progressed.emit(int(round(100 * fraction)), message)
+
+    def cancel(self):
+        """
+        Ask the task to stop. The function stops at its next progress report.
+        """
+        self._cancelled = True
+
+    def isCancelled(self):
+        return self._cancelled
@@ -0,0 +1,92 @@
+"""
+Decorations that follow the mouse in one axis: the cross hairs, hover highlights and the like.
+
+Adding items to and removing them from a PlotWidget changes the scene graph, which makes Qt and
+pyqtgraph recompute bounds and indexes. Doing so on every mouse move is a large part of the cost
+of moving the mouse over the views. The overlay instead adds each decoration once, ignored when the
+view range is computed and above all ingredients, and afterwards only moves, restyles, shows or
+hides it. Restyling and showing are skipped when nothing changed.
+"""
+
+import pyqtgraph as pg
+
+
+class CursorOverlay(object):
+    Z_VALUE = 1000  # Above every ingredient
+
+    def __init__(self, projection):
+        """
+        projection - the lasagna_axis.projection2D whose PlotWidget shows the decorations
+        """
+        self.projection = projection
+        self.decorations = {}  # name -> plot item
+        self._pens = {}  # name -> the pen colour last set
+
+    def addDecoration(self, name, item):
+        """
+        Add plot item "item" to the overlay, hidden, and return it. It is given the objectName name.
+        """
+        self.removeDecoration(name)
+        item.objectName = name
+        item.setZValue(self.Z_VALUE)
+        item.setVisible(False)
+        self.projection.view.addItem(item, ignoreBounds=True)
+        self.decorations[name] = item
+        return item
+
+    def removeDecoration(self, name):
+        item = self.decorations.pop(name, None)
+        self._pens.pop(name, None)
+        if item is not None:
+            self.projection.view.removeItem(item)
+
+    def decoration(self, name):
+        return self.decorations.get(name)
+
+    def setVisible(self, name, visible=True):
+        item = self.decorations.get(name)
+        if item is not None and item.isVisible() != visible:
+            item.setVisible(visible)
+
+    def hideAll(self):
+        for name in self.decorations:
+            self.setVisible(name, False)
+
+    def setPen(self, name, color):
+        """
+        Set the pen colour of decoration name, unless it already has that colour
+        """
+        color = tuple(color)
+        item = self.decorations.get(name)
+        if item is not None and self._pens.get(name) != color:
+            item.setPen(*color)
+            self._pens[name] = color
+
+    # Cross hairs
+    def addCrossHairs(self, color=(220, 200, 0, 180)):
+        """
+        Add the vertical and horizontal lines of the cross hairs, named crossHairVLine and crossHairHLine
+        """
+        for name, angle in (("crossHairVLine", 90), ("crossHairHLine", 0)):
+            self.addDecoration(name, pg.InfiniteLine(pen=color, angle=angle, movable=False))
+            self._pens[name] = tuple(color)
+
+    def hasCrossHairs(self):
+        return "crossHairVLine" in self.decorations
+
+    def showCrossHairs(self, x, y, color):
+        """
+        Centre the cross hairs on the pixel at x, y and draw them in colour color
+        """
+        for name, pos in (("crossHairVLine", x + 0.5), ("crossHairHLine", y + 0.5)):  # Middle of the pixel
+            item = self.decorations.get(name)
+            if item is None:
+                continue
+            self.setPen(name, color)
+            if item.value() != pos:
+                item.setPos(pos)
+            self.setVisible(name, True)
+
+    def hideCrossHairs(self):
+        self.setVisible("crossHairVLine", False)
+        self.setVisible("crossHairHLine", False)
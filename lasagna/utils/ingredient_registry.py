@@ -0,0 +1,93 @@
+"""
+The ingredients loaded into Lasagna, indexed by objectName and by kind.
+
+Ingredients are looked up by name or kind many times for each redraw, hook and mouse move.
+The registry answers these lookups from dictionaries, so their cost does not grow with the
+number of ingredients loaded. The kind of an ingredient is the name of the ingredients module
+that defines it: imagestack, sparsepoints or lines.
+
+Lasagna keeps the registry in sync in addIngredient and removeIngredient. Plugins reach it as
+lasagna.ingredientRegistry, but normally use Lasagna.returnIngredientByName and
+Lasagna.returnIngredientByType.
+"""
+
+import collections
+
+
+class IngredientRegistry(object):
+    def __init__(self):
+        self._byName = collections.OrderedDict()  # objectName -> ingredient, in the order they were added
+        self._byKind = {}  # kind -> OrderedDict of objectName -> ingredient
+        self._list = None  # Cached list of all ingredients [see ingredients()]
+
+    @staticmethod
+    def kindOf(ingredient):
+        return ingredient.__module__.split(".")[-1]
+
+    def add(self, ingredient):
+        """
+        Add ingredient, replacing any ingredient with the same objectName
+        """
+        self.remove(ingredient.objectName)
+        self._byName[ingredient.objectName] = ingredient
+        self._byKind.setdefault(self.kindOf(ingredient), collections.OrderedDict())[ingredient.objectName] = ingredient
+        self._list = None
+
+    def remove(self, objectName):
+        """
+        Remove the ingredient called objectName and return it, or None if there is none
+        """
+        ingredient = self._byName.pop(objectName, None)
+        if ingredient is None:
+            return None
+        of_kind = self._byKind[self.kindOf(ingredient)]
+        del of_kind[objectName]
+        if not of_kind:
+            del self._byKind[self.kindOf(ingredient)]
+        self._list = None
+        return ingredient
+
+    def byName(self, objectName):
+        """
+        Return the ingredient called objectName, or None
+        """
+        return self._byName.get(objectName)
+
+    def byKind(self, kind):
+        """
+        Return the ingredients of the given kind (e.g. "imagestack") in the order they were added.
+        As before the registry existed, a kind also matches the kinds that end with it.
+        """
+        of_kind = self._byKind.get(kind)
+        if of_kind is not None:
+            return list(of_kind.values())
+        kinds = [k for k in self._byKind if k.endswith(kind)]
+        if not kinds:
+            return []
+        return [ingredient for ingredient in self.ingredients() if self.kindOf(ingredient) in kinds]
+
+    def names(self, kind=None):
+        """
+        Return the objectNames of all ingredients, or only of those of the given kind
+        """
+        if kind is None:
+            return list(self._byName)
+        return list(self._byKind.get(kind, ()))
+
+    def ingredients(self):
+        """
+        Return all ingredients in the order they were added. The list is shared until
+        the next change, so it must not be modified.
+        """
+        if self._list is None:
+            self._list = list(self._byName.values())
+        return self._list
+
+    def __len__(self):
+        return len(self._byName)
+
+    def __contains__(self, objectName):
+        return objectName in self._byName
+
+    def __iter__(self):
+        return iter(self.ingredients())
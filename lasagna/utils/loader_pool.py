@@ -0,0 +1,61 @@
+"""
+Read several files at once while keeping the order in which they were requested.
+
+Threads are used for work that mostly waits on the disk (or releases the GIL, like numpy).
+Processes are used for work that is dominated by decompression in Python-level code.
+Process pools use the "spawn" start method so that worker processes never inherit a copy
+of the running Qt application.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+
+def default_max_workers():
+    """
+    The number of workers used when the caller does not cap the parallelism
+    """
+    return os.cpu_count() or 1
+
+
+def thread_pool(max_workers=None):
+    if max_workers is None:
+        max_workers = default_max_workers()
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers))
+
+
+def process_pool(max_workers=None):
+    if max_workers is None:
+        max_workers = default_max_workers()
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, max_workers), mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def map_ordered(func, items, max_workers=None, use_processes=False):
+    """
+    Run func on each of items concurrently and return the results in the order of items.
+    If func fails for an item, the error is printed and the result for that item is None.
+    With use_processes, func and the items must be picklable (e.g. module-level functions).
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    if max_workers is None:
+        max_workers = default_max_workers()
+    max_workers = min(max_workers, len(items))
+
+    pool = process_pool(max_workers) if use_processes else thread_pool(max_workers)
+    with pool:
+        futures = [pool.submit(func, item) for item in items]
+        return [_result_or_none(future, item) for future, item in zip(futures, items)]
+
+
+def _result_or_none(future, item):
+    try:
+        return future.result()
+    except Exception as err:  # One bad file should not stop the others from loading
+        print("Failed to read {}: {}".format(item, err))
+        return None
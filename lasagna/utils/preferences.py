@@ -39,6 +39,25 @@ def defaultPreferences():
             'defaultSymbolSize': 8,
             'hideZoomResetButtonOnImageAxes': True,
             'hideAxes': True,
+            'lazyStackCacheMB': 1024,               # Memory budget for decoded planes of each lazily loaded stack
+            'volumeCacheMB': 10240,                 # Disk space for decoded copies of compressed stacks. 0 disables the cache.
+            'renderSlicesInBackground': True,       # Scale and colour image slices on worker threads
+            'prefetchSlices': 8,                    # Maximum number of slices prepared ahead while scrolling. 0 disables prefetching.
+            'prefetchCacheMB': 256,                 # Memory for slices prepared ahead of time
+            'compositeStacks': False,               # Blend all image stacks of an axis into one image with numpy rather than with Qt
+            'clipToViewport': True,                 # Only draw the part of large image planes that is in view
+            'renderTileSize': 512,                  # Size in pixels of the tiles in which planes are drawn when clipped to the view
+            'tileCacheMB': 256,                     # Memory for tiles re-used while panning
+            'pyramidCacheMB': 128,                  # Memory for the downsampled slices of each image stack shown when zoomed out
+            'interactionDownsample': 4,             # Image stacks are drawn this many times coarser while dragging, zooming or scrolling. 1 disables this.
+            'interactionMaxPoints': 20000,          # At most this many points per layer are drawn while dragging, zooming or scrolling. 0 disables this.
+            'refineDelayMs': 150,                   # Idle time after which coarse drawing is replaced by full resolution
+            'orientedCopiesMB': 2048,               # RAM for contiguous copies of stacks, which speed up slicing in views 2 and 3. 0 disables them.
+            'mouseMoveMinIntervalMs': 5,            # Shortest time between updates of the views as the mouse moves
+            'mouseMoveMaxIntervalMs': 250,          # Longest time between updates, however slow drawing is
+            'mouseMoveLoad': 0.5,                   # Fraction of the time spent updating the views as the mouse moves
+            'densityMapPoints': 50000,              # Point layers with more points than this in view are drawn as a density map. 0 disables this.
+            'densityMapBinPixels': 2,               # Size in screen pixels of the bins of density maps
             }
 
 
@@ -0,0 +1,102 @@
+"""
+Coalesce redraw requests so that one user action causes at most one redraw.
+
+Slots, hooks and plugins ask for a redraw by calling RedrawScheduler.request, saying which
+ingredients, axes and properties changed. The requests are merged and the redraw is performed
+once, when control returns to the Qt event loop. Only the plot items of the changed ingredients
+on the changed axes are redrawn, and the histogram is only rebuilt if something it shows changed.
+
+The counters "requested" and "performed" show how many redraws were asked for and how many
+were actually done.
+"""
+
+from PyQt5 import QtCore
+
+# Changes that alter what the intensity histogram shows
+HISTOGRAM_PROPERTIES = {"all", "data", "lut", "alpha", "ingredients", "histogram"}
+
+
+class RedrawScheduler(QtCore.QObject):
+    def __init__(self, redraw, parent=None):
+        """
+        redraw - callable that performs a redraw. It is called with the keyword arguments
+                 ingredients (list of names or None for all), axes (list of axis indices or None
+                 for all), properties (set of names), resetToMiddleLayer and resetAxes.
+        """
+        super(RedrawScheduler, self).__init__(parent)
+        self.redraw = redraw
+        self.requested = 0
+        self.performed = 0
+        self._clear()
+
+    def _clear(self):
+        self._scheduled = False
+        self._ingredients = set()  # None means all ingredients
+        self._axes = set()  # None means all axes
+        self._properties = set()
+        self._resetToMiddleLayer = False
+        self._resetAxes = False
+
+    def request(self, ingredients=None, axes=None, properties=("all",),
+                resetToMiddleLayer=False, resetAxes=False):
+        """
+        Ask for a redraw at the end of the current event loop turn.
+        ingredients - ingredient names (or ingredient objects) whose plot items changed. None means all.
+        axes - indices of the axes to redraw. None means all of them.
+        properties - names of what changed, e.g. "lut", "alpha", "data", "symbol", "slice".
+                     "all" means anything may have changed.
+        resetToMiddleLayer - show the middle layer of the stacks
+        resetAxes - also zoom the axes to fit the data
+        """
+        self.requested += 1
+
+        if ingredients is None or self._ingredients is None:
+            self._ingredients = None
+        else:
+            self._ingredients.update(getattr(i, "objectName", i) for i in ingredients)
+
+        if axes is None or self._axes is None:
+            self._axes = None
+        else:
+            self._axes.update(axes)
+
+        self._properties.update(properties)
+        self._resetToMiddleLayer = self._resetToMiddleLayer or resetToMiddleLayer or resetAxes
+        self._resetAxes = self._resetAxes or resetAxes
+
+        if not self._scheduled:
+            self._scheduled = True
+            QtCore.QTimer.singleShot(0, self.flush)
+
+    def flush(self):
+        """
+        Perform the pending redraw now, if there is one. Call this when the plots must be up to date
+        before control returns to the event loop.
+        """
+        if not self._scheduled:
+            return
+
+        ingredients = None if self._ingredients is None else sorted(self._ingredients)
+        axes = None if self._axes is None else sorted(self._axes)
+        properties = set(self._properties)
+        resetToMiddleLayer = self._resetToMiddleLayer
+        resetAxes = self._resetAxes
+        self._clear()  # Requests made while redrawing are scheduled for the next turn
+
+        self.performed += 1
+        self.redraw(
+            ingredients=ingredients,
+            axes=axes,
+            properties=properties,
+            resetToMiddleLayer=resetToMiddleLayer,
+            resetAxes=resetAxes,
+        )
+
+    def isPending(self):
+        return self._scheduled
+
+    def counters(self):
+        """
+        Return a dictionary with the number of redraws requested and performed
+        """
+        return dict(requested=self.requested, performed=self.performed)
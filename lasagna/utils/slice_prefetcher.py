@@ -0,0 +1,189 @@
+"""
+Prepare the slices the user is about to see while they scroll through image stacks.
+
+The prefetcher is told each time the wheel or a ctrl-drag changes the slice shown in an axis.
+From the last few changes it estimates the direction, stride and speed of the movement and
+prepares the next slices along the way on worker threads: they are read from disk (for lazily
+loaded stacks) and, if slices are rendered in the background, coloured [see slice_renderer].
+The results are kept in a cache of bounded size, from which imagestack takes them when the
+slice is plotted.
+
+The faster the user scrolls, the further ahead slices are prepared, up to "ahead" slices per axis.
+stats() reports how often a plotted slice was found in the cache, which is what to look at when
+tuning "ahead" (the "prefetchSlices" preference).
+"""
+
+import collections
+import math
+import threading
+import time
+
+from lasagna.utils import loader_pool
+
+
+class SlicePrefetcher(object):
+    def __init__(self, lasagna, ahead=8, max_bytes=256 * 2 ** 20, max_workers=2,
+                 lookahead_seconds=0.5, gesture_gap_seconds=0.5):
+        """
+        lasagna - the Lasagna instance, from which the image stacks are obtained
+        ahead - the maximum number of slices prepared ahead of the current one in each axis
+        max_bytes - the size of the cache of prepared slices
+        max_workers - number of threads preparing slices
+        lookahead_seconds - slices that will be reached within this time are prepared
+        gesture_gap_seconds - a pause longer than this starts a new movement, whose speed is unknown
+        """
+        self.lasagna = lasagna
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+        self.lookahead_seconds = lookahead_seconds
+        self.gesture_gap_seconds = gesture_gap_seconds
+
+        self._pool = loader_pool.thread_pool(max_workers)
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # key -> (result, size in bytes). Least recently used first.
+        self._cachedBytes = 0
+        self._pending = set()  # keys of the slices being prepared
+        self._motion = {}  # axisToPlot -> the last slice shown, when, and the speed in slices per second
+        self._generation = {}  # axisToPlot -> number of the latest prediction. Older ones are abandoned.
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.skipped = 0
+
+    def sliceChanged(self, projection, sliceIndex):
+        """
+        Record that the lasagna_axis.projection2D "projection" now shows slice sliceIndex and
+        prefetch the slices predicted to follow
+        """
+        axis = projection.axisToPlot
+        now = time.time()
+        motion = self._motion.get(axis)
+        self._motion[axis] = dict(slice=sliceIndex, time=now, speed=0.0)
+        if motion is None:
+            return  # The direction is not known yet
+
+        step = sliceIndex - motion["slice"]
+        if step == 0:
+            self._motion[axis] = motion
+            return
+
+        elapsed = max(now - motion["time"], 1e-3)
+        speed = abs(step) / elapsed
+        if elapsed < self.gesture_gap_seconds:
+            speed = 0.5 * (speed + motion["speed"])  # Smooth out irregular event timing
+        self._motion[axis]["speed"] = speed
+
+        # Ctrl-drag may skip slices, so the stride follows the last step
+        stride = abs(step)
+        n_ahead = int(math.ceil(speed * self.lookahead_seconds / stride))
+        n_ahead = min(self.ahead, max(2, n_ahead))
+        direction = 1 if step > 0 else -1
+        targets = [sliceIndex + direction * stride * n for n in range(1, n_ahead + 1)]
+        self.prefetch(projection, targets)
+
+    def prefetch(self, projection, targets):
+        """
+        Prepare slices targets (nearest first) of every image stack in the axis projection.
+        Slices still waiting from earlier predictions for this axis are abandoned.
+        """
+        axis = projection.axisToPlot
+        generation = self._generation.get(axis, 0) + 1
+        self._generation[axis] = generation
+
+        stacks = self.lasagna.returnIngredientByType("imagestack") or []
+        colour = getattr(self.lasagna, "sliceRenderer", None) is not None
+        for target in targets:
+            for stack in stacks:
+                job = stack.prefetchJob(axis, target, projection.currentPyramidFactor, colour,
+                                        projection.currentRegion)
+                if job is None:
+                    continue
+                key, func = job
+                with self._lock:
+                    if key in self._cache or key in self._pending:
+                        continue
+                    self._pending.add(key)
+                self._pool.submit(self._prepare, axis, generation, key, func)
+
+    def lookup(self, key, count=True):
+        """
+        Return the prepared result for key, or None if it has not been prefetched.
+        Only lookups with count True go into the hit and miss statistics. Callers pass False when
+        the slice is redrawn for another reason than moving to it, e.g. new levels or a pan, as
+        the prefetcher does not try to predict those.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def stats(self):
+        """
+        Return a dictionary of prefetch statistics: the number of plotted slices that were found in
+        the cache (hits) and not (misses) on moving to them, the hit rate, the number of slices prepared, the number
+        of predicted slices abandoned before they were prepared, and the size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hitRate=float(self.hits) / lookups if lookups else 0.0,
+                prefetched=self.prefetched,
+                skipped=self.skipped,
+                cachedSlices=len(self._cache),
+                cachedBytes=self._cachedBytes,
+            )
+
+    def resetStats(self):
+        with self._lock:
+            self.hits = self.misses = self.prefetched = self.skipped = 0
+
+    def clear(self):
+        """
+        Empty the cache of prepared slices
+        """
+        with self._lock:
+            self._cache.clear()
+            self._cachedBytes = 0
+
+    def shutdown(self):
+        self._generation.clear()
+        self._pool.shutdown(wait=False)
+        self.clear()
+
+    def _prepare(self, axis, generation, key, func):
+        try:
+            if self._generation.get(axis) != generation:
+                with self._lock:
+                    self.skipped += 1  # The user changed direction or stopped
+                return
+            result = func()
+        except Exception as err:  # Report the failure rather than losing it in the pool
+            print("Failed to prefetch slice: {}".format(err))
+            return
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+        self._store(key, result)
+
+    def _store(self, key, result):
+        nbytes = sum(part.nbytes for part in result if part is not None)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self.prefetched += 1
+            if key in self._cache:
+                return
+            self._cache[key] = (result, nbytes)
+            self._cachedBytes += nbytes
+            while self._cachedBytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._cache.popitem(last=False)
+                self._cachedBytes -= evicted_bytes
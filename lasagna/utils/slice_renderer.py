@@ -0,0 +1,229 @@
+"""
+Render image stack slices on worker threads so the GUI thread only swaps finished images into plot items.
+
+Extracting a slice, scaling it to the display levels and applying the lookup table are done by numpy,
+which releases the GIL, so several slices are rendered in parallel while the GUI stays responsive.
+The result is an RGBA uint8 image that an ImageItem shows without further processing.
+
+Each request has a key, normally the plot item that will show the image. A newer request with the
+same key supersedes the older ones: those not yet started are skipped and the results of those
+already running are discarded. When the user drags through a stack only the latest slice is shown.
+
+When only part of a large plane is in view, that part is coloured in tiles (render_tiled) that are
+kept in a TileCache, so panning only colours the tiles that come into view.
+"""
+
+import collections
+import itertools
+import threading
+
+import numpy as np
+from PyQt5 import QtCore
+
+from lasagna.utils import loader_pool
+
+# Intensity-to-colour tables for integer data, keyed by (dtype, levels, lookup table) [see render_slice]
+_COLOR_TABLES = {}
+_COLOR_TABLES_LOCK = threading.Lock()
+_MAX_COLOR_TABLES = 32
+
+
+def render_slice(plane, levels, lut):
+    """
+    Map the intensities of the 2D array plane to colours. Values at or below levels[0] get the first
+    entry of the lookup table lut and values at or above levels[1] the last one. Returns an RGBA
+    uint8 array with the shape of plane plus a final axis of length 4.
+    This does not touch the GUI so it can be run on a worker thread.
+    """
+    plane = np.asarray(plane)
+    lut = np.asarray(lut, dtype=np.ubyte)
+
+    # 8 and 16 bit images are coloured with one table lookup per pixel
+    if plane.dtype.kind in "ui" and plane.dtype.itemsize <= 2:
+        table = color_table(plane.dtype, levels, lut)
+        offset = np.iinfo(plane.dtype).min
+        if offset:
+            plane = plane.astype(np.int32) - offset
+        return table.take(plane, axis=0)
+
+    return lut.take(lut_indices(plane, levels, len(lut)), axis=0)
+
+
+def lut_indices(values, levels, n_colors):
+    """
+    Return the lookup table index of each value for the display range levels.
+    The scaling is the one pyqtgraph's ImageItem uses, so the images look the same.
+    """
+    low, high = float(levels[0]), float(levels[1])
+    scale = n_colors / (high - low) if high != low else 0.0
+    indices = (np.asarray(values, dtype=np.float32) - low) * scale
+    np.clip(indices, 0, n_colors - 1, out=indices)
+    return indices.astype(np.intp)
+
+
+def color_table(dtype, levels, lut):
+    """
+    Return an array giving the RGBA colour of every value of the integer type dtype, starting from
+    its minimum value. Tables are kept for re-use, as only the slice changes while scrolling.
+    """
+    key = (np.dtype(dtype).str, float(levels[0]), float(levels[1]), lut.tobytes())
+    with _COLOR_TABLES_LOCK:
+        table = _COLOR_TABLES.get(key)
+    if table is not None:
+        return table
+
+    info = np.iinfo(dtype)
+    table = lut.take(lut_indices(np.arange(info.min, info.max + 1), levels, len(lut)), axis=0)
+    with _COLOR_TABLES_LOCK:
+        if len(_COLOR_TABLES) >= _MAX_COLOR_TABLES:
+            _COLOR_TABLES.clear()
+        _COLOR_TABLES[key] = table
+    return table
+
+
+def render_tiled(plane, offset, tile_size, levels, lut, cache=None, key=()):
+    """
+    Colour plane like render_slice, one tile at a time. The tiles are squares of tile_size pixels on a
+    grid anchored at the origin of the full plane, of which plane is the part starting at offset.
+    With a TileCache, tiles are looked up by key plus their grid position, so when the user pans
+    only the tiles that came into view are coloured.
+    """
+    image = np.empty(plane.shape + (4,), dtype=np.ubyte)
+    for i in range(0, plane.shape[0], tile_size):
+        for j in range(0, plane.shape[1], tile_size):
+            part = plane[i:i + tile_size, j:j + tile_size]
+            tile_key = key + ((offset[0] + i) // tile_size, (offset[1] + j) // tile_size, part.shape)
+            tile = None if cache is None else cache.get(tile_key)
+            if tile is None:
+                tile = render_slice(part, levels, lut)
+                if cache is not None:
+                    cache.put(tile_key, tile)
+            image[i:i + tile_size, j:j + tile_size] = tile
+    return image
+
+
+class TileCache(object):
+    """
+    Least recently used cache of rendered tiles, holding at most max_bytes. It can be used from any thread.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._tiles = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._nbytes += tile.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._nbytes = 0
+
+
+class SliceRenderer(QtCore.QObject):
+    rendered = QtCore.pyqtSignal(object, object, object)  # key, generation, result
+
+    def __init__(self, max_workers=None, parent=None):
+        """
+        max_workers - number of rendering threads. None means one per CPU.
+        """
+        super(SliceRenderer, self).__init__(parent)
+        self._pool = loader_pool.thread_pool(max_workers)
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+        self._latest = {}  # key -> generation of the newest request
+        self._callbacks = {}  # key -> function called with the newest result
+        self.delivered = 0
+        self.dropped = 0
+        self.rendered.connect(self._deliver)  # Queued to the GUI thread when emitted by a worker
+
+    def submit(self, key, func, callback):
+        """
+        Run func() on a worker thread, then call callback with its result on the GUI thread,
+        unless a newer request with the same key has been submitted in the meantime.
+        Returns the generation number of the request.
+        """
+        generation = next(self._generations)
+        with self._lock:
+            self._latest[key] = generation
+            self._callbacks[key] = callback
+        self._pool.submit(self._render, key, generation, func)
+        return generation
+
+    def isCurrent(self, key, generation):
+        with self._lock:
+            return self._latest.get(key) == generation
+
+    def isPending(self, key):
+        with self._lock:
+            return key in self._latest
+
+    def pendingCount(self):
+        """
+        Return the number of keys whose newest request has not been shown yet
+        """
+        with self._lock:
+            return len(self._latest)
+
+    def cancel(self, key):
+        """
+        Discard the outstanding request for key, if any
+        """
+        with self._lock:
+            self._latest.pop(key, None)
+            self._callbacks.pop(key, None)
+
+    def shutdown(self):
+        with self._lock:
+            self._latest.clear()
+            self._callbacks.clear()
+        self._pool.shutdown(wait=False)
+
+    def counters(self):
+        """
+        Return a dictionary with the number of results shown and the number of stale requests dropped
+        """
+        return dict(delivered=self.delivered, dropped=self.dropped)
+
+    def _render(self, key, generation, func):
+        if not self.isCurrent(key, generation):
+            with self._lock:
+                self.dropped += 1  # Superseded before it started
+            return
+        try:
+            result = func()
+        except Exception as err:  # Report the failure rather than losing it in the pool
+            print("Failed to render slice: {}".format(err))
+            with self._lock:
+                if self._latest.get(key) == generation:
+                    del self._latest[key]
+                    del self._callbacks[key]
+            return
+        self.rendered.emit(key, generation, result)
+
+    def _deliver(self, key, generation, result):
+        with self._lock:
+            if self._latest.get(key) != generation:
+                self.dropped += 1
+                return
+            del self._latest[key]
+            callback = self._callbacks.pop(key)
+            self.delivered += 1
+        callback(result)
@@ -0,0 +1,196 @@
+"""
+Blend all image stacks shown in an axis into one RGBA image with numpy.
+
+Normally each image stack has its own ImageItem, drawn with CompositionMode_Plus, so Qt blends
+one full-size image per stack every time an axis is painted. With the "compositeStacks"
+preference each axis instead shows a single ImageItem holding the sum of every visible stack,
+each coloured with its own lookup table, levels and alpha.
+
+The colour contributed by each stack is kept, together with a key describing the slice, levels
+and lookup table it was made from, and so is their running sum. Only stacks whose key changed
+are coloured again, and their old contribution is swapped for the new one in the sum.
+Hiding or showing a stack just subtracts or adds its contribution: the others are not touched.
+"""
+
+import numpy as np
+import pyqtgraph as pg
+from PyQt5 import QtGui
+
+
+def premultiplied(rgba):
+    """
+    Return the colours of the RGBA uint8 image multiplied by their alpha, as uint16.
+    This is what Qt adds up when painting with CompositionMode_Plus.
+    """
+    contribution = rgba.astype(np.uint16)
+    contribution[..., :3] *= contribution[..., 3:4]
+    contribution[..., :3] //= 255
+    return contribution
+
+
+def composite_layers(previous, layers, shape):
+    """
+    Blend layers into one image. This does not touch the GUI so it can be run on a worker thread.
+    It does not modify previous, so a result that arrives too late can simply be discarded.
+
+    previous - the state returned by the last call, or None
+    layers - list of (name, key, visible, produce). produce is a function returning (plane, RGBA image)
+             for the layer, or None if the layer is hidden or unchanged since previous (same key).
+    shape - the shape of the blended image. Smaller layers are placed at its origin.
+
+    Returns (state, image, planes) where image is an RGBA uint8 array and planes maps the name
+    of each re-coloured layer to its plane of intensities.
+    """
+    if previous is None or previous["shape"] != shape:
+        # Contributions can be re-used, but their sum has to be rebuilt
+        contributions = {} if previous is None else dict(previous["layers"])
+        total = np.zeros(shape + (4,), dtype=np.uint32)
+        summed = set()
+    else:
+        contributions = dict(previous["layers"])
+        total = previous["total"].copy()
+        summed = set(previous["summed"])
+
+    def add(contribution, sign):
+        region = total[: contribution.shape[0], : contribution.shape[1]]
+        if sign > 0:
+            region += contribution
+        else:
+            region -= contribution
+
+    planes = {}
+    wanted = set()
+    for name, key, visible, produce in layers:
+        wanted.add(name)
+        if produce is not None or (name in contributions and contributions[name][0] != key):
+            # Out of date. Hidden layers are only coloured again when they are shown.
+            if name in summed:
+                add(contributions[name][1], -1)
+                summed.discard(name)
+            contributions.pop(name, None)
+
+        if produce is not None:
+            plane, rgba = produce()
+            planes[name] = plane
+            contributions[name] = (key, premultiplied(rgba))
+
+        if name not in contributions:
+            continue
+        if visible and name not in summed:
+            add(contributions[name][1], 1)
+            summed.add(name)
+        elif not visible and name in summed:
+            add(contributions[name][1], -1)
+            summed.discard(name)
+
+    # Stacks that were removed
+    for name in list(contributions):
+        if name not in wanted:
+            if name in summed:
+                add(contributions[name][1], -1)
+                summed.discard(name)
+            del contributions[name]
+
+    image = np.minimum(total, 255).astype(np.uint8)
+    state = dict(layers=contributions, total=total, summed=summed, shape=shape)
+    return state, image, planes
+
+
+class StackCompositor(object):
+    def __init__(self, projection):
+        """
+        projection - the lasagna_axis.projection2D whose image stacks are blended
+        """
+        self.projection = projection
+        self.item = pg.ImageItem()
+        self.item.setZValue(-1)  # Below points, lines and other overlays
+        projection.view.addItem(self.item)
+        self._state = None  # The state of the blended image on display [see composite_layers]
+        self._requested = None
+
+    def draw(self, stacks, sliceToPlot, pyramidFactor, region=None):
+        """
+        Show slice sliceToPlot of the image stacks "stacks", blended, at the given pyramid level.
+        region, if given, is the part of the planes in view [see lasagna_axis.visibleRegion].
+        The ImageItems of the individual stacks are hidden.
+        """
+        axis = self.projection.axisToPlot
+        lasagna = self.projection.lasagna
+
+        layers = []
+        shape = (0, 0)
+        current = {} if self._state is None else self._state["layers"]
+        for stack in stacks:
+            stack_item = self.projection.getPlotItemByName(stack.objectName)
+            if stack_item is not None and stack_item.isVisible():
+                stack_item.setVisible(False)
+
+            n_slices, rows, cols = stack.data(axis).shape
+            clipped = stack.clipRegion(axis, region)
+            if clipped is not None:  # All stacks share the origin of the region
+                rows, cols = clipped[0][1] - clipped[0][0], clipped[1][1] - clipped[1][0]
+            visible = stack.enable and 0 <= sliceToPlot < n_slices and rows > 0 and cols > 0
+            key = stack.sliceKey(axis, min(max(sliceToPlot, 0), n_slices - 1), pyramidFactor, clipped)
+            if visible:
+                shape = (max(shape[0], -(-rows // pyramidFactor)), max(shape[1], -(-cols // pyramidFactor)))
+            layers.append((stack, key, visible, clipped))
+
+        wanted = (shape, region, tuple((stack.objectName, key, visible) for stack, key, visible, _ in layers))
+        renderer = getattr(lasagna, "sliceRenderer", None)
+        if renderer is not None and renderer.isPending(self.item):
+            if wanted == self._requested:
+                return
+        elif self._state is not None and wanted == self._state.get("wanted"):
+            return
+        self._requested = wanted
+
+        if shape == (0, 0):
+            if renderer is not None:
+                renderer.cancel(self.item)
+            self.item.setVisible(False)
+            return
+
+        jobs = []
+        for stack, key, visible, clipped in layers:
+            produce = None
+            if visible and current.get(stack.objectName, (None,))[0] != key:
+                prefetched = stack.prefetched(key)
+                if prefetched is not None and prefetched[1] is not None:
+                    produce = lambda result=prefetched: result
+                else:
+                    produce = stack.sliceJob(axis, key[0][2], pyramidFactor, region=clipped)
+            jobs.append((stack.objectName, key, visible, produce))
+
+        previous = self._state
+
+        def blend():
+            return composite_layers(previous, jobs, shape)
+
+        def show(result):
+            state, image, planes = result
+            state["wanted"] = wanted
+            self._state = state
+            self.item.setImage(image, autoLevels=False, levels=None, lut=None)
+            self.item.setVisible(True)
+            x0, y0 = (0, 0) if region is None else (region[0][0], region[1][0])
+            transform = QtGui.QTransform(pyramidFactor, 0, 0, pyramidFactor, x0, y0)
+            if self.item.transform() != transform:
+                self.item.setTransform(transform)
+            # Plugins that read the displayed slice find the intensities on the stacks' own items
+            for name, plane in planes.items():
+                stack_item = self.projection.getPlotItemByName(name)
+                if stack_item is not None:
+                    stack_item.dataPlane = plane
+
+        if renderer is not None:
+            renderer.submit(self.item, blend, show)
+        else:
+            show(blend())
+
+    def clear(self):
+        """
+        Forget the blended layers, e.g. when compositing is switched off
+        """
+        self._state = None
+        self._requested = None
+        self.item.setVisible(False)
@@ -0,0 +1,78 @@
+"""
+Tests of the ingredient registry. Run with:
+    python -m pytest lasagna/utils
+"""
+
+from lasagna.utils.ingredient_registry import IngredientRegistry
+
+
+class FakeIngredient(object):
+    def __init__(self, objectName):
+        self.objectName = objectName
+
+
+def ingredient_of_kind(module, objectName):
+    """
+    Make an ingredient whose kind, i.e. the module defining its class, is module
+    """
+    cls = type(module, (FakeIngredient,), {"__module__": "lasagna.ingredients." + module})
+    return cls(objectName)
+
+
+def test_lookup_by_name_and_kind():
+    registry = IngredientRegistry()
+    stack = ingredient_of_kind("imagestack", "brain.tif")
+    points = ingredient_of_kind("sparsepoints", "cells.csv")
+    registry.add(stack)
+    registry.add(points)
+
+    assert registry.kindOf(stack) == "imagestack"
+    assert registry.byName("brain.tif") is stack
+    assert registry.byName("missing") is None
+    assert registry.byKind("imagestack") == [stack]
+    assert registry.byKind("lines") == []
+    assert registry.names() == ["brain.tif", "cells.csv"]
+    assert registry.names("sparsepoints") == ["cells.csv"]
+    assert len(registry) == 2
+    assert "cells.csv" in registry
+    assert list(registry) == [stack, points]
+
+
+def test_kind_matches_end_of_module_name():
+    registry = IngredientRegistry()
+    stack = ingredient_of_kind("imagestack", "brain.tif")
+    registry.add(stack)
+    assert registry.byKind("stack") == [stack]
+
+
+def test_ingredients_are_in_the_order_added():
+    registry = IngredientRegistry()
+    added = [ingredient_of_kind("imagestack", name) for name in ("c", "a", "b")]
+    for ingredient in added:
+        registry.add(ingredient)
+    assert registry.ingredients() == added
+    assert registry.byKind("imagestack") == added
+
+
+def test_add_replaces_same_name():
+    registry = IngredientRegistry()
+    old = ingredient_of_kind("imagestack", "brain.tif")
+    new = ingredient_of_kind("sparsepoints", "brain.tif")
+    registry.add(old)
+    registry.add(new)
+    assert registry.ingredients() == [new]
+    assert registry.byKind("imagestack") == []
+    assert registry.byKind("sparsepoints") == [new]
+
+
+def test_remove():
+    registry = IngredientRegistry()
+    stack = ingredient_of_kind("imagestack", "brain.tif")
+    registry.add(stack)
+    cached = registry.ingredients()
+
+    assert registry.remove("brain.tif") is stack
+    assert registry.remove("brain.tif") is None
+    assert registry.ingredients() == []
+    assert registry.names("imagestack") == []
+    assert cached == [stack]  # Lists handed out earlier are not changed
@@ -0,0 +1,132 @@
+"""
+Tests of the slice prefetcher, with stand-ins for Lasagna, its axes and image stacks. Run with:
+    python -m pytest lasagna/utils
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from lasagna.utils.slice_prefetcher import SlicePrefetcher
+
+
+class FakeStack(object):
+    objectName = "stack"
+
+    def __init__(self, n_slices=100):
+        self.n_slices = n_slices
+        self.prepared = []
+        self.gate = None  # If set, jobs wait for it, so that the tests control when they finish
+        self.started = threading.Event()
+
+    def prefetchJob(self, axisToPlot, sliceToPlot, pyramidFactor, colour=True, region=None):
+        if not 0 <= sliceToPlot < self.n_slices:
+            return None
+
+        def job():
+            self.started.set()
+            if self.gate is not None:
+                self.gate.wait(5)
+            self.prepared.append(sliceToPlot)
+            return np.full(4, sliceToPlot, dtype=np.uint8), None
+
+        return (self.objectName, axisToPlot, sliceToPlot), job
+
+
+class FakeLasagna(object):
+    sliceRenderer = None
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+
+    def returnIngredientByType(self, kind):
+        return self.stacks
+
+
+class FakeProjection(object):
+    axisToPlot = 0
+    currentPyramidFactor = 1
+    currentRegion = None
+
+
+@pytest.fixture
+def stack():
+    return FakeStack()
+
+
+@pytest.fixture
+def prefetcher(stack):
+    prefetcher = SlicePrefetcher(FakeLasagna([stack]), ahead=4, max_workers=1)
+    yield prefetcher
+    if stack.gate is not None:
+        stack.gate.set()
+    prefetcher.shutdown()
+
+
+def wait_for(prefetcher):
+    prefetcher._pool.submit(lambda: None).result(5)  # One worker: earlier jobs are done
+
+
+def test_predicts_slices_in_the_direction_of_movement(prefetcher, stack):
+    projection = FakeProjection()
+    prefetcher.sliceChanged(projection, 10)
+    assert stack.prepared == []  # The direction is not known yet
+    prefetcher.sliceChanged(projection, 8)
+    wait_for(prefetcher)
+    assert stack.prepared[:2] == [6, 4]  # Stride 2, downwards, nearest first
+    assert all(s < 8 and s % 2 == 0 for s in stack.prepared)
+
+
+def test_lookup_counts_hits_and_misses(prefetcher, stack):
+    prefetcher.prefetch(FakeProjection(), [3])
+    wait_for(prefetcher)
+    result = prefetcher.lookup(("stack", 0, 3))
+    assert result[0][0] == 3
+    assert prefetcher.lookup(("stack", 0, 4)) is None
+    stats = prefetcher.stats()
+    assert (stats["hits"], stats["misses"], stats["prefetched"]) == (1, 1, 1)
+    assert stats["hitRate"] == 0.5
+
+    prefetcher.resetStats()
+    assert prefetcher.stats()["hits"] == 0
+
+
+def test_uncounted_lookups_leave_stats_alone(prefetcher, stack):
+    prefetcher.prefetch(FakeProjection(), [3])
+    wait_for(prefetcher)
+    assert prefetcher.lookup(("stack", 0, 3), count=False) is not None
+    assert prefetcher.lookup(("stack", 0, 4), count=False) is None
+    stats = prefetcher.stats()
+    assert (stats["hits"], stats["misses"]) == (0, 0)
+
+
+def test_new_prediction_abandons_waiting_slices(prefetcher, stack):
+    stack.gate = threading.Event()
+    projection = FakeProjection()
+    prefetcher.prefetch(projection, [1, 2, 3])
+    assert stack.started.wait(5)  # 1 is being prepared, 2 and 3 wait
+    prefetcher.prefetch(projection, [20])  # A new generation for the same axis
+    stack.gate.set()
+    wait_for(prefetcher)
+    assert stack.prepared == [1, 20]
+    assert prefetcher.stats()["skipped"] == 2
+
+
+def test_cache_is_bounded(stack):
+    prefetcher = SlicePrefetcher(FakeLasagna([stack]), max_bytes=8, max_workers=1)
+    try:
+        prefetcher.prefetch(FakeProjection(), [1, 2, 3])
+        wait_for(prefetcher)
+        stats = prefetcher.stats()
+        assert stats["cachedSlices"] == 2
+        assert stats["cachedBytes"] <= 8
+        assert prefetcher.lookup(("stack", 0, 1)) is None  # The least recently used was evicted
+    finally:
+        prefetcher.shutdown()
+
+
+def test_slices_outside_the_stack_are_skipped(prefetcher, stack):
+    prefetcher.prefetch(FakeProjection(), [-1, 100])
+    wait_for(prefetcher)
+    assert stack.prepared == []
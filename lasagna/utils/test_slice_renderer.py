@@ -0,0 +1,96 @@
+"""
+Tests of the slice colouring in slice_renderer. The module defines a Qt worker pool, so these
+tests need PyQt5. Run with:
+    python -m pytest lasagna/utils
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from lasagna.utils.slice_renderer import TileCache, lut_indices, render_slice, render_tiled
+
+
+@pytest.fixture
+def lut():
+    """
+    A 256 colour lookup table in which every entry is different
+    """
+    ramp = np.arange(256)
+    return np.column_stack((ramp, 255 - ramp, ramp // 2, np.full(256, 255))).astype(np.ubyte)
+
+
+@pytest.fixture
+def plane():
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 4096, (37, 23)).astype(np.uint16)
+
+
+def test_levels_map_to_ends_of_lut(lut):
+    plane = np.array([[0, 100, 200, 300]], dtype=np.uint16)
+    image = render_slice(plane, (100, 200), lut)
+    assert image.shape == (1, 4, 4)
+    assert image.dtype == np.ubyte
+    np.testing.assert_array_equal(image[0, 0], lut[0])
+    np.testing.assert_array_equal(image[0, 1], lut[0])
+    np.testing.assert_array_equal(image[0, 2], lut[-1])
+    np.testing.assert_array_equal(image[0, 3], lut[-1])
+
+
+def test_uint8_identity(lut):
+    plane = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    np.testing.assert_array_equal(render_slice(plane, (0, 256), lut), lut[plane])
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int8, np.uint16, np.int16])
+def test_integer_table_matches_direct_scaling(lut, plane, dtype):
+    """
+    8 and 16 bit planes are coloured from a table. It must give the colours of the direct calculation.
+    """
+    data = (plane % 100).astype(dtype)
+    if np.dtype(dtype).kind == "i":
+        data = data - 50
+    levels = (-20, 70)
+    expected = lut[lut_indices(data, levels, len(lut))]
+    np.testing.assert_array_equal(render_slice(data, levels, lut), expected)
+    np.testing.assert_array_equal(render_slice(data, levels, lut), expected)  # From the stored table
+
+
+def test_float_plane(lut):
+    plane = np.linspace(-1, 2, 30, dtype=np.float32).reshape(5, 6)
+    image = render_slice(plane, (0.0, 1.0), lut)
+    np.testing.assert_array_equal(image[0, 0], lut[0])
+    np.testing.assert_array_equal(image[-1, -1], lut[-1])
+
+
+def test_equal_levels_do_not_divide_by_zero(lut, plane):
+    image = render_slice(plane.astype(np.float32), (5, 5), lut)
+    assert np.all(image == lut[0])
+
+
+def test_tiled_matches_whole_plane(lut, plane):
+    cache = TileCache()
+    expected = render_slice(plane, (0, 4095), lut)
+    np.testing.assert_array_equal(render_tiled(plane, (0, 0), 8, (0, 4095), lut, cache, key=("a",)), expected)
+    # The second time the tiles come from the cache
+    np.testing.assert_array_equal(render_tiled(plane, (0, 0), 8, (0, 4095), lut, cache, key=("a",)), expected)
+
+
+def test_tiled_part_of_plane_uses_the_tile_grid(lut, plane):
+    cache = TileCache()
+    render_tiled(plane, (0, 0), 8, (0, 4095), lut, cache, key=("a",))
+    part = plane[8:24, 8:16]
+    image = render_tiled(part, (8, 8), 8, (0, 4095), lut, cache, key=("a",))
+    np.testing.assert_array_equal(image, render_slice(part, (0, 4095), lut))
+
+
+def test_tile_cache_is_bounded():
+    tile = np.zeros((4, 4, 4), dtype=np.ubyte)
+    cache = TileCache(max_bytes=2 * tile.nbytes)
+    for key in range(3):
+        cache.put(key, tile)
+    assert cache.get(0) is None
+    assert cache.get(2) is not None
+    cache.put("big", np.zeros(1000, dtype=np.ubyte))
+    assert cache.get("big") is None
@@ -0,0 +1,118 @@
+"""
+Tests of the numpy blending of image stacks in stack_compositor. The module also defines the
+plot item that shows the blend, so these tests need pyqtgraph. Run with:
+    python -m pytest lasagna/utils
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyqtgraph")
+
+from lasagna.utils.stack_compositor import composite_layers, premultiplied
+
+
+def solid(shape, rgba):
+    return np.broadcast_to(np.array(rgba, dtype=np.ubyte), shape + (4,)).copy()
+
+
+class Layer(object):
+    """
+    A stack shown with a single colour, which counts how often it is coloured
+    """
+
+    def __init__(self, name, rgba, shape=(3, 4)):
+        self.name = name
+        self.rgba = rgba
+        self.shape = shape
+        self.key = 0
+        self.visible = True
+        self.coloured = 0
+
+    def produce(self):
+        self.coloured += 1
+        return np.zeros(self.shape), solid(self.shape, self.rgba)
+
+    def entry(self, previous):
+        """
+        The layers entry: only produced if the key changed since the previous composite
+        """
+        unchanged = previous is not None and previous["layers"].get(self.name, (None,))[0] == self.key
+        needed = self.visible and not unchanged
+        return self.name, self.key, self.visible, self.produce if needed else None
+
+
+def composite(previous, layers, shape=(3, 4)):
+    return composite_layers(previous, [layer.entry(previous) for layer in layers], shape)
+
+
+def test_premultiplied():
+    contribution = premultiplied(np.array([[200, 100, 50, 128]], dtype=np.ubyte))
+    np.testing.assert_array_equal(contribution, [[100, 50, 25, 128]])
+
+
+def test_sum_of_layers_saturates():
+    red = Layer("red", (200, 0, 0, 255))
+    more_red = Layer("more red", (100, 10, 0, 255))
+    state, image, planes = composite(None, [red, more_red])
+    np.testing.assert_array_equal(image[0, 0], (255, 10, 0, 255))
+    assert set(planes) == {"red", "more red"}
+
+
+def test_unchanged_layers_are_not_coloured_again():
+    red = Layer("red", (200, 0, 0, 255))
+    green = Layer("green", (0, 200, 0, 255))
+    state, _, _ = composite(None, [red, green])
+    green.key = 1
+    green.rgba = (0, 100, 0, 255)
+    state, image, planes = composite(state, [red, green])
+    assert (red.coloured, green.coloured) == (1, 2)
+    assert set(planes) == {"green"}
+    np.testing.assert_array_equal(image[0, 0], (200, 100, 0, 255))
+
+
+def test_hiding_and_showing_a_layer():
+    red = Layer("red", (200, 0, 0, 255))
+    green = Layer("green", (0, 200, 0, 255))
+    state, _, _ = composite(None, [red, green])
+    green.visible = False
+    state, image, _ = composite(state, [red, green])
+    np.testing.assert_array_equal(image[0, 0], (200, 0, 0, 255))
+    green.visible = True
+    state, image, _ = composite(state, [red, green])
+    np.testing.assert_array_equal(image[0, 0], (200, 200, 0, 255))
+    assert green.coloured == 1  # Its contribution was kept while it was hidden
+
+
+def test_removed_layer_is_subtracted():
+    red = Layer("red", (200, 0, 0, 255))
+    green = Layer("green", (0, 200, 0, 255))
+    state, _, _ = composite(None, [red, green])
+    state, image, _ = composite(state, [red])
+    np.testing.assert_array_equal(image[0, 0], (200, 0, 0, 255))
+    assert set(state["layers"]) == {"red"}
+
+
+def test_previous_state_is_not_modified():
+    red = Layer("red", (200, 0, 0, 255))
+    state, _, _ = composite(None, [red])
+    total = state["total"].copy()
+    red.key = 1
+    composite(state, [red])
+    np.testing.assert_array_equal(state["total"], total)
+
+
+def test_smaller_layers_are_placed_at_the_origin():
+    small = Layer("small", (0, 0, 200, 255), shape=(2, 2))
+    _, image, _ = composite(None, [small], shape=(3, 4))
+    np.testing.assert_array_equal(image[1, 1], (0, 0, 200, 255))
+    np.testing.assert_array_equal(image[2, 3], (0, 0, 0, 0))
+
+
+def test_new_shape_rebuilds_the_sum():
+    red = Layer("red", (200, 0, 0, 255))
+    state, _, _ = composite(None, [red])
+    state, image, _ = composite(state, [red], shape=(5, 5))
+    assert image.shape == (5, 5, 4)
+    np.testing.assert_array_equal(image[0, 0], (200, 0, 0, 255))
+    assert red.coloured == 1